@@ -11,7 +11,7 @@ from pathlib import Path  # python 3.4
 #
 # third-party imports
 #
-from flask import Flask, Response, send_from_directory
+from flask import Flask, Response, abort, request, send_from_directory
 from flask_cli import FlaskCLI
 from flask_dropzone import Dropzone
 from healthcheck import HealthCheck, EnvironmentDump
@@ -24,6 +24,11 @@ coverage.process_startup()
 # local imports
 #
 from .config import configure_app
+from .memory import init_memory
+from .metrics import init_metrics
+from .pagecache import init_template_cache
+from .profiling import init_profiling
+from . import logtail
 #
 # Non-configurable global constants.
 #
@@ -49,6 +54,10 @@ app = Flask(__name__,
 FlaskCLI(app)
 Dropzone(app)
 configure_app(app)
+init_metrics(app)
+init_profiling(app)
+init_memory(app)
+init_template_cache(app)
 #
 # Application data for optional environment dump.
 #
@@ -100,13 +109,59 @@ def hello_world():
 
 @app.route('/log.txt')
 def return_log():
-    """Return the log file.
+    """Return all or part of the server log file.
+
+    The log is streamed in chunks rather than read whole.  Byte ranges
+    may be requested with a Range header.  Query parameters are:
+
+        lines:   return only the last N lines.
+        since:   return only lines stamped at or after this date/time.
+        follow:  keep streaming lines as they are appended, for up to
+                 LOG_FOLLOW_SECONDS.
 
     :return: text/plain response
     """
-    content = get_file(__name__ + '_server.log',
-                       file_type='log')
-    return Response(content, mimetype=TEXT_MIMETYPE)
+    log_path = Path(app.config['LOG']) / (__name__ + '_server.log')
+    try:
+        with log_path.open(mode='rb') as log_fh:
+            end = log_fh.seek(0, os.SEEK_END)
+            start = 0
+            since = request.args.get('since')
+            if since is not None:
+                since_stamp = logtail.normalize_timestamp(since)
+                if since_stamp is None:
+                    abort(400)
+                start = logtail.since_offset(log_fh, since_stamp, end=end)
+            lines = request.args.get('lines', type=int)
+            if lines is not None:
+                start = max(start, logtail.tail_offset(log_fh, lines,
+                                                       end=end))
+    except IOError as exc:
+        return Response(str(exc), mimetype=TEXT_MIMETYPE)
+    if request.args.get('follow'):
+        return Response(logtail.follow(str(log_path),
+                                       start,
+                                       app.config['LOG_FOLLOW_SECONDS']),
+                        mimetype=TEXT_MIMETYPE,
+                        direct_passthrough=True)
+    status = 200
+    headers = {'Accept-Ranges': 'bytes'}
+    byte_range = request.range
+    if byte_range is not None and start == 0:
+        length = end
+        range_tuple = byte_range.range_for_length(length)
+        if range_tuple is None:
+            return Response(status=416,
+                            headers={'Content-Range': 'bytes */%d' % length})
+        start, end = range_tuple
+        status = 206
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, length)
+    headers['Content-Length'] = str(end - start)
+    return Response(logtail.iter_range(str(log_path), start, end),
+                    status=status,
+                    headers=headers,
+                    mimetype=TEXT_MIMETYPE,
+                    direct_passthrough=True)
 
 
 @app.route('/test_exception')
@@ -120,4 +175,5 @@ def favicon():
                                'favicon.ico',
                                mimetype=ICON_MIMETYPE)
 
+from .admin import *
 from .core import *
\ No newline at end of file
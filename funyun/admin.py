@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Administrative and instrumentation URLs.
+"""
+#
+# standard library imports
+#
+import json
+import time
+from io import StringIO
+#
+# third-party imports
+#
+from flask import Response, abort, request, send_from_directory
+#
+# local imports
+#
+from . import app
+from . import memory
+from .clientpool import ClientPool
+from .metrics import METRICS
+from .profiling import PROFILE_EXT, list_profiles, profile_dir
+#
+# Global defs.
+#
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+JSON_MIMETYPE = 'application/json'
+TEXT_MIMETYPE = 'text/plain'
+MEMORY_KEY_TYPES = ('filename', 'lineno', 'traceback')
+#
+# Routes (URLS) start here.
+#
+@app.route('/metrics')
+def metrics():
+    """Return metrics from all worker processes.
+
+    :return: Prometheus text format
+    """
+    if not app.config['METRICS']:
+        abort(404)
+    return Response(METRICS.render(), content_type=PROMETHEUS_MIMETYPE)
+
+
+@app.route('/profiles')
+def profiles():
+    """List saved request profiles, newest first.
+
+    :return: text/plain response
+    """
+    outstr = StringIO()
+    for path in list_profiles(app):
+        stat = path.stat()
+        outstr.write('%s  %8d  %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S',
+                                                      time.gmtime(
+                                                          stat.st_mtime)),
+                                        stat.st_size,
+                                        path.name))
+    return Response(outstr.getvalue(), mimetype=TEXT_MIMETYPE)
+
+
+@app.route('/profiles/<name>')
+def profile(name):
+    """Return one saved profile in collapsed-stack format.
+
+    :return: text/plain response
+    """
+    if not name.endswith(PROFILE_EXT):
+        abort(404)
+    return send_from_directory(str(profile_dir(app)),
+                               name,
+                               mimetype=TEXT_MIMETYPE)
+
+
+@app.route('/memory')
+def memory_status():
+    """Report memory use and tracing state of the worker that answers.
+
+    :return: text/plain response
+    """
+    return Response(memory.status(), mimetype=TEXT_MIMETYPE)
+
+
+@app.route('/memory/start', methods=['POST'])
+def memory_start():
+    """Start tracemalloc, with ?frames=N frames per traceback.
+
+    :return: text/plain response
+    """
+    memory.start_tracing(request.args.get('frames', default=1, type=int))
+    return Response(memory.status(), mimetype=TEXT_MIMETYPE)
+
+
+@app.route('/memory/stop', methods=['POST'])
+def memory_stop():
+    """Stop tracemalloc and discard snapshots.
+
+    :return: text/plain response
+    """
+    memory.stop_tracing()
+    return Response(memory.status(), mimetype=TEXT_MIMETYPE)
+
+
+def memory_key_type():
+    """Return the ?key= grouping of allocation sites, or abort 400."""
+    key_type = request.args.get('key', default='lineno')
+    if key_type not in MEMORY_KEY_TYPES:
+        abort(400)
+    return key_type
+
+
+@app.route('/memory/snapshot', methods=['POST'])
+def memory_snapshot():
+    """Take a snapshot and report its top allocation sites.
+
+    :return: text/plain response
+    """
+    key_type = memory_key_type()
+    try:
+        snapshot = memory.take_snapshot()
+    except RuntimeError:
+        abort(409)
+    return Response(memory.format_top(snapshot,
+                                      limit=request.args.get('limit',
+                                                             default=25,
+                                                             type=int),
+                                      key_type=key_type),
+                    mimetype=TEXT_MIMETYPE)
+
+
+@app.route('/memory/diff')
+def memory_diff():
+    """Compare the last two snapshots (or first and last, with ?since=first).
+
+    :return: text/plain response
+    """
+    key_type = memory_key_type()
+    if len(memory.SNAPSHOTS) < 2:
+        abort(409)
+    if request.args.get('since') == 'first':
+        old = memory.SNAPSHOTS[0]
+    else:
+        old = memory.SNAPSHOTS[-2]
+    return Response(memory.format_diff(old,
+                                       memory.SNAPSHOTS[-1],
+                                       limit=request.args.get('limit',
+                                                              default=25,
+                                                              type=int),
+                                       key_type=key_type),
+                    mimetype=TEXT_MIMETYPE)
+
+
+@app.route('/rekognition/endpoints')
+def rekognition_endpoints():
+    """Report latency statistics for each Rekognition endpoint.
+
+    :return: JSON list, empty if a single endpoint is configured
+    """
+    from .core import REK
+    stats = []
+    if isinstance(REK.client, ClientPool):
+        stats = REK.client.stats()
+    return Response(json.dumps(stats), mimetype=JSON_MIMETYPE)
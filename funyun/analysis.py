@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""Analyze an image, producing results as plain JSON-able data.
+
+Results are dicts of built-in types so they can be shared between
+requests, written to disk and sent to other processes.
+"""
+#
+# Standard library imports.
+#
+from collections import OrderedDict
+from concurrent.futures import as_completed
+from io import StringIO
+#
+# Local imports.
+#
+from .cassette import image_digest
+from .metrics import METRICS
+#
+# Global defs.
+#
+ANALYSIS_VERSION = 2  # bump when the result layout changes
+WIKIPEDIA_QUERY = r'https://google.com/search?q="%s"' + \
+                  '&as_sitesearch=wikipedia.org&btnI'
+IMAGES_QUERY = r'https://google.com/search?q="%s"&safe=on&tbm=isch&btnI'
+
+
+def analysis_key(digest, **params):
+    """Return a key identifying an analysis of an image with parameters."""
+    key = '%s-v%d' % (digest, ANALYSIS_VERSION)
+    for name in sorted(params):
+        key += '-%s=%s' % (name, params[name])
+    return key
+
+
+def face_to_dict(face):
+    """Convert a Rekognize.Face to a dict."""
+    return {'confidence': face.confidence,
+            'box': face.bounding_box,
+            'age': {'low': face.age.low, 'high': face.age.high},
+            'emotions': OrderedDict(face.emotions),
+            'features': [{'name': feature.name,
+                          'value': feature.value,
+                          'confidence': feature.confidence}
+                         for feature in face.features]}
+
+
+def celebrity_to_dict(celebrity):
+    """Convert a Rekognize.Celebrity to a dict."""
+    return {'name': celebrity.name,
+            'id': celebrity.id,
+            'urls': list(celebrity.urls),
+            'confidence': celebrity.confidence}
+
+
+def enrich_celebrity(celebrity, http, deadline=None):
+    """Add links found by searching for a celebrity's name.
+
+    :param celebrity: dict from celebrity_to_dict(); 'url' and
+                      'imageurl' are added to it.
+    :param http: a requests session.
+    :param deadline: a deadline.Deadline bounding each lookup, or None.
+    """
+    def timeout():
+        if deadline is None:
+            return None
+        deadline.check()
+        return deadline.remaining()
+
+    if len(celebrity['urls']) > 0:
+        celebrity['url'] = 'http://' + celebrity['urls'][0]
+    else:
+        with METRICS.timer('funyun_enrichment_seconds', service='wikipedia'):
+            celebrity['url'] = http.get(WIKIPEDIA_QUERY % celebrity['name'],
+                                        timeout=timeout()).url
+    with METRICS.timer('funyun_enrichment_seconds', service='images'):
+        celebrity['imageurl'] = http.get(IMAGES_QUERY % celebrity['name'],
+                                         timeout=timeout()).url
+    return celebrity
+
+
+def find_celebrities(rek, image):
+    """Return the celebrities in an image, as dicts."""
+    return [celebrity_to_dict(c) for c in rek.recognize_celebrities(image)]
+
+
+def find_labels(rek, image):
+    """Return {label: confidence} for an image."""
+    return rek.detect_labels(image)
+
+
+def find_faces(rek, image):
+    """Return the faces in an image, as dicts."""
+    return [face_to_dict(f) for f in rek.detect_faces(image)]
+
+
+SECTIONS = (('celebrities', find_celebrities),
+            ('labels', find_labels),
+            ('faces', find_faces))
+
+
+def iter_analysis(rek, image, executor):
+    """Run the analyses of an image concurrently.
+
+    :param rek: a Rekognize instance.
+    :param image: image bytes.
+    :param executor: a concurrent.futures executor to run them on.
+    :return: iterator of (section, results) in order of completion,
+             where section is 'celebrities', 'labels' or 'faces'.
+    """
+    futures = {executor.submit(func, rek, image): section
+               for section, func in SECTIONS}
+    for future in as_completed(futures):
+        yield futures[future], future.result()
+
+
+def partial_result(digest, size, sections):
+    """Return a result with the sections finished so far.
+
+    :param digest: image digest.
+    :param size: image size in bytes.
+    :param sections: dict of section: results for those finished.
+    :return: dict of results; unfinished sections are empty and listed
+             in 'missing'.
+    """
+    result = {'digest': digest, 'size': size, 'missing': []}
+    for section, unused in SECTIONS:
+        if section in sections:
+            result[section] = sections[section]
+        else:
+            result[section] = {} if section == 'labels' else []
+            result['missing'].append(section)
+    return result
+
+
+def analyze_image(rek, image, http=None):
+    """Run all analyses of an image.
+
+    :param rek: a Rekognize instance.
+    :param image: image bytes.
+    :param http: requests session for celebrity lookups, or None to
+                 skip them.
+    :return: dict of results.
+    """
+    celebrities = find_celebrities(rek, image)
+    labels = find_labels(rek, image)
+    faces = find_faces(rek, image)
+    if http is not None and len(celebrities) > 0:
+        enrich_celebrity(celebrities[0], http)
+    return {'digest': image_digest(image),
+            'size': len(image),
+            'labels': labels,
+            'faces': faces,
+            'celebrities': celebrities}
+
+
+def format_text(result):
+    """Format analysis results as plain text."""
+    text = ''.join(format_text_section(section, result[section])
+                   for section, unused in SECTIONS)
+    if result.get('missing'):
+        text += 'missing (deadline exceeded): %s\n' % \
+            ', '.join(result['missing'])
+    return text
+
+
+def format_text_section(section, data):
+    """Format one section of analysis results as plain text."""
+    if not data:
+        return ''
+    outstr = StringIO()
+    if section == 'celebrities':
+        outstr.write('celebrities:\n')
+        for celebrity in data:
+            outstr.write('   %s (%.0f%%)\n' % (celebrity['name'],
+                                              celebrity['confidence']))
+            for url in celebrity['urls']:
+                outstr.write('       http://%s\n' % url)
+    elif section == 'labels':
+        outstr.write('labels:\n')
+        for label, confidence in data.items():
+            outstr.write('   %s (%.0f%%)\n' % (label, confidence))
+    elif section == 'faces':
+        outstr.write('faces:\n')
+        for face_num, face in enumerate(data):
+            outstr.write('   Face %d (%.0f%%), age %d to %d:\n'
+                         % (face_num, face['confidence'],
+                            face['age']['low'], face['age']['high']))
+            for emotion, confidence in face['emotions'].items():
+                outstr.write('      %s (%.0f%%)\n' % (emotion, confidence))
+            for feature in face['features']:
+                if feature['value']:
+                    outstr.write('      %s: %s (%.0f%%)\n'
+                                 % (feature['name'], feature['value'],
+                                    feature['confidence']))
+    return outstr.getvalue()
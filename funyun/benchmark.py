@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""Time the analysis pipeline offline, using recorded responses.
+
+Rekognition responses and enrichment lookups are served from
+benchmarks/recorded_responses.json, so the numbers measure only our own
+code: response parsing, upload handling, template rendering and the
+request path through Flask.  S3, the call scheduler, caches and eager
+background analysis are turned off, and uploads go to a temporary
+directory, so a run neither touches nor is slowed by shared state.
+Results can be saved as JSON and compared against a stored baseline.
+"""
+#
+# Standard library imports.
+#
+import json
+import pkgutil
+import platform
+import statistics
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path  # python 3.4
+#
+# Global defs.
+#
+RESPONSES_RESOURCE = 'benchmarks/recorded_responses.json'
+IMAGE_RESOURCE = 'static/nora.jpg'
+IMAGE_NAME = 'nora.jpg'
+DEFAULT_ITERATIONS = 200
+DEFAULT_TOLERANCE = 0.10
+WARMUP_FRACTION = 0.1
+
+
+class RecordedClient(object):
+    """Stand-in for a boto3 Rekognition client that replays responses."""
+
+    def __init__(self, responses):
+        self.responses = responses
+
+    def __getattr__(self, operation):
+        try:
+            response = self.responses[operation]
+        except KeyError:
+            raise AttributeError(operation)
+        return lambda **params: response
+
+
+class RecordedSession(object):
+    """Stand-in for a requests session that replays enrichment lookups."""
+
+    class Response(object):
+        def __init__(self, url):
+            self.url = url
+            self.status_code = 200
+
+    def __init__(self, urls):
+        self.urls = urls
+
+    def get(self, url, **kwargs):
+        if 'wikipedia' in url:
+            return self.Response(self.urls['wikipedia'])
+        return self.Response(self.urls['images'])
+
+
+def load_responses():
+    """Load the recorded responses shipped with the package."""
+    return json.loads(pkgutil.get_data(__name__.split('.')[0],
+                                       RESPONSES_RESOURCE).decode('UTF-8'))
+
+
+def time_case(func, iterations):
+    """Time repeated calls to func.
+
+    :param func: callable with no arguments.
+    :param iterations: number of timed calls.
+    :return: dict of timing statistics in microseconds.
+    """
+    for unused in range(max(1, int(iterations * WARMUP_FRACTION))):
+        func()
+    times = []
+    for unused in range(iterations):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1e6)
+    times.sort()
+    return {'iterations': iterations,
+            'min_us': times[0],
+            'median_us': statistics.median(times),
+            'mean_us': statistics.mean(times),
+            'p95_us': times[min(len(times) - 1, int(len(times) * 0.95))]}
+
+
+def benchmark_cases(app, image, responses):
+    """Return an ordered list of (name, callable) benchmark cases.
+
+    :param app: the Flask app.
+    :param image: bytes of the image to upload.
+    :param responses: recorded responses, as from load_responses().
+    """
+    from flask import render_template, request
+    from . import core
+    from .cassette import image_digest
+    rek = core.REK
+    template_data = core.get_analysis_data(image)
+    client = app.test_client()
+
+    def upload():
+        with app.test_request_context('/funyun/recognize',
+                                      method='POST',
+                                      data={'image': (BytesIO(image),
+                                                      IMAGE_NAME)}):
+            core.get_image(request.files)
+
+    def render():
+        with app.test_request_context('/funyun/analyze'):
+            render_template('analyze.html', **template_data)
+
+    def end_to_end_analyze():
+        client.post('/funyun/recognize',
+                    data={'image': (BytesIO(image), IMAGE_NAME)})
+        page = client.get('/funyun/analyze', follow_redirects=True)
+        if b'EventSource' in page.data:
+            client.get('/funyun/analyze_stream/' +
+                       image_digest(image)).get_data()
+
+    def end_to_end_text():
+        client.post('/funyun/recognize_as_text',
+                    data={'image': (BytesIO(image), IMAGE_NAME)})
+
+    return [('detect_faces', lambda: rek.detect_faces(image)),
+            ('detect_labels', lambda: rek.detect_labels(image)),
+            ('recognize_celebrities',
+             lambda: rek.recognize_celebrities(image)),
+            ('get_image', upload),
+            ('render_analyze', render),
+            ('end_to_end_analyze', end_to_end_analyze),
+            ('end_to_end_recognize_as_text', end_to_end_text)]
+
+
+def run_benchmarks(app, iterations=DEFAULT_ITERATIONS, selected=None):
+    """Run the benchmark cases with network calls replaced by recordings.
+
+    :param app: the Flask app.
+    :param iterations: timed iterations per case.
+    :param selected: names of cases to run, or None for all.
+    :return: dict of results, suitable for saving as JSON.
+    """
+    from . import core
+    from .chunks import ChunkedUploads
+    from .singleflight import SingleFlight
+    from .uploads import UploadStore
+    responses = load_responses()
+    image = pkgutil.get_data(__name__.split('.')[0], IMAGE_RESOURCE)
+    tmp_dir = tempfile.TemporaryDirectory(prefix='funyun-benchmark-')
+    saved = (core.REK.client, core.REK.scheduler, core.REK.image_store,
+             core.HTTP, core.SINGLE_FLIGHT, core.RESULTS, core.PAGES,
+             core.SHARED, core.SCHEDULER, core.IMAGE_STORE, core.UPLOADS,
+             core.CHUNKS, app.config['EAGER_ANALYSIS'])
+    core.REK.client = RecordedClient(responses)
+    core.REK.scheduler = core.SCHEDULER = None
+    core.REK.image_store = core.IMAGE_STORE = None
+    core.HTTP = RecordedSession(responses['enrichment'])
+    core.SINGLE_FLIGHT = SingleFlight()  # no result sharing between runs
+    core.RESULTS = None
+    core.PAGES = None
+    core.SHARED = None
+    core.UPLOADS = UploadStore(Path(tmp_dir.name) / 'uploads')
+    core.CHUNKS = ChunkedUploads(Path(tmp_dir.name) / 'chunks',
+                                 max_bytes=app.config['UPLOAD_MAX_BYTES'])
+    app.config['EAGER_ANALYSIS'] = False
+    results = {'version': app.config['VERSION'],
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               'cases': {}}
+    try:
+        for name, func in benchmark_cases(app, image, responses):
+            if selected and name not in selected:
+                continue
+            results['cases'][name] = time_case(func, iterations)
+    finally:
+        core.REK.client, core.REK.scheduler, core.REK.image_store, \
+            core.HTTP, core.SINGLE_FLIGHT, core.RESULTS, core.PAGES, \
+            core.SHARED, core.SCHEDULER, core.IMAGE_STORE, core.UPLOADS, \
+            core.CHUNKS, app.config['EAGER_ANALYSIS'] = saved
+        tmp_dir.cleanup()
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Compare median times against a baseline.
+
+    :param results: results from run_benchmarks().
+    :param baseline: earlier results from run_benchmarks().
+    :param tolerance: fractional slowdown allowed before flagging.
+    :return: list of (name, baseline_us, current_us, ratio, regressed).
+    """
+    comparisons = []
+    for name, case in sorted(results['cases'].items()):
+        if name not in baseline['cases']:
+            continue
+        base_us = baseline['cases'][name]['median_us']
+        current_us = case['median_us']
+        ratio = current_us / base_us
+        comparisons.append((name, base_us, current_us, ratio,
+                            ratio > 1. + tolerance))
+    return comparisons
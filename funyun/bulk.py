@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""Analyze every image in a directory tree, resumably.
+
+A checkpoint database records each image analyzed, by digest and by
+path, size and modification time.  On a rerun, files whose path, size
+and time match are skipped without being read, and files with an
+already-analyzed digest (copies, renames) are skipped after reading.
+Results are written to the output file before the checkpoint is
+updated, so an interrupted run may repeat at most the records in
+flight; it never loses one.
+"""
+#
+# Standard library imports.
+#
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path  # python 3.4
+#
+# Local imports.
+#
+from .analysis import analyze_image
+from .cassette import image_digest
+from .imagecheck import ImageValidationError, validate_image
+from .results import exif_info
+#
+# Global defs.
+#
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+OUTPUT_FORMATS = ('jsonl', 'csv')
+CSV_COLUMNS = ('path', 'digest', 'size', 'labels', 'faces', 'celebrities')
+PROGRESS_INTERVAL = 1.  # seconds between progress reports
+SCHEMA = ("""CREATE TABLE IF NOT EXISTS done (
+                 digest TEXT PRIMARY KEY,
+                 path TEXT NOT NULL,
+                 size INTEGER NOT NULL,
+                 mtime REAL NOT NULL,
+                 status TEXT NOT NULL,
+                 finished REAL NOT NULL)""",
+          'CREATE INDEX IF NOT EXISTS done_path ON done (path)')
+
+
+class Checkpoint(object):
+    """SQLite record of images already analyzed.
+
+    Only the thread that created it may use it.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def has_file(self, path, size, mtime):
+        """Return True if this exact file was analyzed."""
+        return self.connection.execute(
+            'SELECT 1 FROM done WHERE path = ? AND size = ? AND mtime = ?',
+            (str(path), size, mtime)).fetchone() is not None
+
+    def has_digest(self, digest):
+        """Return True if an image with this digest was analyzed."""
+        return self.connection.execute(
+            'SELECT 1 FROM done WHERE digest = ?',
+            (digest,)).fetchone() is not None
+
+    def mark(self, digest, path, size, mtime, status='ok'):
+        """Record an image as done."""
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO done VALUES (?, ?, ?, ?, ?, ?)',
+                (digest, str(path), size, mtime, status, time.time()))
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM done').fetchone()[0]
+
+
+class ResultWriter(object):
+    """Append results to a JSON-lines or CSV file."""
+
+    def __init__(self, path, output_format='jsonl'):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('Unknown output format "%s"' % output_format)
+        self.output_format = output_format
+        path = Path(path)
+        new_file = not path.exists() or path.stat().st_size == 0
+        self.fh = path.open('a', newline='')
+        if output_format == 'csv':
+            self.csv = csv.writer(self.fh)
+            if new_file:
+                self.csv.writerow(CSV_COLUMNS)
+
+    def write(self, path, result):
+        """Write one result and flush it to disk."""
+        if self.output_format == 'jsonl':
+            record = dict(result, path=str(path))
+            self.fh.write(json.dumps(record, separators=(',', ':')) + '\n')
+        else:
+            self.csv.writerow((str(path),
+                               result['digest'],
+                               result['size'],
+                               ';'.join(result['labels']),
+                               len(result['faces']),
+                               ';'.join(c['name']
+                                        for c in result['celebrities'])))
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def close(self):
+        self.fh.close()
+
+
+def find_images(root, extensions=IMAGE_EXTENSIONS):
+    """Return sorted paths of image files below root."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(str(root)):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() in extensions:
+                paths.append(Path(dirpath) / filename)
+    return paths
+
+
+class Progress(object):
+    """Report throughput and estimated time remaining."""
+
+    def __init__(self, total=0, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.start = time.monotonic()
+        self.last_report = 0.
+        self.counts = {'analyzed': 0, 'skipped': 0, 'invalid': 0,
+                       'errors': 0}
+
+    def count(self, outcome, report=True):
+        self.counts[outcome] += 1
+        if report and time.monotonic() - self.last_report >= \
+                PROGRESS_INTERVAL:
+            self.report()
+
+    def report(self, end='\r'):
+        self.last_report = time.monotonic()
+        if self.stream is None:
+            return
+        elapsed = self.last_report - self.start
+        done = sum(self.counts.values())
+        rate = self.counts['analyzed'] / elapsed if elapsed > 0 else 0.
+        if rate > 0:
+            eta = time.strftime('%H:%M:%S',
+                                time.gmtime((self.total - done) / rate))
+        else:
+            eta = '--:--:--'
+        self.stream.write('%d/%d files (%d analyzed, %d skipped, %d invalid,'
+                          ' %d errors), %.1f files/s, ETA %s%s'
+                          % (done, self.total, self.counts['analyzed'],
+                             self.counts['skipped'], self.counts['invalid'],
+                             self.counts['errors'], rate, eta, end))
+        self.stream.flush()
+
+
+def analyze_tree(rek,
+                 root,
+                 checkpoint,
+                 writer,
+                 workers=4,
+                 min_dimension=1,
+                 max_dimension=None,
+                 progress=None,
+                 log=None,
+                 store=None):
+    """Analyze the images below root that the checkpoint has not seen.
+
+    Files are read and checked on this thread; analyses run on a pool
+    of workers with a bounded number in flight.
+
+    :param rek: a Rekognize instance.
+    :param root: directory to walk.
+    :param checkpoint: a Checkpoint.
+    :param writer: a ResultWriter.
+    :param workers: number of concurrent analyses.
+    :param min_dimension: see imagecheck.validate_image().
+    :param max_dimension: see imagecheck.validate_image().
+    :param progress: a Progress, or None.
+    :param log: callable for error messages, or None.
+    :param store: a results.ResultsStore to save results in, or None.
+    :return: dict of counts of analyzed, skipped, invalid and errors.
+    """
+    paths = find_images(root)
+    if progress is None:
+        progress = Progress(stream=None)
+    progress.total = len(paths)
+    pending = deque()
+    in_flight = set()  # digests submitted but not yet checkpointed
+
+    def finish(entry):
+        path, digest, size, mtime, exif, future = entry
+        in_flight.discard(digest)
+        try:
+            result = future.result()
+        except Exception as exc:  # retried on the next run
+            if log is not None:
+                log('%s: %s' % (path, exc))
+            progress.count('errors')
+            return
+        writer.write(path, result)
+        if store is not None:
+            store.save(result, exif)
+        checkpoint.mark(digest, path, size, mtime)
+        progress.count('analyzed')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path in paths:
+            stat = path.stat()
+            if checkpoint.has_file(path, stat.st_size, stat.st_mtime):
+                progress.count('skipped')
+                continue
+            data = path.read_bytes()
+            digest = image_digest(data)
+            if digest in in_flight or checkpoint.has_digest(digest):
+                progress.count('skipped')
+                continue
+            try:
+                validate_image(data,
+                               min_dimension=min_dimension,
+                               max_dimension=max_dimension)
+            except ImageValidationError as exc:
+                if log is not None:
+                    log('%s: %s' % (path, exc))
+                checkpoint.mark(digest, path, stat.st_size, stat.st_mtime,
+                                status='invalid')
+                progress.count('invalid')
+                continue
+            in_flight.add(digest)
+            exif = exif_info(data) if store is not None else None
+            pending.append((path, digest, stat.st_size, stat.st_mtime, exif,
+                            executor.submit(analyze_image, rek, data)))
+            while len(pending) > workers * 2:
+                finish(pending.popleft())
+        while pending:
+            finish(pending.popleft())
+    progress.report(end='\n')
+    return progress.counts
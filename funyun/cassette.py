@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Store raw Rekognition responses for later replay.
+
+Responses are kept zlib-compressed in a single SQLite file, keyed by a
+hash of the operation name and its parameters.  Image bytes enter the
+key only through their SHA-256 digest, so keys are small and the same
+image always maps to the same response.
+"""
+#
+# Standard library imports.
+#
+import hashlib
+import json
+import sqlite3
+import threading
+import zlib
+from pathlib import Path  # python 3.4
+#
+# Global defs.
+#
+SCHEMA = """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                operation TEXT NOT NULL,
+                response BLOB NOT NULL)"""
+
+
+class CassetteMissError(LookupError):
+    """No response was recorded for a call being replayed."""
+
+
+def image_digest(img):
+    """Return the hex SHA-256 digest of image bytes."""
+    return hashlib.sha256(img).hexdigest()
+
+
+def call_key(operation, params):
+    """Compute the cassette key for a call.
+
+    :param operation: Rekognition operation name, e.g. 'detect_labels'.
+    :param params: keyword parameters of the call.
+    :return: hex digest.
+    """
+    key_params = dict(params)
+    image = key_params.get('Image')
+    if image is not None and 'Bytes' in image:
+        key_params['Image'] = {'Digest': image_digest(image['Bytes'])}
+    canonical = json.dumps([operation, key_params],
+                           sort_keys=True,
+                           separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('UTF-8')).hexdigest()
+
+
+class Cassette(object):
+    """SQLite-backed store of Rekognition responses."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        if not self.path.parent.is_dir():
+            self.path.parent.mkdir(parents=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path),
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(SCHEMA)
+
+    def get(self, key):
+        """Return the recorded response for key, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT response FROM responses WHERE key = ?',
+                (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]).decode('UTF-8'))
+
+    def put(self, key, operation, response):
+        """Record a response, dropping the per-call metadata."""
+        response = {k: v for k, v in response.items()
+                    if k != 'ResponseMetadata'}
+        blob = zlib.compress(json.dumps(response,
+                                        separators=(',', ':'),
+                                        default=str).encode('UTF-8'))
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+                (key, operation, blob))
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM responses').fetchone()[0]
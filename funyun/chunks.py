@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Assemble files uploaded in chunks.
+
+Each upload has an ID chosen by the client (Dropzone's dzuuid) and a
+directory holding its chunks, one file per chunk index, so chunks may
+arrive in any order, in parallel, from any worker, and a chunk sent
+again after a dropped connection simply replaces the first copy.  A
+client resuming an upload can ask which chunks have arrived and send
+only the rest.  The request that completes an upload assembles it;
+uploads abandoned part way are removed after a time.
+"""
+#
+# Standard library imports.
+#
+import fcntl
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path  # python 3.4
+#
+# Global defs.
+#
+UPLOAD_ID_RE = re.compile(r'^[0-9A-Za-z-]{8,64}$')
+PRUNE_EVERY = 100  # chunks stored between sweeps of abandoned uploads
+MAX_CHUNKS = 10000  # most chunks an upload may be split into
+
+
+class ChunkError(ValueError):
+    """A chunk is inconsistent with its upload; the message says why."""
+
+
+class ChunkedUploads(object):
+    """Directory of uploads in progress, one subdirectory per upload."""
+
+    def __init__(self, directory, max_bytes, ttl=3600):
+        """Create a chunked upload store.
+
+        :param directory: directory for uploads in progress.
+        :param max_bytes: largest file that may be uploaded.
+        :param ttl: seconds after its last chunk that an unfinished
+                    upload is removed.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.puts = 0
+
+    def path(self, upload_id):
+        if not UPLOAD_ID_RE.match(upload_id):
+            raise ChunkError('Invalid upload ID.')
+        return self.directory / upload_id
+
+    def _meta(self, upload_dir, total_chunks, total_bytes):
+        """Record an upload's shape, or check a chunk agrees with it."""
+        meta = {'chunks': total_chunks, 'bytes': total_bytes}
+        meta_path = upload_dir / 'meta.json'
+        try:
+            with meta_path.open() as meta_fh:
+                known = json.load(meta_fh)
+        except (OSError, ValueError):
+            known = None
+        if known is None:
+            fd, tmp_path = tempfile.mkstemp(dir=str(upload_dir),
+                                            suffix='.tmp')
+            with os.fdopen(fd, 'w') as meta_fh:
+                json.dump(meta, meta_fh)
+            os.replace(tmp_path, str(meta_path))
+        elif known != meta:
+            raise ChunkError('Chunk does not match its upload.')
+
+    def put(self, upload_id, index, total_chunks, total_bytes, data):
+        """Store a chunk.
+
+        :param upload_id: client's ID for the upload.
+        :param index: chunk number, from 0.
+        :param total_chunks: number of chunks in the upload.
+        :param total_bytes: size of the whole file.
+        :param data: chunk bytes.
+        :return: the whole file if this chunk completed it, else None.
+        :raises ChunkError: if the chunk is invalid.
+        """
+        upload_dir = self.path(upload_id)
+        if total_bytes > self.max_bytes:
+            raise ChunkError('File is larger than %d MB.'
+                             % (self.max_bytes // (1024 * 1024)))
+        if not 0 < total_chunks <= min(MAX_CHUNKS, total_bytes) or \
+                not 0 <= index < total_chunks or not data:
+            raise ChunkError('Invalid chunk %d of %d.'
+                             % (index, total_chunks))
+        upload_dir.mkdir(exist_ok=True)
+        self._meta(upload_dir, total_chunks, total_bytes)
+        if self._received_bytes(upload_dir, index) + len(data) > total_bytes:
+            raise ChunkError('Chunks are larger than the %d byte file.'
+                             % total_bytes)
+        fd, tmp_path = tempfile.mkstemp(dir=str(upload_dir), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as chunk_fh:
+                chunk_fh.write(data)
+            os.replace(tmp_path, str(upload_dir / ('%d.part' % index)))
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+        with self.lock:
+            self.puts += 1
+            prune = self.puts % PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+        if len(self.received(upload_id)) < total_chunks:
+            return None
+        return self._assemble(upload_dir, total_chunks, total_bytes)
+
+    def received(self, upload_id):
+        """Return the sorted indexes of the chunks received so far."""
+        try:
+            names = os.listdir(str(self.path(upload_id)))
+        except OSError:
+            return []
+        return sorted(int(name[:-len('.part')]) for name in names
+                      if name.endswith('.part'))
+
+    def _received_bytes(self, upload_dir, skip=None):
+        """Return the total size of the chunks stored, but one."""
+        total = 0
+        for entry in os.scandir(str(upload_dir)):
+            if entry.name.endswith('.part') and \
+                    entry.name != '%s.part' % skip:
+                try:
+                    total += entry.stat().st_size
+                except OSError:
+                    continue  # replaced or assembled meanwhile
+        return total
+
+    def _assemble(self, upload_dir, total_chunks, total_bytes):
+        """Join the chunks and remove the upload.
+
+        Only one of the requests racing to complete an upload gets the
+        file; the others get None.
+        """
+        try:
+            lock_fh = (upload_dir / 'meta.json').open()
+        except OSError:
+            return None  # assembled by another request
+        with lock_fh:
+            try:
+                fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            if not upload_dir.exists():
+                return None
+            size = self._received_bytes(upload_dir)
+            if size != total_bytes:
+                shutil.rmtree(str(upload_dir), ignore_errors=True)
+                raise ChunkError('Upload is %d bytes, expected %d.'
+                                 % (size, total_bytes))
+            try:
+                data = b''.join((upload_dir / ('%d.part' % index))
+                                .read_bytes()
+                                for index in range(total_chunks))
+            except OSError:
+                return None
+            shutil.rmtree(str(upload_dir), ignore_errors=True)
+        if len(data) != total_bytes:
+            raise ChunkError('Upload is %d bytes, expected %d.'
+                             % (len(data), total_bytes))
+        return data
+
+    def prune(self):
+        """Remove uploads with no chunk for ttl seconds."""
+        expired = time.time() - self.ttl
+        for upload_dir in self.directory.iterdir():
+            try:
+                if upload_dir.stat().st_mtime < expired:
+                    shutil.rmtree(str(upload_dir))
+            except OSError:
+                continue
@@ -31,6 +31,8 @@ from .logs import configure_logging
 from .filesystem import init_filesystem
 from .config_file import create_config_file, write_kv_to_config_file
 from .config import print_config_var
+from . import benchmark as bench
+from . import bulk
 #
 # Global variables.
 #
@@ -328,3 +330,107 @@ def create_test_files(force, configonly):
                    force,
                    notemplate_exts=['png', 'jpg', 'sh'])
 
+
+@cli.command()
+@click.option('--iterations', default=bench.DEFAULT_ITERATIONS,
+              help='Timed iterations per case.')
+@click.option('--case', 'cases', multiple=True,
+              help='Run only this case (may be repeated).')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Write results to this JSON file.')
+@click.option('--baseline', type=click.Path(dir_okay=False), default=None,
+              help='Baseline file [DATA/benchmark_baseline.json].')
+@click.option('--save-baseline/--no-save-baseline', default=False,
+              help='Save these results as the new baseline.')
+@click.option('--tolerance', default=bench.DEFAULT_TOLERANCE,
+              help='Fractional slowdown flagged as a regression.')
+def benchmark(iterations, cases, output, baseline, save_baseline, tolerance):
+    """Time the analysis pipeline against recorded responses."""
+    if baseline is None:
+        baseline_path = Path(current_app.config['DATA']) / \
+            'benchmark_baseline.json'
+    else:
+        baseline_path = Path(baseline)
+    results = bench.run_benchmarks(current_app,
+                                   iterations=iterations,
+                                   selected=cases)
+    print('%-30s %12s %12s %12s' % ('case', 'median (us)', 'min (us)',
+                                     'p95 (us)'))
+    for name, case in results['cases'].items():
+        print('%-30s %12.1f %12.1f %12.1f' % (name,
+                                              case['median_us'],
+                                              case['min_us'],
+                                              case['p95_us']))
+    if output is not None:
+        with open(output, 'w') as output_fh:
+            json.dump(results, output_fh, indent=1)
+    if save_baseline:
+        if not baseline_path.parent.is_dir():
+            baseline_path.parent.mkdir(parents=True)
+        with baseline_path.open('w') as baseline_fh:
+            json.dump(results, baseline_fh, indent=1)
+        print('Baseline saved to "%s".' % str(baseline_path))
+        return
+    if not baseline_path.exists():
+        print('No baseline at "%s", use --save-baseline to create one.'
+              % str(baseline_path))
+        return
+    with baseline_path.open() as baseline_fh:
+        baseline_results = json.load(baseline_fh)
+    print('Comparison with baseline from %s:' % baseline_results['time'])
+    regressions = 0
+    for name, base_us, current_us, ratio, regressed in \
+            bench.compare(results, baseline_results, tolerance):
+        print('%-30s %12.1f -> %10.1f  %6.2fx%s'
+              % (name, base_us, current_us, ratio,
+                 '  REGRESSION' if regressed else ''))
+        regressions += regressed
+    if regressions:
+        print('ERROR--%d case(s) slower than baseline by more than %.0f%%.'
+              % (regressions, tolerance * 100), file=sys.stderr)
+        sys.exit(1)
+
+
+@cli.command('analyze-dir')
+@click.argument('directory',
+                type=click.Path(exists=True, file_okay=False))
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--format', 'output_format', default='jsonl',
+              type=click.Choice(bulk.OUTPUT_FORMATS),
+              help='Output as JSON lines or CSV columns.')
+@click.option('--workers', default=4, help='Concurrent analyses.')
+@click.option('--checkpoint', type=click.Path(dir_okay=False), default=None,
+              help='Checkpoint database [OUTPUT.checkpoint].')
+def analyze_dir(directory, output, output_format, workers, checkpoint):
+    """Analyze all images in a directory tree, resuming if interrupted."""
+    from .core import REK, RESULTS
+    if checkpoint is None:
+        checkpoint = output + '.checkpoint'
+    done = bulk.Checkpoint(checkpoint)
+    print('Checkpoint "%s" has %d images.' % (checkpoint, len(done)),
+          file=sys.stderr)
+    writer = bulk.ResultWriter(output, output_format)
+    try:
+        counts = bulk.analyze_tree(
+            REK.with_priority('bulk'),
+            directory,
+            done,
+            writer,
+            workers=workers,
+            min_dimension=current_app.config['IMAGE_MIN_DIMENSION'],
+            max_dimension=current_app.config['IMAGE_MAX_DIMENSION'],
+            progress=bulk.Progress(),
+            log=lambda message: print('\nERROR--%s' % message,
+                                      file=sys.stderr),
+            store=RESULTS)
+    except KeyboardInterrupt:
+        print('\nInterrupted, rerun to resume.', file=sys.stderr)
+        sys.exit(130)
+    finally:
+        writer.close()
+        if RESULTS is not None:
+            RESULTS.flush()
+    if counts['errors']:
+        print('%d image(s) failed and will be retried on the next run.'
+              % counts['errors'], file=sys.stderr)
+        sys.exit(1)
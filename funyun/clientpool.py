@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""Spread Rekognition calls over several regions or endpoints.
+
+The pool keeps a moving window of call latencies for each endpoint and
+sends each call to the one that is currently fastest, occasionally
+trying another so that its numbers stay fresh.  With hedging on, if the
+chosen endpoint has not answered by the configured percentile of its
+recent latencies, the same call is sent to the next-fastest endpoint and
+whichever answers first wins.
+
+A call fails over to the next endpoint only if the first was throttled,
+timed out or failed on the server side; other errors would only recur.
+Calls that change state, such as index_faces, are never retried or
+hedged, since the first attempt may have taken effect.  Face collections
+and S3 buckets exist in one region, so calls naming either go to the
+home endpoint, the first one, alone.
+
+A pool stands in for a boto3 client: pool.detect_labels(**params) makes
+the call on the chosen endpoint.
+"""
+#
+# Standard library imports.
+#
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
+#
+# Third-party imports.
+#
+import boto3
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+#
+# Global defs.
+#
+LATENCY_WINDOW = 200
+EWMA_WEIGHT = 0.2
+ERROR_PENALTY = 2.0  # factor applied to latency score per recent error
+THROTTLING_CODES = frozenset(('ThrottlingException',
+                              'ProvisionedThroughputExceededException',
+                              'LimitExceededException',
+                              'RequestLimitExceeded',
+                              'ServiceUnavailableException',
+                              'InternalServerError'))
+NON_IDEMPOTENT = frozenset(('create_collection',
+                            'delete_collection',
+                            'index_faces',
+                            'delete_faces'))
+COLLECTION_OPERATIONS = NON_IDEMPOTENT | frozenset(('describe_collection',
+                                                    'list_collections',
+                                                    'list_faces',
+                                                    'search_faces',
+                                                    'search_faces_by_image'))
+
+
+def retryable(exc):
+    """Return True if another endpoint might succeed where exc failed."""
+    if isinstance(exc, (BotoConnectionError, HTTPClientError)):
+        return True  # includes connect and read timeouts
+    if isinstance(exc, ClientError):
+        return (exc.response.get('Error', {}).get('Code')
+                in THROTTLING_CODES or
+                exc.response.get('ResponseMetadata', {})
+                .get('HTTPStatusCode', 0) >= 500)
+    return False
+
+
+def home_only(operation, params):
+    """Return True if a call must go to the home endpoint."""
+    return operation in COLLECTION_OPERATIONS or \
+        'S3Object' in params.get('Image', {})
+
+
+class Endpoint(object):
+    """A client together with its recent latency record."""
+
+    def __init__(self, name, client, window=LATENCY_WINDOW):
+        self.name = name
+        self.client = client
+        self.latencies = deque(maxlen=window)
+        self.ewma = None
+        self.recent_errors = 0
+        self.lock = threading.Lock()
+
+    def record(self, elapsed, ok):
+        with self.lock:
+            if ok:
+                self.latencies.append(elapsed)
+                if self.ewma is None:
+                    self.ewma = elapsed
+                else:
+                    self.ewma += EWMA_WEIGHT * (elapsed - self.ewma)
+                self.recent_errors = max(0, self.recent_errors - 1)
+            else:
+                self.recent_errors += 1
+
+    def score(self):
+        """Expected latency; untried endpoints score 0 so they get tried."""
+        if self.ewma is None:
+            return 0.
+        return self.ewma * ERROR_PENALTY ** self.recent_errors
+
+    def percentile(self, percent):
+        """Return a percentile of recent latencies, or None if no data."""
+        with self.lock:
+            if not self.latencies:
+                return None
+            ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100.))
+        return ordered[index]
+
+
+class ClientPool(object):
+    """Route calls to the fastest of several Rekognition clients."""
+
+    def __init__(self,
+                 endpoints,
+                 hedge=False,
+                 hedge_percentile=95,
+                 hedge_min_delay=0.05,
+                 explore=0.05,
+                 max_workers=16):
+        """Create a pool.
+
+        :param endpoints: list of (name, boto3 client) pairs.
+        :param hedge: send a duplicate call when the first is slow.
+        :param hedge_percentile: latency percentile after which to hedge.
+        :param hedge_min_delay: never hedge sooner than this (seconds).
+        :param explore: fraction of calls sent to a random other endpoint.
+        :param max_workers: threads available for hedged calls.
+        """
+        if not endpoints:
+            raise ValueError('ClientPool needs at least one endpoint')
+        self.endpoints = [Endpoint(name, client) for name, client in endpoints]
+        self.hedge = hedge and len(self.endpoints) > 1
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.explore = explore
+        self.hedges = 0
+        self.hedge_wins = 0
+        #
+        # Observers are called as observer(endpoint_name, operation,
+        # elapsed, ok) after every call to an endpoint.
+        #
+        self.observers = []
+        if self.hedge:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        else:
+            self.executor = None
+
+    @classmethod
+    def from_config(cls, regions, endpoint_urls=(), client_config=None,
+                    **kwargs):
+        """Create a pool with one client per region and per endpoint URL.
+
+        Endpoint URLs (for example, local stand-ins for testing) use
+        the first region for signing.  client_config is a botocore
+        Config for every client.
+        """
+        endpoints = [(region, boto3.client('rekognition', region,
+                                           config=client_config))
+                     for region in regions]
+        for url in endpoint_urls:
+            endpoints.append((url, boto3.client('rekognition',
+                                                region_name=regions[0],
+                                                endpoint_url=url,
+                                                config=client_config)))
+        return cls(endpoints, **kwargs)
+
+    @property
+    def home(self):
+        """The home endpoint's client, for calls that must go there."""
+        return self.endpoints[0].client
+
+    def ranked(self):
+        """Return endpoints ordered fastest-first, with some exploration."""
+        ranked = sorted(self.endpoints, key=Endpoint.score)
+        if len(ranked) > 1 and random.random() < self.explore:
+            other = random.randrange(1, len(ranked))
+            ranked[0], ranked[other] = ranked[other], ranked[0]
+        return ranked
+
+    def _timed_call(self, endpoint, operation, params):
+        start = time.perf_counter()
+        ok = False
+        try:
+            response = getattr(endpoint.client, operation)(**params)
+            ok = True
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            endpoint.record(elapsed, ok)
+            for observer in self.observers:
+                observer(endpoint.name, operation, elapsed, ok)
+
+    def call(self, operation, **params):
+        """Make a call on the best endpoint, hedging if configured."""
+        if home_only(operation, params):
+            return self._timed_call(self.endpoints[0], operation, params)
+        ranked = self.ranked()
+        primary = ranked[0]
+        if not self.hedge or operation in NON_IDEMPOTENT:
+            try:
+                return self._timed_call(primary, operation, params)
+            except Exception as exc:
+                if len(ranked) == 1 or operation in NON_IDEMPOTENT or \
+                        not retryable(exc):
+                    raise
+            return self._timed_call(ranked[1], operation, params)
+        delay = primary.percentile(self.hedge_percentile)
+        if delay is None or delay < self.hedge_min_delay:
+            delay = self.hedge_min_delay
+        first = self.executor.submit(self._timed_call, primary, operation,
+                                     params)
+        done, pending = wait([first], timeout=delay)
+        if done and (first.exception() is None or
+                     not retryable(first.exception())):
+            return first.result()
+        self.hedges += 1
+        second = self.executor.submit(self._timed_call, ranked[1],
+                                      operation, params)
+        pending = {first, second} - done
+        error = first.exception() if done else None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self.hedge_wins += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def __getattr__(self, operation):
+        if operation.startswith('_'):
+            raise AttributeError(operation)
+        return partial(self.call, operation)
+
+    def stats(self):
+        """Return a list of per-endpoint latency summaries."""
+        return [{'endpoint': endpoint.name,
+                 'ewma': endpoint.ewma,
+                 'p50': endpoint.percentile(50),
+                 'p95': endpoint.percentile(95),
+                 'recent_errors': endpoint.recent_errors}
+                for endpoint in self.endpoints]
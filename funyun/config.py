@@ -114,6 +114,44 @@ class BaseConfig(object):
     LOGFILE_MAXBYTES = 10000000
     LOGFILE_BACKUPCOUNT = 1
     #
+    # Write log file records as JSON lines, from a background thread
+    # fed by a queue so that logging calls don't block on file I/O.
+    #
+    LOGFILE_JSON = True
+    LOGFILE_QUEUE = True
+    #
+    # Maximum time a /log.txt?follow=1 request keeps streaming; it holds
+    # one of a worker's GUNICORN_THREADS meanwhile.
+    #
+    LOG_FOLLOW_SECONDS = 300
+    #
+    # Collect metrics, served in Prometheus format at /metrics.  Each
+    # process writes its metrics to TMP/metrics at most this often.
+    #
+    METRICS = True
+    METRICS_FLUSH_SECONDS = 5
+    #
+    # Per-request profiling.  When PROFILE is True, requests carrying
+    # the PROFILE_HEADER header, plus a random PROFILE_SAMPLE_RATE
+    # fraction of all requests, are sampled every PROFILE_INTERVAL
+    # seconds.  The newest PROFILE_KEEP profiles are kept in LOG/profiles.
+    #
+    PROFILE = False
+    PROFILE_HEADER = 'X-Funyun-Profile'
+    PROFILE_SAMPLE_RATE = 0.0
+    PROFILE_INTERVAL = 0.001
+    PROFILE_KEEP = 100
+    #
+    # Per-request memory tracing.  When MEMORY_TRACE_REQUESTS is True,
+    # tracemalloc is started in each worker and requests that leave
+    # more than MEMORY_DELTA_THRESHOLD bytes allocated are logged.
+    # Traced memory is process-wide, so requests are logged only when
+    # GUNICORN_THREADS is 1.
+    #
+    MEMORY_TRACE_REQUESTS = False
+    MEMORY_TRACE_FRAMES = 1
+    MEMORY_DELTA_THRESHOLD = 1024 * 1024
+    #
     # Log only errors.
     #
     QUIET = False
@@ -170,10 +208,17 @@ class BaseConfig(object):
         DISTRIBUTION = None
     NGINX_UNIX_SOCKET = False
     #
-    # gunicorn defs--these will not be used in debugging mode.
+    # gunicorn defs--these will not be used in debugging mode.  Workers
+    # serve requests on GUNICORN_THREADS threads each, so long-lived
+    # streams (/funyun/live, /log.txt?follow=1) hold a thread, not the
+    # worker, and are not killed after GUNICORN_TIMEOUT seconds; that
+    # timeout applies only to a worker that stops responding.
     #
     GUNICORN_LOG_LEVEL = 'debug'
     GUNICORN_UNIX_SOCKET = True
+    GUNICORN_WORKER_CLASS = 'gthread'
+    GUNICORN_THREADS = 16
+    GUNICORN_TIMEOUT = 30
     #
     # URL defs--these will be used in testing.
     #
@@ -209,14 +254,208 @@ class BaseConfig(object):
     STDERR_LOG_FORMAT = '%(levelname)s: %(message)s'
     FILE_LOG_FORMAT = '%(levelname)s: %(message)s'
     #
-    # Dropzone defs.
+    # Rekognition calls.  REKOGNITION_MODE may be:
+    #    live:   call AWS.
+    #    record: call AWS, saving responses in DATA/REKOGNITION_CASSETTE.
+    #    replay: serve saved responses.  A call with no saved response
+    #            raises an error if REKOGNITION_REPLAY_MISS is 'error',
+    #            or is made (and recorded) live if it is 'live'.
+    #
+    REKOGNITION_MODE = 'live'
+    REKOGNITION_CASSETTE = 'rekognition_cassette.sqlite'
+    REKOGNITION_REPLAY_MISS = 'error'
+    #
+    # Rekognition endpoints.  Calls go to whichever of the regions and
+    # endpoint URLs (e.g., local stand-ins) is currently fastest.  With
+    # REKOGNITION_HEDGE, a call not answered within the
+    # REKOGNITION_HEDGE_PERCENTILE of recent latencies (but no sooner
+    # than REKOGNITION_HEDGE_MIN_DELAY seconds) is also sent to the
+    # next-fastest endpoint.  Face collection calls, and calls reading
+    # images from S3, always go to the first of REKOGNITION_REGIONS.
+    #
+    REKOGNITION_REGIONS = ['us-west-2']
+    REKOGNITION_ENDPOINT_URLS = []
+    REKOGNITION_HEDGE = False
+    REKOGNITION_HEDGE_PERCENTILE = 95
+    REKOGNITION_HEDGE_MIN_DELAY = 0.05
+    #
+    # Passing images by S3 reference.  If REKOGNITION_S3_BUCKET is set,
+    # images of at least REKOGNITION_S3_MIN_BYTES are uploaded once,
+    # named by digest under REKOGNITION_S3_PREFIX, and Rekognition reads
+    # them from there.  A lifecycle rule deletes them after
+    # REKOGNITION_S3_EXPIRE_DAYS.  The bucket must be in the first of
+    # REKOGNITION_REGIONS.  S3_ENDPOINT_URL points at an S3-compatible
+    # stand-in for testing.
+    #
+    REKOGNITION_S3_BUCKET = None
+    REKOGNITION_S3_PREFIX = 'funyun/images/'
+    REKOGNITION_S3_EXPIRE_DAYS = 1
+    REKOGNITION_S3_MIN_BYTES = 256*1024
+    S3_ENDPOINT_URL = None
+    #
+    # Coalescing of identical analyses.  Concurrent requests for the
+    # same image share one set of Rekognition calls within a worker and,
+    # if SINGLE_FLIGHT_SHARED, across workers via lock and result files
+    # in TMP/singleflight.  Results are reused for SINGLE_FLIGHT_TTL
+    # seconds; a worker waits at most SINGLE_FLIGHT_LEASE seconds for
+    # another to finish.  Analyses and lookups that requests with a
+    # deadline, or streamed pages, wait on run on FLIGHT_THREADS
+    # threads, so the requests can stop waiting while the work goes on.
+    #
+    SINGLE_FLIGHT_SHARED = True
+    SINGLE_FLIGHT_TTL = 30
+    SINGLE_FLIGHT_LEASE = 30
+    FLIGHT_THREADS = 8
+    #
+    # Results store.  Analyses are kept in DATA/RESULTS_DB, indexed by
+    # label, celebrity and capture time, and reused for images seen
+    # before.  Writes are batched, up to RESULTS_BATCH_SIZE at a time
+    # and at most RESULTS_FLUSH_SECONDS after the analysis.
+    #
+    RESULTS_STORE = True
+    RESULTS_DB = 'results.sqlite'
+    RESULTS_BATCH_SIZE = 100
+    RESULTS_FLUSH_SECONDS = 1.0
+    #
+    # Label search over stored results.  The in-memory index loads new
+    # results at most every SEARCH_REFRESH_SECONDS.
+    #
+    SEARCH_REFRESH_SECONDS = 5.0
+    SEARCH_MAX_RESULTS = 1000
+    #
+    # Face collection.  If FACE_COLLECTION names a Rekognition collection,
+    # faces can be indexed by person and recognized.  Up to
+    # FACE_INDEX_BATCH faces are indexed per call; matches need
+    # FACE_MATCH_THRESHOLD percent similarity and are cached in
+    # DATA/FACES_DB for FACE_MATCH_TTL seconds.
+    #
+    FACE_COLLECTION = None
+    FACE_INDEX_BATCH = 16
+    FACE_MATCH_THRESHOLD = 90.0
+    FACE_MATCH_TTL = 3600
+    FACES_DB = 'faces.sqlite'
+    #
+    # Limits on uploaded image dimensions, in pixels.  Rekognition
+    # needs at least 80 pixels in each dimension.
+    #
+    IMAGE_MIN_DIMENSION = 80
+    IMAGE_MAX_DIMENSION = 10000
+    #
+    # Shared result cache.  Analyses are also kept in TMP/results.cache,
+    # a memory-mapped file shared by all workers on the host, in
+    # SHARED_CACHE_SLOTS slots of SHARED_CACHE_SLOT_SIZE bytes (32 MB by
+    # default).  Least recently used results are evicted; compressed
+    # results too big for a slot are not cached.
+    #
+    SHARED_CACHE = True
+    SHARED_CACHE_SLOTS = 4096
+    SHARED_CACHE_SLOT_SIZE = 8192
+    #
+    # Streaming.  With ANALYZE_STREAM, the analyze page is sent at once
+    # and filled in as results arrive.  Streamed analyses run their
+    # Rekognition calls concurrently on ANALYSIS_THREADS threads.
+    #
+    ANALYZE_STREAM = True
+    ANALYSIS_THREADS = 16
+    #
+    # With EAGER_ANALYSIS, an image uploaded through the Dropzone form
+    # is analyzed in the background at once, so the analysis is under
+    # way, or done, by the time the analyze page asks for it.  These
+    # analyses run on their own EAGER_THREADS threads, so a burst of
+    # uploads never holds up the ANALYSIS_THREADS of pages being viewed.
+    #
+    EAGER_ANALYSIS = True
+    EAGER_THREADS = 2
+    #
+    # Page caching.  Rendered analyze pages are kept in TMP/pages, up to
+    # PAGE_CACHE_ENTRIES of them, keyed by image, template and version.
+    # Compiled templates are kept in TMP/jinja.
+    #
+    PAGE_CACHE = True
+    PAGE_CACHE_ENTRIES = 1000
+    TEMPLATE_BYTECODE_CACHE = True
+    #
+    # HTTP caching.  Analyses are served at URLs named by image digest
+    # with strong ETags, cacheable by browsers, nginx and CDNs for
+    # HTTP_MAX_AGE seconds.  The last UPLOAD_STORE_ENTRIES uploaded
+    # images are kept in TMP/uploads to back those URLs.
+    #
+    HTTP_MAX_AGE = 86400
+    UPLOAD_STORE_ENTRIES = 1000
+    #
+    # Latency budgets.  A request's budget is taken from its
+    # X-Request-Timeout header (seconds), else REQUEST_TIMEOUT (None for
+    # no limit), and is at most REQUEST_TIMEOUT_MAX.  Parts of an
+    # analysis not done in time are reported missing.  Each AWS call
+    # times out after REKOGNITION_TIMEOUT seconds regardless.
+    #
+    REQUEST_TIMEOUT = None
+    REQUEST_TIMEOUT_MAX = 60.0
+    REKOGNITION_TIMEOUT = 10.0
+    #
+    # Scheduling of Rekognition calls.  At most REKOGNITION_SLOTS calls
+    # are in flight at once across all workers (0 for no limit).  Calls
+    # for pages are 'interactive', for other requests 'api', and from
+    # analyze-dir 'bulk'.  Contended slots are shared by PRIORITY_WEIGHTS,
+    # and each class uses at most PRIORITY_CAPS slots.
+    #
+    REKOGNITION_SLOTS = 16
+    PRIORITY_WEIGHTS = {'interactive': 8, 'api': 4, 'bulk': 1}
+    PRIORITY_CAPS = {'interactive': 16, 'api': 12, 'bulk': 6}
+    #
+    # Video and animated GIF analysis.  Frames are sampled at VIDEO_FPS
+    # from the first VIDEO_MAX_SECONDS; a frame whose difference hash is
+    # within VIDEO_DEDUP_DISTANCE bits of the last kept frame is skipped.
+    # VIDEO_WORKERS keyframes are analyzed at once.  Formats other than
+    # GIF are decoded by FFMPEG.
+    #
+    VIDEO_FPS = 1.0
+    VIDEO_DEDUP_DISTANCE = 6
+    VIDEO_WORKERS = 4
+    VIDEO_MAX_SECONDS = 60
+    VIDEO_MAX_BYTES = 100*1024*1024
+    FFMPEG = 'ffmpeg'
+    #
+    # Live camera streams, sent to /funyun/live.  Each worker takes at
+    # most LIVE_MAX_STREAMS at once, each holding one of its
+    # GUNICORN_THREADS, so keep it well below that.  A stream has at
+    # most LIVE_IN_FLIGHT frames analyzed at once and LIVE_MAX_FPS per
+    # second, and all streams of a worker together start at most
+    # LIVE_RATE analyses per second; other frames are dropped, as are
+    # frames within LIVE_DEDUP_DISTANCE bits of the last analyzed.
+    # Streams end after LIVE_MAX_SECONDS.
+    #
+    LIVE_MAX_STREAMS = 4
+    LIVE_IN_FLIGHT = 1
+    LIVE_MAX_FPS = 2.0
+    LIVE_RATE = 4.0
+    LIVE_DEDUP_DISTANCE = 6
+    LIVE_MAX_SECONDS = 600
+    #
+    # Uploads.  Files larger than UPLOAD_CHUNK_SIZE bytes are sent in
+    # chunks, assembled in TMP/chunks; an upload can be resumed within
+    # UPLOAD_CHUNK_TTL seconds of its last chunk.  Up to
+    # UPLOAD_PARALLEL_FILES files are sent at once.  Images larger than
+    # DOWNSCALE_MAX_DIMENSION pixels or Rekognition's byte limit are
+    # scaled down if Pillow is installed (None to never scale).
+    #
+    UPLOAD_CHUNK_SIZE = 1024*1024
+    UPLOAD_CHUNK_TTL = 3600
+    UPLOAD_MAX_BYTES = 50*1024*1024
+    UPLOAD_PARALLEL_FILES = 3
+    DOWNSCALE_MAX_DIMENSION = 4096
+    #
+    # Dropzone defs.  With several files, each is linked to its
+    # analysis as it finishes; a single file is shown at once.  The
+    # file size limit, in MB, is raised to UPLOAD_MAX_BYTES when
+    # images can be scaled down.
     #
     DROPZONE_ALLOWED_FILE_TYPE = 'image'
     DROPZONE_MAX_FILE_SIZE = 5
     DROPZONE_INPUT_NAME = 'image'
-    DROPZONE_MAX_FILES = 1
+    DROPZONE_MAX_FILES = 10
     DROPZONE_DEFAULT_MESSAGE = 'Click here to upload or take a pic'
-    DROPZONE_REDIRECT_VIEW = 'analyze'
+    DROPZONE_REDIRECT_VIEW = None
 
 
 class DevelopmentConfig(BaseConfig):
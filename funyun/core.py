@@ -4,33 +4,190 @@
 #
 # standard library imports
 #
+import copy
 import json
-from io import StringIO
+import os
+import socket
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from pathlib import Path  # python 3.4
 #
 # third-party imports
 #
-from flask import Response, request, abort, render_template
+from flask import Response, request, abort, redirect, render_template
 import arrow
 import requests
+from botocore.exceptions import ClientError
 #
 # local imports
 #
 from . import app
-from .rekognizer import Rekognize
+from .analysis import SECTIONS, analysis_key, analyze_image, \
+    enrich_celebrity, format_text, format_text_section, iter_analysis, \
+    partial_result
+from .cassette import Cassette, CassetteMissError, image_digest
+from .chunks import ChunkError, ChunkedUploads
+from .clientpool import ClientPool
+from .deadline import Deadline
+from .faces import FaceCache, FaceCollection
+from .imagecheck import ImageValidationError, sniff_format, validate_image
+from .labelindex import LabelIndex, QuerySyntaxError
+from .live import LiveSession, RateLimiter, iter_jpeg_stream, label_changes
+from .metrics import METRICS, cache_lookup, observe_endpoint, \
+    observe_live_frame, observe_rekognition, observe_schedule
+from .pagecache import PageCache, TemplateVersions
+from .preprocess import can_downscale, downscale
+from .rekognizer import Rekognize, client_config
+from .results import ResultsStore, exif_info
+from .s3store import ImageStore
+from .scheduler import Scheduler
+from .shmcache import SharedCache
+from .singleflight import SingleFlight
+from .uploads import UploadStore
+from .video import VIDEO_EXTENSIONS, VideoError, analyze_video
 #
 # Global defs.
 #
 JSON_MIMETYPE = 'application/json'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+SSE_MIMETYPE = 'text/event-stream'
+STREAM_HEADERS = {'Cache-Control': 'no-cache',
+                  'X-Accel-Buffering': 'no'} # tell nginx not to buffer
 TEXT_MIMETYPE = 'text/plain'
-JPEG_MIMETYPE = 'image/jpeg'
-PNG_MIMETYPE = 'image/png'
-REK = Rekognize() # Amazon Rekognition client
-JPEG_EXTENSIONS = ['jpg', 'jpeg']
-PNG_EXTENSIONS = ['png']
+DEADLINE_HEADER = 'X-Request-Timeout' # budget in seconds
+if app.config['REKOGNITION_MODE'] == 'live':
+    CASSETTE = None
+else:
+    CASSETTE = Cassette(Path(app.config['DATA']) /
+                        app.config['REKOGNITION_CASSETTE'])
+if app.config['REKOGNITION_S3_BUCKET']:
+    IMAGE_STORE = ImageStore(app.config['REKOGNITION_S3_BUCKET'],
+                             prefix=app.config['REKOGNITION_S3_PREFIX'],
+                             expire_days=app.config[
+                                 'REKOGNITION_S3_EXPIRE_DAYS'],
+                             region=app.config['REKOGNITION_REGIONS'][0],
+                             endpoint_url=app.config['S3_ENDPOINT_URL'])
+    try:
+        IMAGE_STORE.ensure_lifecycle()
+    except ClientError as exc:
+        app.logger.warning('Unable to set expiration on bucket %s: %s',
+                           IMAGE_STORE.bucket, exc)
+    MAX_IMAGE_BYTES = 15*1024*1024 # Rekognition limit for S3 images
+else:
+    IMAGE_STORE = None
+    MAX_IMAGE_BYTES = 5*1024*1024 # Rekognition limit for inline images
+if app.config['DOWNSCALE_MAX_DIMENSION'] and can_downscale():
+    app.config['DROPZONE_MAX_FILE_SIZE'] = max(
+        app.config['DROPZONE_MAX_FILE_SIZE'],
+        app.config['UPLOAD_MAX_BYTES'] // (1024*1024))
+if app.config['REKOGNITION_SLOTS']:
+    SCHEDULER = Scheduler(Path(app.config['TMP']) / 'scheduler',
+                          slots=app.config['REKOGNITION_SLOTS'],
+                          weights=app.config['PRIORITY_WEIGHTS'],
+                          caps=app.config['PRIORITY_CAPS'])
+    SCHEDULER.observers.append(observe_schedule)
+else:
+    SCHEDULER = None
+REK = Rekognize(region=app.config['REKOGNITION_REGIONS'][0],
+                mode=app.config['REKOGNITION_MODE'],
+                cassette=CASSETTE,
+                replay_miss=app.config['REKOGNITION_REPLAY_MISS'],
+                image_store=IMAGE_STORE,
+                s3_min_bytes=app.config['REKOGNITION_S3_MIN_BYTES'],
+                timeout=app.config['REKOGNITION_TIMEOUT'],
+                scheduler=SCHEDULER,
+                priority='api')
+REK.observers.append(observe_rekognition)
+if len(app.config['REKOGNITION_REGIONS']) > 1 or \
+        app.config['REKOGNITION_ENDPOINT_URLS']:
+    REK.client = ClientPool.from_config(
+        app.config['REKOGNITION_REGIONS'],
+        app.config['REKOGNITION_ENDPOINT_URLS'],
+        client_config=client_config(app.config['REKOGNITION_TIMEOUT']),
+        hedge=app.config['REKOGNITION_HEDGE'],
+        hedge_percentile=app.config['REKOGNITION_HEDGE_PERCENTILE'],
+        hedge_min_delay=app.config['REKOGNITION_HEDGE_MIN_DELAY'])
+    REK.client.observers.append(observe_endpoint)
+HTTP = requests.Session() # connection-pooling client for enrichment lookups
+if app.config['SINGLE_FLIGHT_SHARED']:
+    SINGLE_FLIGHT_DIR = Path(app.config['TMP']) / 'singleflight'
+else:
+    SINGLE_FLIGHT_DIR = None
+SINGLE_FLIGHT = SingleFlight(SINGLE_FLIGHT_DIR,
+                             result_ttl=app.config['SINGLE_FLIGHT_TTL'],
+                             lease=app.config['SINGLE_FLIGHT_LEASE'])
+if app.config['RESULTS_STORE']:
+    RESULTS = ResultsStore(
+        Path(app.config['DATA']) / app.config['RESULTS_DB'],
+        batch_size=app.config['RESULTS_BATCH_SIZE'],
+        flush_interval=app.config['RESULTS_FLUSH_SECONDS'])
+    LABEL_INDEX = LabelIndex(
+        RESULTS,
+        refresh_interval=app.config['SEARCH_REFRESH_SECONDS'])
+else:
+    RESULTS = None
+    LABEL_INDEX = None
+if app.config['FACE_COLLECTION']:
+    #
+    # The collection lives in the home region and indexing changes it,
+    # so face calls bypass the endpoint pool.
+    #
+    FACES_REK = REK
+    if isinstance(REK.client, ClientPool):
+        FACES_REK = copy.copy(REK)
+        FACES_REK.client = REK.client.home
+    FACES = FaceCollection(
+        FACES_REK,
+        app.config['FACE_COLLECTION'],
+        FaceCache(Path(app.config['DATA']) / app.config['FACES_DB']),
+        threshold=app.config['FACE_MATCH_THRESHOLD'],
+        batch_size=app.config['FACE_INDEX_BATCH'],
+        match_ttl=app.config['FACE_MATCH_TTL'])
+else:
+    FACES = None
+TEMPLATES = TemplateVersions(app.jinja_env, app.config['VERSION'])
+if app.config['PAGE_CACHE']:
+    PAGES = PageCache(Path(app.config['TMP']) / 'pages',
+                      TEMPLATES,
+                      max_entries=app.config['PAGE_CACHE_ENTRIES'])
+else:
+    PAGES = None
+if app.config['SHARED_CACHE']:
+    SHARED = SharedCache(Path(app.config['TMP']) / 'results.cache',
+                         slots=app.config['SHARED_CACHE_SLOTS'],
+                         slot_size=app.config['SHARED_CACHE_SLOT_SIZE'])
+else:
+    SHARED = None
+UPLOADS = UploadStore(Path(app.config['TMP']) / 'uploads',
+                      max_entries=app.config['UPLOAD_STORE_ENTRIES'])
+CHUNKS = ChunkedUploads(Path(app.config['TMP']) / 'chunks',
+                        max_bytes=app.config['UPLOAD_MAX_BYTES'],
+                        ttl=app.config['UPLOAD_CHUNK_TTL'])
+ANALYSIS_EXECUTOR = ThreadPoolExecutor(
+    max_workers=app.config['ANALYSIS_THREADS'])
+EAGER_EXECUTOR = ThreadPoolExecutor(max_workers=app.config['EAGER_THREADS'])
+FLIGHT_EXECUTOR = ThreadPoolExecutor(
+    max_workers=app.config['FLIGHT_THREADS'])
+PARTIAL = {}  # digest: sections of analyses in progress in this process
+PARTIAL_CHANGED = threading.Condition()
+PARTIAL_WAIT = 0.1  # seconds between checks on analyses in other workers
+LIVE_LIMITER = RateLimiter(app.config['LIVE_RATE'],
+                           burst=app.config['LIVE_MAX_STREAMS'])
+LIVE_STREAMS = threading.BoundedSemaphore(app.config['LIVE_MAX_STREAMS'])
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg'])
 NAME = None
 IMAGE = None
 #
+# Error handlers.
+#
+@app.errorhandler(CassetteMissError)
+def cassette_miss(exc):
+    app.logger.error('%s', exc)
+    return Response(str(exc), status=503, mimetype=TEXT_MIMETYPE)
+#
 # Routes (URLS) start here.
 #
 @app.route('/funyun/time')
@@ -69,7 +226,13 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_image(files):
+def get_image(files, form=None):
+    """Return (filename, image bytes) of an uploaded image.
+
+    If form has Dropzone's chunk fields, the upload is a chunk of a
+    larger one, and the image is None until its last chunk arrives.
+    Large originals are scaled down to fit Rekognition's limits.
+    """
     # If file wasn't uploaded, it's an error.
     if 'image' not in files:
         app.logger.info('No image uploaded in POST.')
@@ -82,30 +245,266 @@ def get_image(files):
     elif not allowed_file(file.filename):
         app.logger.error('Filename %s not allowed' % file.filename)
         abort(403)
-    return(file.filename, file.read())
+    data = file.read()
+    if form is not None and 'dzuuid' in form:
+        data = put_chunk(form, data)
+        if data is None:
+            return(file.filename, None)
+    METRICS.observe('funyun_upload_bytes', len(data))
+    try:
+        image_format, width, height = validate_image(
+            data,
+            min_dimension=app.config['IMAGE_MIN_DIMENSION'],
+            max_dimension=app.config['IMAGE_MAX_DIMENSION'])
+    except ImageValidationError as exc:
+        app.logger.error('Image %s rejected: %s' % (file.filename, exc))
+        abort(Response(str(exc), status=400, mimetype=TEXT_MIMETYPE))
+    if app.config['DOWNSCALE_MAX_DIMENSION']:
+        data = downscale(data, width, height,
+                         app.config['DOWNSCALE_MAX_DIMENSION'],
+                         MAX_IMAGE_BYTES)
+    return(file.filename, data)
+
+
+def put_chunk(form, data):
+    """Store a chunk of a Dropzone upload.
+
+    :return: the whole file if this was its last chunk, else None.
+    """
+    try:
+        return CHUNKS.put(form['dzuuid'],
+                          int(form['dzchunkindex']),
+                          int(form['dztotalchunkcount']),
+                          int(form['dztotalfilesize']),
+                          data)
+    except (KeyError, ValueError) as exc:  # ChunkError is a ValueError
+        app.logger.error('Chunk rejected: %s' % exc)
+        abort(Response(str(exc) if isinstance(exc, ChunkError)
+                       else 'Invalid chunk.',
+                       status=400, mimetype=TEXT_MIMETYPE))
+
+
+def check_image_size(image):
+    """Abort if an image is too large for Rekognition."""
+    if len(image) > MAX_IMAGE_BYTES:
+        app.logger.error('Image size is greater than %d MB (%d).'
+                         %(MAX_IMAGE_BYTES/1024/1024, len(image)))
+        abort(400)
+
+
+def cacheable(etag, build, immutable=False):
+    """Return a response that clients and proxies may cache.
+
+    The response is validated by a strong ETag; if the client already
+    has this version, 304 is returned without calling build.
+
+    :param etag: ETag, which must change whenever the content would.
+    :param build: callable returning the response or page.
+    :param immutable: True if the content at this URL never changes.
+    """
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = build()
+        if not isinstance(response, Response):
+            response = Response(response, mimetype='text/html')
+        elif response.headers.get('Cache-Control') == 'no-store':
+            return response  # partial, see get_analysis()
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=%d%s' % (
+        app.config['HTTP_MAX_AGE'], ', immutable' if immutable else '')
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def uncacheable(response):
+    """Mark a response that depends on more than its URL."""
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def request_deadline():
+    """Return the deadline for this request, or None if unlimited."""
+    return Deadline.parse(request.headers.get(DEADLINE_HEADER),
+                          default=app.config['REQUEST_TIMEOUT'],
+                          maximum=app.config['REQUEST_TIMEOUT_MAX'])
+
+
+def cached_result(digest):
+    """Return the stored analysis of an image, or None.
+
+    The shared memory cache is tried before the results store, and
+    filled from it.
+    """
+    key = analysis_key(digest)
+    if SHARED is not None:
+        value = SHARED.get(key)
+        cache_lookup('shared', value is not None)
+        if value is not None:
+            return json.loads(zlib.decompress(value).decode('UTF-8'))
+    if RESULTS is None:
+        return None
+    result = RESULTS.get(digest)
+    cache_lookup('results', result is not None)
+    if result is not None and SHARED is not None:
+        SHARED.put(key, zlib.compress(json.dumps(result).encode('UTF-8')))
+    return result
+
+
+def save_result(result, image):
+    """Store a complete analysis in the shared cache and results store."""
+    if SHARED is not None:
+        SHARED.put(analysis_key(result['digest']),
+                   zlib.compress(json.dumps(result).encode('UTF-8')))
+    if RESULTS is not None:
+        RESULTS.save(result, exif_info(image))
+
+
+def get_analysis(image, deadline=None, priority='api'):
+    """Analyze an image, sharing the work with identical requests in flight.
+
+    With a deadline, only the wait is bounded: the analysis runs to
+    completion, and is saved, whether or not it finishes in time.  If it
+    does not, the sections finished by then are returned, with the rest
+    listed in 'missing'.  Such a partial result must not be cached.
+
+    :param image: image bytes.
+    :param deadline: a deadline.Deadline, or None.
+    :param priority: scheduler priority class of the calls.
+    :return: dict of analysis results.
+    """
+    digest = image_digest(image)
+    result = cached_result(digest)
+    if result is not None:
+        return result
+    key = analysis_key(digest)
+    if deadline is None:
+        return SINGLE_FLIGHT.do(key,
+                                lambda: analyze_and_save(image, priority))
+    try:
+        return SINGLE_FLIGHT.do(
+            key, lambda: analyze_sections_and_save(image, priority),
+            timeout=deadline.remaining(), executor=FLIGHT_EXECUTOR)
+    except TimeoutError:
+        METRICS.inc('funyun_deadline_exceeded_total')
+        with PARTIAL_CHANGED:
+            sections = dict(PARTIAL.get(digest, {}))
+        return partial_result(digest, len(image), sections)
+
+
+def analyze_sections_and_save(image, priority='api'):
+    """Analyze an image with its calls run concurrently, and save it.
+
+    Sections are put in PARTIAL as they finish, for requests whose
+    deadline passes first.
+    """
+    digest = image_digest(image)
+    result = {'digest': digest, 'size': len(image)}
+    with PARTIAL_CHANGED:
+        PARTIAL[digest] = result
+    try:
+        for section, data in iter_analysis(REK.with_priority(priority),
+                                           image, ANALYSIS_EXECUTOR):
+            with PARTIAL_CHANGED:
+                result[section] = data
+                PARTIAL_CHANGED.notify_all()
+    finally:
+        with PARTIAL_CHANGED:
+            PARTIAL.pop(digest, None)
+            PARTIAL_CHANGED.notify_all()
+    save_result(result, image)
+    return result
+
+
+def analyze_and_save(image, priority='api'):
+    """Analyze an image, queueing the result for the results store."""
+    result = analyze_image(REK.with_priority(priority), image)
+    save_result(result, image)
+    return result
+
+
+def iter_sections(image, priority='api'):
+    """Analyze an image, yielding (section, data) as each call finishes.
+
+    The analysis is shared with identical ones in flight.  Sections of
+    one running in this worker are yielded as they finish; stored
+    results, and those of an analysis running in another worker or
+    without sections, are yielded all at once.
+    """
+    digest = image_digest(image)
+    result = cached_result(digest)
+    sent = set()
+    if result is None:
+        call = SINGLE_FLIGHT.start(
+            analysis_key(digest),
+            lambda: analyze_sections_and_save(image, priority),
+            FLIGHT_EXECUTOR)
+        while True:
+            finished = call.done()
+            with PARTIAL_CHANGED:
+                partial = PARTIAL.get(digest, {})
+                ready = [(section, partial[section])
+                         for section, unused in SECTIONS
+                         if section in partial and section not in sent]
+                if not ready and not finished:
+                    PARTIAL_CHANGED.wait(PARTIAL_WAIT)
+                    continue
+            for section, data in ready:
+                sent.add(section)
+                yield section, data
+            if finished:
+                break
+        result = call.wait()
+    for section, unused in SECTIONS:
+        if section not in sent:
+            yield section, result[section]
+
+
+def stream(chunks, mimetype, format_error):
+    """Return a streamed response, ending with an error message if the
+    analysis fails part way through."""
+    def generate():
+        try:
+            yield from chunks
+        except Exception as exc:
+            app.logger.exception('Streamed analysis failed')
+            yield format_error(exc)
+    return Response(generate(), mimetype=mimetype, headers=STREAM_HEADERS)
+
+
+def ndjson_line(data):
+    return json.dumps(data) + '\n'
+
+
+def sse_event(event, data):
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
 
 
 @app.route('/funyun/recognize_as_text', methods=['POST', 'GET'])
 def recognize_as_text():
     if request.method == 'POST':
         name, image = get_image(request.files)
-        if len(image) > 5*1024*1024:
-            app.logger.error('Image size is greater than 5 MB (%d).' %len(image))
-            abort(400)
-        celebrities = REK.recognize_celebrities(image)
-        labels = REK.detect_labels(image)
-        faces = REK.detect_faces(image)
+        check_image_size(image)
+        digest = UPLOADS.put(image)
+        if request.args.get('stream'):
+            # Sections are sent in the order the calls finish.
+            return stream((format_text_section(section, data)
+                           for section, data in iter_sections(image)),
+                          TEXT_MIMETYPE,
+                          lambda exc: 'error: %s\n' % exc)
+        result = get_analysis(image, request_deadline())
         app.logger.info('%s: %d b, %d labels %d faces %d celebs.' %(name,
                                                                     len(image),
-                                                                    len(labels),
-                                                                    len(faces),
-                                                                    len(celebrities)))
-
-        info = REK.all_info()
-        outstr = StringIO()
-        for key in info.keys():
-            outstr.write('%s:  %s\n' %(key,str(info[key])))
-        return Response(outstr.getvalue(), mimetype=TEXT_MIMETYPE)
+                                                                    len(result['labels']),
+                                                                    len(result['faces']),
+                                                                    len(result['celebrities'])))
+        response = Response(format_text(result), mimetype=TEXT_MIMETYPE)
+        if result.get('missing'):
+            return uncacheable(response)
+        # The same text, cacheable, for later requests.
+        response.headers['Content-Location'] = \
+            '/funyun/analysis/%s/text' % digest
+        return response
     elif request.method == 'GET':
         return Response('This is a GET', mimetype=TEXT_MIMETYPE)
     else:
@@ -119,69 +518,549 @@ def recognize():
     global NAME, IMAGE
     templateData = {'version': app.config['VERSION']}
     if request.method == 'POST':
-        NAME, IMAGE = get_image(request.files)
-        return Response('Upload completed', mimetype=TEXT_MIMETYPE)
+        name, image = get_image(request.files, request.form)
+        if image is None:
+            return Response('Chunk received', mimetype=TEXT_MIMETYPE)
+        NAME, IMAGE = name, image
+        digest = UPLOADS.put(IMAGE)
+        if app.config['EAGER_ANALYSIS'] and len(IMAGE) <= MAX_IMAGE_BYTES:
+            EAGER_EXECUTOR.submit(analyze_in_background, digest, IMAGE)
+        return Response(json.dumps({'digest': digest,
+                                    'url': '/funyun/analyze/%s' % digest}),
+                        mimetype=JSON_MIMETYPE)
     else:
         NAME = None
         IMAGE = None
+        templateData['chunk_size'] = app.config['UPLOAD_CHUNK_SIZE']
+        templateData['parallel_uploads'] = app.config['UPLOAD_PARALLEL_FILES']
         return render_template('recognize.html', **templateData)
 
 
+@app.route('/funyun/upload/<upload_id>')
+def upload_status(upload_id):
+    """Return the chunks of an upload received so far, for resuming.
+
+    :return: JSON data
+    """
+    try:
+        received = CHUNKS.received(upload_id)
+    except ChunkError:
+        abort(404)
+    return uncacheable(Response(json.dumps({'received': received}),
+                                mimetype=JSON_MIMETYPE))
+
+
+def analyze_in_background(digest, image):
+    """Analyze an upload and look up its celebrity before it is viewed.
+
+    The work goes through SINGLE_FLIGHT, so the analyze page, in this
+    worker or another, attaches to it rather than starting its own.
+    """
+    try:
+        if cached_result(digest) is not None:
+            return
+        result = get_analysis(image, priority='interactive')
+        if result['celebrities']:
+            get_celebrity_data(digest, result['celebrities'][0])
+    except Exception:
+        app.logger.exception('Background analysis of %s failed', digest)
+
+
 @app.route('/funyun/lastimage')
 def lastimage():
-    global NAME,IMAGE
     if IMAGE is None:
         abort(400)
-    ext = NAME.rsplit('.', 1)[1].lower()
-    if ext in JPEG_EXTENSIONS:
-        return Response(IMAGE, mimetype=JPEG_MIMETYPE)
-    elif ext in PNG_EXTENSIONS:
-        return Response(IMAGE, mimetype=PNG_MIMETYPE)
-    else:
+    image_format = sniff_format(IMAGE)  # a PNG may be re-encoded as JPEG
+    if image_format is None:
         abort(404)
+    return uncacheable(Response(IMAGE, mimetype='image/' + image_format))
 
 
-@app.route('/funyun/analyze')
-def analyze():
-    global IMAGE
-    templateData = {'version': app.config['VERSION']}
-    if IMAGE is None:
+@app.route('/funyun/image/<digest>')
+def image_by_digest(digest):
+    """Return an uploaded image by digest."""
+    if digest not in UPLOADS:
         abort(404)
-    if len(IMAGE) > 5*1024*1024:
-        app.logger.error('Image size is greater than 5 MB (%d).' %len(IMAGE))
-        abort(400)
-    celebrities = REK.recognize_celebrities(IMAGE)
-    labels = REK.detect_labels(IMAGE)
-    faces = REK.detect_faces(IMAGE)
+
+    def build():
+        image = UPLOADS.get(digest)
+        if image is None:
+            abort(404)
+        image_format = sniff_format(image) or 'jpeg'
+        return Response(image, mimetype='image/' + image_format)
+
+    return cacheable(digest, build, immutable=True)
+
+
+def image_url(digest):
+    return '/funyun/image/%s' % digest
+
+
+def analysis_by_digest(digest, deadline=None, priority='api'):
+    """Return the analysis of an image by digest.
+
+    An uploaded image not yet analyzed is analyzed now.
+    """
+    image = UPLOADS.get(digest)
+    if image is not None:
+        check_image_size(image)
+        return get_analysis(image, deadline, priority)
+    result = cached_result(digest)
+    if result is not None:
+        return result
+    abort(404)
+
+
+@app.route('/funyun/analysis/<digest>')
+def analysis_as_JSON(digest):
+    """Return the analysis of an uploaded image by digest.
+
+    :return: JSON data
+    """
+    deadline = request_deadline()
+
+    def build():
+        result = analysis_by_digest(digest, deadline)
+        response = Response(json.dumps(result), mimetype=JSON_MIMETYPE)
+        return uncacheable(response) if result.get('missing') else response
+
+    return cacheable(analysis_key(digest, view='json'), build)
+
+
+@app.route('/funyun/analysis/<digest>/text')
+def analysis_as_text(digest):
+    """Return the analysis of an uploaded image by digest.
+
+    :return: Text data
+    """
+    deadline = request_deadline()
+
+    def build():
+        result = analysis_by_digest(digest, deadline)
+        response = Response(format_text(result), mimetype=TEXT_MIMETYPE)
+        return uncacheable(response) if result.get('missing') else response
+
+    return cacheable(analysis_key(digest, view='text'), build)
+
+
+def get_celebrity_data(digest, celebrity, deadline=None):
+    """Look up links for a celebrity, adding our own notes.
+
+    :param digest: digest of the image the celebrity was found in.
+    :param celebrity: dict from analysis.celebrity_to_dict().
+    :param deadline: a deadline.Deadline, or None.
+    :return: dict of template data for the celebrity; 'missing' is
+             True if the lookups did not finish by the deadline.
+    """
+    #
+    # The lookup is shared, so it runs without this request's deadline;
+    # only the wait for it is bounded.
+    #
+    key = analysis_key(digest, enrich='celebrity')
+
+    def lookup():
+        return enrich_celebrity(dict(celebrity), HTTP)
+
+    if deadline is None:
+        celeb = SINGLE_FLIGHT.do(key, lookup)
+    else:
+        try:
+            celeb = SINGLE_FLIGHT.do(key, lookup,
+                                     timeout=deadline.remaining(),
+                                     executor=FLIGHT_EXECUTOR)
+        except TimeoutError:
+            app.logger.warning('Lookup of %s cut short by the deadline.',
+                               celebrity['name'])
+            celeb = dict(celebrity, missing=True)
+    app.logger.info('ID = %s', celeb['id'])
+    if celeb['id']  == '4y3xB8v':
+        celeb['desc'] = 'Popular Romanian singer'
+        celeb['localURL'] = '/static/Carmen_Serban.jpg'
+    elif celeb['id'] == '26o9uJ':
+        celeb['desc'] = 'TV mom (Wizards of Waverly Place)'
+        celeb['localURL'] = '/static/Maria_Canals-Barrera.jpg'
+    return celeb
+
+
+def get_analysis_data(image):
+    """Analyze an image and look up any celebrity found.
+
+    :param image: image bytes.
+    :return: dict of template data.
+    """
+    return analysis_template_data(get_analysis(image,
+                                               priority='interactive'))
+
+
+def analysis_template_data(result, deadline=None):
+    """Return template data for an analysis, looking up any celebrity.
+
+    'missing' lists the parts not finished by the deadline.
+    """
+    templateData = {'version': app.config['VERSION'],
+                    'image_url': image_url(result['digest']),
+                    'missing': list(result.get('missing', []))}
+    celebrities = result['celebrities']
+    faces = result['faces']
     app.logger.info('%d celebs, %d labels, %d faces' %(len(celebrities),
-                                                       len(labels),
+                                                       len(result['labels']),
                                                        len(faces)))
-    templateData['labels'] = labels
+    templateData['labels'] = result['labels']
     if len(celebrities) > 0:
-        celeb = celebrities[0]
-        wikiquery = r'https://google.com/search?q="'+\
-                    celeb.name + '"&as_sitesearch=wikipedia.org&btnI'
-        tophit = requests.get(wikiquery)
-        imagequery =  r'https://google.com/search?q="'+\
-                    celeb.name + r'"&safe=on&tbm=isch&btnI'
-        imghit = requests.get(imagequery)
-        templateData['celebrity'] = celeb.__dict__
-        if len(celeb.urls) > 0:
-            url = 'http://'+ celeb.urls[0]
-        else:
-            url = tophit.url
-        templateData['celebrity']['url'] = url
-        templateData['celebrity']['imageurl'] = imghit.url
-        app.logger.info('ID = %s', celeb.id)
-        if celeb.id  == '4y3xB8v':
-            templateData['celebrity']['desc'] = 'Popular Romanian singer'
-            templateData['celebrity']['localURL'] = '/static/Carmen_Serban.jpg'
-        elif celeb.id == '26o9uJ':
-            templateData['celebrity']['desc'] = 'TV mom (Wizards of Waverly Place)'
-            templateData['celebrity']['localURL'] = '/static/Maria_Canals-Barrera.jpg'
+        templateData['celebrity'] = get_celebrity_data(result['digest'],
+                                                       celebrities[0],
+                                                       deadline)
+        if templateData['celebrity'].get('missing'):
+            templateData['missing'].append('celebrity links')
     else:
         templateData['celebrity'] = None
     if len(faces) > 0:
         face = faces[0]
         templateData['face'] = face
-    return render_template('analyze.html', **templateData)
\ No newline at end of file
+    return templateData
+
+
+@app.route('/funyun/analyze')
+def analyze():
+    """Redirect to the analysis page of the last image uploaded."""
+    if IMAGE is None:
+        abort(404)
+    check_image_size(IMAGE)
+    digest = UPLOADS.put(IMAGE)
+    return uncacheable(redirect('/funyun/analyze/%s' % digest, code=303))
+
+
+@app.route('/funyun/analyze/<digest>')
+def analyze_by_digest(digest):
+    """Show the analysis of an uploaded image."""
+    deadline = request_deadline()
+    etag = page_etag(digest)
+    if etag not in request.if_none_match:
+        if PAGES is not None:
+            page = PAGES.get(digest, 'analyze.html')
+            cache_lookup('pages', page is not None)
+            if page is not None:
+                return cacheable(etag, lambda: page)
+        if app.config['ANALYZE_STREAM'] and digest in UPLOADS and \
+                cached_result(digest) is None:
+            # The page fills itself in from /funyun/analyze_stream.
+            return uncacheable(Response(render_template(
+                'analyze.html',
+                version=app.config['VERSION'],
+                image_url=image_url(digest),
+                stream_url='/funyun/analyze_stream/%s' % digest,
+                stream=True)))
+
+    def build():
+        templateData = analysis_template_data(
+            analysis_by_digest(digest, deadline, 'interactive'), deadline)
+        page = render_analyze_page(digest, templateData)
+        if templateData['missing']:
+            return uncacheable(Response(page))
+        return page
+
+    return cacheable(etag, build)
+
+
+def page_etag(digest):
+    return analysis_key(digest, view='page',
+                        template=TEMPLATES.fingerprint('analyze.html')[:16])
+
+
+def render_analyze_page(digest, templateData):
+    """Render the analyze page for an image, caching the result."""
+    page = render_template('analyze.html', **templateData)
+    if PAGES is not None and not templateData.get('missing'):
+        PAGES.put(digest, 'analyze.html', page)
+    return page
+
+
+@app.route('/funyun/analyze_stream/<digest>')
+def analyze_stream(digest):
+    """Stream analysis of an uploaded image as server-sent events.
+
+    Events are labels, face (the first face, or null) and celebrity
+    (the first celebrity with links, or null), each sent as soon as it
+    is known, then done.
+    """
+    image = UPLOADS.get(digest)
+    if image is None:
+        abort(404)
+    check_image_size(image)
+
+    def events():
+        templateData = {'version': app.config['VERSION'],
+                        'image_url': image_url(digest),
+                        'celebrity': None}
+        enrichment = None
+        for section, data in iter_sections(image, 'interactive'):
+            if section == 'labels':
+                templateData['labels'] = data
+                yield sse_event('labels', data)
+            elif section == 'faces':
+                if data:
+                    templateData['face'] = data[0]
+                yield sse_event('face', data[0] if data else None)
+            elif data:
+                enrichment = ANALYSIS_EXECUTOR.submit(get_celebrity_data,
+                                                      digest, data[0])
+            else:
+                yield sse_event('celebrity', None)
+        if enrichment is not None:
+            templateData['celebrity'] = enrichment.result()
+            yield sse_event('celebrity', templateData['celebrity'])
+        yield sse_event('done', None)
+        if PAGES is not None:
+            # Later views of this image get the whole page at once.
+            with app.app_context():
+                render_analyze_page(digest, templateData)
+
+    return stream(events(), SSE_MIMETYPE,
+                  lambda exc: sse_event('failed', str(exc)))
+
+
+@app.route('/funyun/recognize_as_ndjson', methods=['POST'])
+def recognize_as_ndjson():
+    """Analyze an uploaded image, streaming results as JSON lines.
+
+    Each line is an object with section ('celebrities', 'labels' or
+    'faces') and data, sent as soon as that call finishes; the last
+    line has section 'done', or 'error' and a message.
+    """
+    name, image = get_image(request.files)
+    check_image_size(image)
+    lines = (ndjson_line({'section': section, 'data': data})
+             for section, data in iter_sections(image))
+
+    def with_done():
+        yield from lines
+        yield ndjson_line({'section': 'done'})
+
+    return stream(with_done(), NDJSON_MIMETYPE,
+                  lambda exc: ndjson_line({'section': 'error',
+                                           'message': str(exc)}))
+
+
+@app.route('/funyun/live', methods=['POST'])
+def live():
+    """Analyze a live stream of camera frames, streaming results.
+
+    The request body is a stream of JPEG frames, such as MJPEG sent
+    with chunked encoding, for as long as the camera runs.  Each
+    response line is a JSON object with section 'frame', the frame
+    number, the labels added and removed since the last result, and
+    data (the analysis); the last line has section 'done' and counts of
+    frames analyzed, skipped as unchanged and dropped, or 'error' and a
+    message.  Frames that arrive while analysis is busy are dropped.
+    """
+    if not LIVE_STREAMS.acquire(blocking=False):
+        app.logger.warning('Live stream refused: too many streams.')
+        abort(503)
+    config = app.config
+    session = LiveSession(REK.with_priority('interactive'),
+                          ANALYSIS_EXECUTOR,
+                          LIVE_LIMITER,
+                          max_fps=config['LIVE_MAX_FPS'],
+                          max_in_flight=config['LIVE_IN_FLIGHT'],
+                          max_distance=config['LIVE_DEDUP_DISTANCE'],
+                          min_dimension=config['IMAGE_MIN_DIMENSION'],
+                          max_seconds=config['LIVE_MAX_SECONDS'])
+    session.observers.append(observe_live_frame)
+    threading.Thread(target=session.feed,
+                     args=(iter_jpeg_stream(request.stream,
+                                            MAX_IMAGE_BYTES),),
+                     daemon=True).start()
+
+    def lines():
+        labels = None
+        for number, result in session.results():
+            added, removed = label_changes(labels, result['labels'])
+            labels = result['labels']
+            yield ndjson_line({'section': 'frame', 'frame': number,
+                               'added': added, 'removed': removed,
+                               'data': result})
+        yield ndjson_line({'section': 'done', 'data': session.counts})
+
+    response = stream(lines(), NDJSON_MIMETYPE,
+                      lambda exc: ndjson_line({'section': 'error',
+                                               'message': str(exc)}))
+    client_socket = request.environ.get('gunicorn.socket')
+
+    def close():
+        LIVE_STREAMS.release()
+        if client_socket is not None:
+            #
+            # Results ended (max_seconds, error or disconnect); wake the
+            # reader if it is still waiting on a client that is silent.
+            #
+            try:
+                client_socket.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+
+    response.call_on_close(close)
+    return response
+
+
+def get_video(files):
+    """Save an uploaded video to a temporary file.
+
+    :return: (filename, path of temporary file).
+    """
+    if 'video' not in files:
+        app.logger.info('No video uploaded in POST.')
+        abort(400)
+    file = files['video']
+    if file.filename == '':
+        app.logger.error('No file selected.')
+        abort(400)
+    elif '.' not in file.filename or \
+            file.filename.rsplit('.', 1)[1].lower() not in VIDEO_EXTENSIONS:
+        app.logger.error('Filename %s not allowed' % file.filename)
+        abort(403)
+    fd, path = tempfile.mkstemp(prefix='video-', dir=app.config['TMP'])
+    with os.fdopen(fd, 'wb') as video_fh:
+        file.save(video_fh)
+    size = os.path.getsize(path)
+    METRICS.observe('funyun_upload_bytes', size)
+    if size > app.config['VIDEO_MAX_BYTES']:
+        os.unlink(path)
+        app.logger.error('Video size is greater than %d MB (%d).'
+                         %(app.config['VIDEO_MAX_BYTES']/1024/1024, size))
+        abort(400)
+    return(file.filename, path)
+
+
+@app.route('/funyun/analyze_video', methods=['POST'])
+def analyze_video_as_JSON():
+    """Analyze the keyframes of an uploaded video or animated GIF.
+
+    :return: JSON timeline of labels, faces and celebrities.
+    """
+    name, path = get_video(request.files)
+    try:
+        config = app.config
+        result = analyze_video(REK,
+                               path,
+                               fps=config['VIDEO_FPS'],
+                               max_distance=config['VIDEO_DEDUP_DISTANCE'],
+                               workers=config['VIDEO_WORKERS'],
+                               max_seconds=config['VIDEO_MAX_SECONDS'],
+                               min_dimension=config['IMAGE_MIN_DIMENSION'],
+                               ffmpeg=config['FFMPEG'])
+    except VideoError as exc:
+        app.logger.error('Video %s rejected: %s' % (name, exc))
+        abort(Response(str(exc), status=400, mimetype=TEXT_MIMETYPE))
+    finally:
+        os.unlink(path)
+    app.logger.info('%s: %d frames, %d keyframes, %d labels.'
+                    %(name, result['frames'], result['keyframes'],
+                      len(result['labels'])))
+    return Response(json.dumps(result), mimetype=JSON_MIMETYPE)
+
+
+@app.route('/funyun/results/<digest>')
+def stored_result(digest):
+    """Return the stored analysis of an image by digest.
+
+    :return: JSON data
+    """
+    if RESULTS is None:
+        abort(404)
+    record = RESULTS.record(digest)
+    result = RESULTS.get(digest)
+    if record is None or result is None:
+        abort(404)
+    record['result'] = result
+    return Response(json.dumps(record), mimetype=JSON_MIMETYPE)
+
+
+@app.route('/funyun/search')
+def search():
+    """Search analyzed images by label.
+
+    Query parameters are q, a query such as 'Dog AND Beach NOT Cat',
+    min_confidence and k, the number of results.
+
+    :return: JSON data
+    """
+    if LABEL_INDEX is None:
+        abort(404)
+    query = request.args.get('q', '')
+    try:
+        min_confidence = float(request.args.get('min_confidence', 0))
+        k = min(int(request.args.get('k', 20)),
+                app.config['SEARCH_MAX_RESULTS'])
+    except ValueError:
+        abort(400)
+    if k < 1:
+        abort(400)
+    start = perf_counter()
+    try:
+        total, results = LABEL_INDEX.search(query,
+                                            min_confidence=min_confidence,
+                                            k=k)
+    except QuerySyntaxError as exc:
+        abort(Response(str(exc), status=400, mimetype=TEXT_MIMETYPE))
+    json_data = {'query': query,
+                 'min_confidence': min_confidence,
+                 'total': total,
+                 'elapsed_ms': (perf_counter() - start) * 1000.,
+                 'results': [{'digest': digest, 'score': score}
+                             for digest, score in results]}
+    return Response(json.dumps(json_data), mimetype=JSON_MIMETYPE)
+
+
+def face_boxes(image):
+    """Return the bounding boxes of the faces in an image."""
+    return [face['box'] for face in get_analysis(image)['faces']]
+
+
+@app.route('/funyun/faces/index', methods=['POST'])
+def index_faces():
+    """Add the faces in uploaded images to the face collection.
+
+    Form fields are person, the name to index the faces under, and
+    optionally metadata, a JSON object kept with them.  Several images
+    may be uploaded at once and are indexed together.
+
+    :return: JSON data
+    """
+    if FACES is None:
+        abort(404)
+    person = request.form.get('person', '')
+    if not person:
+        abort(Response('No person given.', status=400,
+                       mimetype=TEXT_MIMETYPE))
+    try:
+        metadata = json.loads(request.form.get('metadata', 'null'))
+    except ValueError:
+        abort(Response('Metadata is not valid JSON.', status=400,
+                       mimetype=TEXT_MIMETYPE))
+    queued = skipped = 0
+    for file in request.files.getlist('image'):
+        name, image = get_image({'image': file})
+        counts = FACES.index(image, face_boxes(image), person, metadata)
+        queued += counts[0]
+        skipped += counts[1]
+    indexed = FACES.flush()
+    app.logger.info('Indexed %d faces of %s, %d already indexed.'
+                    %(len(indexed), person, skipped))
+    json_data = {'person': person,
+                 'indexed': [face_id for face_id, unused in indexed],
+                 'not_indexed': queued - len(indexed),
+                 'already_indexed': skipped}
+    return Response(json.dumps(json_data), mimetype=JSON_MIMETYPE)
+
+
+@app.route('/funyun/faces/search', methods=['POST'])
+def search_faces():
+    """Identify the faces in an uploaded image.
+
+    :return: JSON data
+    """
+    if FACES is None:
+        abort(404)
+    name, image = get_image(request.files)
+    results = FACES.search(image, face_boxes(image))
+    return Response(json.dumps({'faces': results}), mimetype=JSON_MIMETYPE)
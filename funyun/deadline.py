@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Latency budgets for requests.
+
+A Deadline is made when a request arrives, from a header or the
+configured default, and handed to everything that waits on an
+external call.  Only the waiting is bounded: analyses and lookups
+shared with other requests run to completion, without any one
+request's deadline, and their results still go to the caches.
+"""
+#
+# Standard library imports.
+#
+import time
+
+
+class DeadlineExceeded(Exception):
+    """A deadline passed before the work was started."""
+
+
+class Deadline(object):
+    """A point in time by which a request must be answered."""
+
+    def __init__(self, seconds):
+        """Create a deadline.
+
+        :param seconds: budget, counted from now.
+        """
+        self.budget = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        """Return the seconds left, never less than zero."""
+        return max(0., self.expires - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def check(self):
+        """Raise DeadlineExceeded if the deadline has passed."""
+        if self.expired():
+            raise DeadlineExceeded('Deadline of %.3g s exceeded.'
+                                   % self.budget)
+
+    @classmethod
+    def parse(cls, value, default=None, maximum=None):
+        """Make a deadline from a header value in seconds.
+
+        :param value: header value, or None if absent.
+        :param default: budget when there is no valid header, or None.
+        :param maximum: largest budget allowed, or None.
+        :return: a Deadline, or None if there is no budget.
+        """
+        seconds = default
+        if value is not None:
+            try:
+                seconds = float(value)
+            except ValueError:
+                pass
+        if seconds is None or not seconds > 0:
+            return None
+        if maximum is not None:
+            seconds = min(seconds, maximum)
+        return cls(seconds)
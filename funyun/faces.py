@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""Recognize our own people with a Rekognition face collection.
+
+Faces are cropped locally from the boxes found by face detection.  A
+crop whose hash is already in the local cache is not indexed again.
+New crops are batched: up to a batch's worth are tiled into one mosaic
+image and indexed with a single index_faces call, and the returned
+faces are mapped back to their tiles.  The cache keeps, for each face
+ID, the person and metadata it was indexed with, and remembers recent
+search results by crop hash so a face seen again is recognized
+without a call.
+
+Pillow is an optional dependency (the 'faces' extra).
+"""
+#
+# Standard library imports.
+#
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+import time
+from io import BytesIO
+from pathlib import Path  # python 3.4
+#
+# Third-party imports.
+#
+try:
+    from PIL import Image
+except ImportError:  # optional, install the 'faces' extra
+    Image = None
+#
+# Global defs.
+#
+SCHEMA = ("""CREATE TABLE IF NOT EXISTS faces (
+                 face_id TEXT PRIMARY KEY,
+                 collection TEXT NOT NULL,
+                 crop_hash TEXT NOT NULL,
+                 person TEXT NOT NULL,
+                 metadata TEXT,
+                 indexed REAL NOT NULL)""",
+          'CREATE INDEX IF NOT EXISTS faces_crop_hash '
+          'ON faces (collection, crop_hash)',
+          """CREATE TABLE IF NOT EXISTS matches (
+                 collection TEXT NOT NULL,
+                 crop_hash TEXT NOT NULL,
+                 face_id TEXT,
+                 external_id TEXT,
+                 similarity REAL,
+                 searched REAL NOT NULL,
+                 PRIMARY KEY (collection, crop_hash))""")
+TILE_SIZE = 200  # pixels per face in a mosaic
+TILE_GAP = 40  # pixels between tiles, so faces are seen separately
+CROP_MARGIN = 0.2  # fraction of the box added on each side of a crop
+JPEG_QUALITY = 90
+
+
+def _require_pillow():
+    if Image is None:
+        raise RuntimeError('Face collections require Pillow '
+                           '(pip install funyun[faces]).')
+
+
+def _to_jpeg(image):
+    outfh = BytesIO()
+    image.convert('RGB').save(outfh, 'JPEG', quality=JPEG_QUALITY)
+    return outfh.getvalue()
+
+
+def crop_faces(img, boxes):
+    """Crop faces from an image.
+
+    :param img: image bytes.
+    :param boxes: Rekognition bounding boxes, as ratios of the image.
+    :return: list of (crop hash, Pillow image).
+    """
+    _require_pillow()
+    image = Image.open(BytesIO(img))
+    image.load()
+    width, height = image.size
+    crops = []
+    for box in boxes:
+        margin_x = box['Width'] * CROP_MARGIN
+        margin_y = box['Height'] * CROP_MARGIN
+        left = max(0, int((box['Left'] - margin_x) * width))
+        top = max(0, int((box['Top'] - margin_y) * height))
+        right = min(width,
+                    int((box['Left'] + box['Width'] + margin_x) * width))
+        bottom = min(height,
+                     int((box['Top'] + box['Height'] + margin_y) * height))
+        crop = image.crop((left, top, max(right, left + 1),
+                           max(bottom, top + 1))).convert('RGB')
+        crop_hash = hashlib.sha256(b'%dx%d:' % crop.size +
+                                   crop.tobytes()).hexdigest()
+        crops.append((crop_hash, crop))
+    return crops
+
+
+def mosaic(crops):
+    """Tile face crops into one image.
+
+    :param crops: list of Pillow images.
+    :return: (JPEG bytes, number of columns, mosaic width, height).
+    """
+    columns = int(math.ceil(math.sqrt(len(crops))))
+    rows = int(math.ceil(len(crops) / columns))
+    pitch = TILE_SIZE + TILE_GAP
+    width = columns * pitch + TILE_GAP
+    height = rows * pitch + TILE_GAP
+    canvas = Image.new('RGB', (width, height), (255, 255, 255))
+    for number, crop in enumerate(crops):
+        tile = crop.copy()
+        tile.thumbnail((TILE_SIZE, TILE_SIZE))
+        row, column = divmod(number, columns)
+        canvas.paste(tile, (TILE_GAP + column * pitch +
+                            (TILE_SIZE - tile.size[0]) // 2,
+                            TILE_GAP + row * pitch +
+                            (TILE_SIZE - tile.size[1]) // 2))
+    return _to_jpeg(canvas), columns, width, height
+
+
+def tile_of(box, columns, width, height):
+    """Return the mosaic tile number containing the center of a box."""
+    pitch = TILE_SIZE + TILE_GAP
+    x = (box['Left'] + box['Width'] / 2.) * width - TILE_GAP / 2.
+    y = (box['Top'] + box['Height'] / 2.) * height - TILE_GAP / 2.
+    return int(y // pitch) * columns + int(x // pitch)
+
+
+class FaceCache(object):
+    """SQLite cache of indexed faces and recent search results."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        if not self.path.parent.is_dir():
+            self.path.parent.mkdir(parents=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path),
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def is_indexed(self, collection, crop_hash):
+        """Return True if a crop has been indexed in a collection."""
+        with self.lock:
+            return self.connection.execute(
+                'SELECT 1 FROM faces WHERE collection = ? AND crop_hash = ?',
+                (collection, crop_hash)).fetchone() is not None
+
+    def add_faces(self, collection, faces):
+        """Record indexed faces.
+
+        :param faces: list of (face_id, crop_hash, person, metadata).
+        """
+        now = time.time()
+        rows = [(face_id, collection, crop_hash, person,
+                 json.dumps(metadata), now)
+                for face_id, crop_hash, person, metadata in faces]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO faces VALUES (?, ?, ?, ?, ?, ?)',
+                rows)
+            #
+            # Earlier searches may have missed these people.
+            #
+            self.connection.execute(
+                'DELETE FROM matches WHERE collection = ? AND '
+                'face_id IS NULL', (collection,))
+
+    def person(self, face_id):
+        """Return (person, metadata) for a face ID, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT person, metadata FROM faces WHERE face_id = ?',
+                (face_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def match(self, collection, crop_hash, max_age):
+        """Return a cached search result for a crop.
+
+        :return: None if not cached, else (face_id, external_id,
+                 similarity), where face_id is None if nothing matched.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT face_id, external_id, similarity FROM matches '
+                'WHERE collection = ? AND crop_hash = ? AND searched > ?',
+                (collection, crop_hash, time.time() - max_age)).fetchone()
+        return row
+
+    def put_match(self, collection, crop_hash, face_id, external_id,
+                  similarity):
+        """Cache a search result for a crop."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?)',
+                (collection, crop_hash, face_id, external_id, similarity,
+                 time.time()))
+
+
+class FaceCollection(object):
+    """A named Rekognition face collection with a local cache."""
+
+    def __init__(self,
+                 rek,
+                 collection_id,
+                 cache,
+                 threshold=90.,
+                 batch_size=16,
+                 match_ttl=3600.):
+        """Create a collection client.
+
+        :param rek: a Rekognize instance.
+        :param collection_id: name of the Rekognition collection.
+        :param cache: a FaceCache.
+        :param threshold: least similarity counted as a match (percent).
+        :param batch_size: most faces indexed in one call.
+        :param match_ttl: seconds a search result is reused.
+        """
+        self.rek = rek
+        self.collection_id = collection_id
+        self.cache = cache
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.match_ttl = match_ttl
+        self.lock = threading.Lock()
+        self.pending = []  # (crop_hash, person, metadata, crop)
+        self.created = False
+
+    def ensure(self):
+        """Create the collection on first use."""
+        if not self.created:
+            self.rek.create_collection(self.collection_id)
+            self.created = True
+
+    def index(self, img, boxes, person, metadata=None):
+        """Queue the faces in an image for indexing as a person.
+
+        A full batch is indexed at once; call flush() for the rest.
+
+        :param img: image bytes.
+        :param boxes: face bounding boxes from detect_faces.
+        :param person: name of the person.
+        :param metadata: JSON-serializable data kept with the faces.
+        :return: (number of faces queued, number already indexed).
+        """
+        queued = skipped = 0
+        full = False
+        for crop_hash, crop in crop_faces(img, boxes):
+            if self.cache.is_indexed(self.collection_id, crop_hash):
+                skipped += 1
+                continue
+            with self.lock:
+                if any(entry[0] == crop_hash for entry in self.pending):
+                    skipped += 1
+                    continue
+                self.pending.append((crop_hash, person, metadata, crop))
+                full = len(self.pending) >= self.batch_size
+            queued += 1
+            if full:
+                self.flush()
+        return queued, skipped
+
+    def flush(self):
+        """Index queued faces in batches, one call per batch.
+
+        :return: list of (face_id, person) for the faces indexed; faces
+                 Rekognition declines to index (too small, blurred) are
+                 left out and may be queued again later.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return []
+        self.ensure()
+        indexed = []
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start:start + self.batch_size]
+            jpeg, columns, width, height = mosaic([entry[3]
+                                                   for entry in batch])
+            records = self.rek.index_faces(jpeg,
+                                           self.collection_id,
+                                           max_faces=len(batch))
+            faces = []
+            taken = set()
+            for record in sorted(records, key=lambda r: -r['confidence']):
+                tile = tile_of(record['box'], columns, width, height)
+                if tile >= len(batch) or tile in taken:
+                    continue
+                taken.add(tile)
+                crop_hash, person, metadata, crop = batch[tile]
+                faces.append((record['face_id'], crop_hash, person,
+                              metadata))
+                indexed.append((record['face_id'], person))
+            self.cache.add_faces(self.collection_id, faces)
+        return indexed
+
+    def search(self, img, boxes):
+        """Identify the faces in an image.
+
+        :param img: image bytes.
+        :param boxes: face bounding boxes from detect_faces.
+        :return: list, in the order of boxes, of dicts of box, person
+                 (None if not recognized), metadata, face_id and
+                 similarity.
+        """
+        self.ensure()
+        results = []
+        for box, (crop_hash, crop) in zip(boxes, crop_faces(img, boxes)):
+            cached = self.cache.match(self.collection_id, crop_hash,
+                                      self.match_ttl)
+            if cached is None:
+                matches = self.rek.search_faces_by_image(
+                    _to_jpeg(crop), self.collection_id,
+                    threshold=self.threshold)
+                if matches:
+                    cached = (matches[0]['face_id'],
+                              matches[0]['external_id'],
+                              matches[0]['similarity'])
+                else:
+                    cached = (None, None, None)
+                self.cache.put_match(self.collection_id, crop_hash, *cached)
+            face_id, external_id, similarity = cached
+            person = metadata = None
+            if face_id is not None:
+                known = self.cache.person(face_id)
+                if known is not None:
+                    person, metadata = known
+                else:  # indexed by some other client
+                    person = external_id
+            results.append({'box': box,
+                            'person': person,
+                            'metadata': metadata,
+                            'face_id': face_id,
+                            'similarity': similarity})
+        return results
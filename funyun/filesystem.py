@@ -37,3 +37,22 @@ def init_filesystem(app):
     #
     create_config_file(Path(app.config['ROOT']) / 'etc' /
                        app.config['SETTINGS'])
+
+
+def prune_files(directory, pattern, max_entries):
+    """Remove the least recently modified files beyond max_entries.
+
+    Files removed concurrently by another process are ignored.
+    """
+    files = []
+    for path in Path(directory).glob(pattern):
+        try:
+            files.append((path.stat().st_mtime, path))
+        except OSError:
+            pass
+    files.sort(reverse=True)
+    for mtime, path in files[max_entries:]:
+        try:
+            path.unlink()
+        except OSError:
+            pass
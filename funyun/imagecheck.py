@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Check uploaded images before sending them anywhere.
+
+The format is sniffed from magic bytes and the dimensions are read from
+the JPEG SOF or PNG IHDR header, without decoding any pixels, so images
+that Rekognition would reject can be turned away in microseconds.
+"""
+#
+# Standard library imports.
+#
+import struct
+#
+# Global defs.
+#
+SUPPORTED_FORMATS = ('jpeg', 'png')
+MAGIC_BYTES = ((b'\xff\xd8\xff', 'jpeg'),
+               (b'\x89PNG\r\n\x1a\n', 'png'),
+               (b'GIF87a', 'gif'),
+               (b'GIF89a', 'gif'),
+               (b'BM', 'bmp'),
+               (b'II*\x00', 'tiff'),
+               (b'MM\x00*', 'tiff'))
+#
+# JPEG start-of-frame markers (baseline, progressive, lossless, etc.).
+# C4 (DHT), C8 (JPG) and CC (DAC) are in that range but are not frames.
+#
+JPEG_SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+JPEG_STANDALONE_MARKERS = frozenset(range(0xd0, 0xd8)) | {0x01}
+JPEG_SOS = 0xda
+JPEG_EOI = b'\xff\xd9'
+PNG_IEND = b'IEND'
+TRAILER_SEARCH_BYTES = 64 * 1024
+
+
+class ImageValidationError(ValueError):
+    """An uploaded image is unusable; the message says why."""
+
+
+def sniff_format(data):
+    """Return the image format indicated by magic bytes, or None."""
+    for magic, image_format in MAGIC_BYTES:
+        if data.startswith(magic):
+            return image_format
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[4:8] == b'ftyp' and data[8:12] in (b'heic', b'heix', b'mif1'):
+        return 'heic'
+    return None
+
+
+def jpeg_dimensions(data):
+    """Read (width, height) from the first JPEG start-of-frame segment."""
+    position = 2
+    length = len(data)
+    while position < length:
+        if data[position] != 0xff:
+            raise ImageValidationError('Corrupt JPEG: bad marker at byte %d.'
+                                       % position)
+        while position < length and data[position] == 0xff:  # fill bytes
+            position += 1
+        if position >= length:
+            break
+        marker = data[position]
+        position += 1
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if position + 2 > length:
+            break
+        segment_length = struct.unpack('>H', data[position:position + 2])[0]
+        if marker in JPEG_SOF_MARKERS:
+            if position + 7 > length:
+                break
+            height, width = struct.unpack('>HH',
+                                          data[position + 3:position + 7])
+            return width, height
+        if marker == JPEG_SOS:
+            raise ImageValidationError('Corrupt JPEG: no frame header before '
+                                       'image data.')
+        position += segment_length
+    raise ImageValidationError('Truncated JPEG: ends before frame header.')
+
+
+def png_dimensions(data):
+    """Read (width, height) from the PNG IHDR chunk."""
+    if len(data) < 24:
+        raise ImageValidationError('Truncated PNG: ends before header.')
+    if data[12:16] != b'IHDR':
+        raise ImageValidationError('Corrupt PNG: first chunk is not IHDR.')
+    return struct.unpack('>II', data[16:24])
+
+
+def validate_image(data, min_dimension=1, max_dimension=None):
+    """Check an image's format, completeness and dimensions.
+
+    :param data: image bytes.
+    :param min_dimension: smallest allowed width or height in pixels.
+    :param max_dimension: largest allowed width or height, or None.
+    :return: (format, width, height).
+    :raises ImageValidationError: with a message suitable for the user.
+    """
+    if len(data) == 0:
+        raise ImageValidationError('Empty file.')
+    image_format = sniff_format(data)
+    if image_format is None:
+        raise ImageValidationError('Not a recognized image file.')
+    if image_format not in SUPPORTED_FORMATS:
+        raise ImageValidationError('%s images are not supported, only JPEG '
+                                   'and PNG.' % image_format.upper())
+    trailer = data[-TRAILER_SEARCH_BYTES:]
+    if image_format == 'jpeg':
+        width, height = jpeg_dimensions(data)
+        if JPEG_EOI not in trailer:
+            raise ImageValidationError('Truncated JPEG: no end-of-image '
+                                       'marker.')
+    else:
+        width, height = png_dimensions(data)
+        if PNG_IEND not in trailer:
+            raise ImageValidationError('Truncated PNG: no IEND chunk.')
+    if min(width, height) < min_dimension:
+        raise ImageValidationError('Image is %dx%d pixels, smaller than the '
+                                   'minimum of %d.'
+                                   % (width, height, min_dimension))
+    if max_dimension is not None and max(width, height) > max_dimension:
+        raise ImageValidationError('Image is %dx%d pixels, larger than the '
+                                   'maximum of %d.'
+                                   % (width, height, max_dimension))
+    return image_format, width, height
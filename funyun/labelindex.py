@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""Search analyzed images by label.
+
+The index maps each label to a postings list of (image, confidence),
+with images numbered by small integers.  Each list is kept as parallel
+arrays twice over: sorted by confidence and sorted by image number.  A
+confidence threshold is then a binary search and a slice.  An AND
+starts from its smallest operand and checks the others by binary search
+in their lists sorted by image number, or by set operations in C when
+they are not much larger; a NOT is kept as the set of images excluded,
+never as the set of all other images.  Matches are scored by the sum
+of their confidences in the labels asked for; the top k are found with
+the threshold algorithm, reading the lists from the most confident end
+and stopping as soon as no unseen image can score higher, so only a
+few postings of long lists are touched.
+
+Queries are labels combined with AND, OR, NOT and parentheses; adjacent
+labels are ANDed, and labels with spaces are quoted:
+
+    Dog AND (Beach OR "Sea Life") NOT Cat
+
+The index is loaded from the results store and picks up new results
+incrementally: new postings are sorted on their own and merged into
+the lists when loaded, not when searched.
+"""
+#
+# Standard library imports.
+#
+import heapq
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+#
+# Global defs.
+#
+TOKEN_RE = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([^\s()"]+))')
+OPERATORS = ('AND', 'OR', 'NOT')
+INSERT_FRACTION = 64  # merge by insertion if under 1/64 of a list is new
+PROBE_FACTOR = 16  # check an AND operand by binary search if this larger
+
+
+class QuerySyntaxError(ValueError):
+    """A search query could not be parsed."""
+
+
+def tokenize(query):
+    """Split a query into (kind, text) tokens.
+
+    Kinds are '(', ')', 'AND', 'OR', 'NOT' and 'LABEL'.
+    """
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = TOKEN_RE.match(query, position)
+        if match is None:
+            raise QuerySyntaxError('Unbalanced quote in query.')
+        position = match.end()
+        if match.group(1):
+            tokens.append(('(', '('))
+        elif match.group(2):
+            tokens.append((')', ')'))
+        elif match.group(3) is not None:
+            tokens.append(('LABEL', match.group(3)))
+        elif match.group(4).upper() in OPERATORS:
+            tokens.append((match.group(4).upper(), match.group(4)))
+        else:
+            tokens.append(('LABEL', match.group(4)))
+    return tokens
+
+
+def parse(query):
+    """Parse a query into a tree of tuples.
+
+    :return: ('LABEL', name), ('NOT', tree), or ('AND' | 'OR', [trees]).
+    :raises QuerySyntaxError: if the query is malformed.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        raise QuerySyntaxError('Empty query.')
+    position = [0]
+
+    def peek():
+        if position[0] < len(tokens):
+            return tokens[position[0]][0]
+        return None
+
+    def take():
+        position[0] += 1
+        return tokens[position[0] - 1]
+
+    def parse_or():
+        terms = [parse_and()]
+        while peek() == 'OR':
+            take()
+            terms.append(parse_and())
+        return terms[0] if len(terms) == 1 else ('OR', terms)
+
+    def parse_and():
+        terms = [parse_not()]
+        while peek() in ('AND', 'NOT', 'LABEL', '('):
+            if peek() == 'AND':
+                take()
+            terms.append(parse_not())
+        return terms[0] if len(terms) == 1 else ('AND', terms)
+
+    def parse_not():
+        kind = peek()
+        if kind == 'NOT':
+            take()
+            return ('NOT', parse_not())
+        if kind == '(':
+            take()
+            tree = parse_or()
+            if peek() != ')':
+                raise QuerySyntaxError('Missing ")" in query.')
+            take()
+            return tree
+        if kind == 'LABEL':
+            return ('LABEL', take()[1])
+        if kind is None:
+            raise QuerySyntaxError('Query ends unexpectedly.')
+        raise QuerySyntaxError('Unexpected "%s" in query.'
+                               % tokens[position[0]][1])
+
+    tree = parse_or()
+    if position[0] != len(tokens):
+        raise QuerySyntaxError('Unexpected "%s" in query.'
+                               % tokens[position[0]][1])
+    return tree
+
+
+class Postings(object):
+    """Images with a label and their confidences."""
+
+    def __init__(self):
+        self.images = array('I')  # by ascending confidence
+        self.confidences = array('f')
+        self.numbers = array('I')  # by ascending image number
+        self.number_confidences = array('f')
+        self.unsorted = []  # (confidence, image) not yet merged
+
+    def merge(self):
+        """Merge the unsorted postings into the sorted arrays.
+
+        Only the new postings are sorted.  A few are inserted at their
+        binary-searched positions, which moves memory in C; many are
+        merged with the existing postings in one linear pass.
+        """
+        if not self.unsorted:
+            return
+        # Round to the stored precision so the order matches the arrays.
+        rounded = array('f', (c for c, i in self.unsorted))
+        new = sorted(zip(rounded, (i for c, i in self.unsorted)))
+        self.unsorted = []
+        if len(new) * INSERT_FRACTION < len(self.images):
+            for confidence, image in new:
+                low = bisect_left(self.confidences, confidence)
+                high = bisect_right(self.confidences, confidence, low)
+                position = bisect_left(self.images, image, low, high)
+                self.confidences.insert(position, confidence)
+                self.images.insert(position, image)
+        else:
+            merged = list(heapq.merge(zip(self.confidences, self.images),
+                                      new))
+            self.confidences = array('f', (c for c, i in merged))
+            self.images = array('I', (i for c, i in merged))
+        new.sort(key=lambda posting: posting[1])
+        if not self.numbers or new[0][1] > self.numbers[-1]:
+            # New images are numbered after all others, so usually the
+            # new postings simply go at the end.
+            self.number_confidences.extend(c for c, i in new)
+            self.numbers.extend(i for c, i in new)
+        else:
+            merged = list(heapq.merge(zip(self.numbers,
+                                          self.number_confidences),
+                                      ((i, c) for c, i in new)))
+            self.numbers = array('I', (i for i, c in merged))
+            self.number_confidences = array('f', (c for i, c in merged))
+
+    def above(self, min_confidence):
+        """Return the slice of images at or above a confidence."""
+        self.merge()  # only if added to without a refresh
+        start = bisect_left(self.confidences, min_confidence)
+        return self.images[start:], self.confidences[start:]
+
+    def confidence(self, image):
+        """Return the confidence for an image, or 0 if it is absent."""
+        position = bisect_left(self.numbers, image)
+        if position < len(self.numbers) and self.numbers[position] == image:
+            return self.number_confidences[position]
+        return 0.
+
+    def __len__(self):
+        return len(self.images) + len(self.unsorted)
+
+
+class LabelIndex(object):
+    """In-memory inverted index from label to images."""
+
+    def __init__(self, store=None, refresh_interval=5.):
+        """Create an index.
+
+        :param store: a results.ResultsStore to load from, or None.
+        :param refresh_interval: least time between loads of new
+                                 results from the store (seconds).
+        """
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.digests = []  # image number -> digest
+        self.numbers = {}  # digest -> image number
+        self.postings = {}  # lower-case label -> Postings
+        self.names = {}  # lower-case label -> label as stored
+        self.last_seq = 0  # results store change sequence loaded up to
+        self.last_refresh = 0.
+
+    def add(self, digest, label, confidence):
+        """Add one posting."""
+        number = self.numbers.get(digest)
+        if number is None:
+            number = self.numbers[digest] = len(self.digests)
+            self.digests.append(digest)
+        key = label.lower()
+        postings = self.postings.get(key)
+        if postings is None:
+            postings = self.postings[key] = Postings()
+            self.names[key] = label
+        postings.unsorted.append((confidence, number))
+
+    def refresh(self, force=False):
+        """Load results added to the store since the last refresh."""
+        if self.store is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_refresh < self.refresh_interval:
+            return
+        with self.lock:
+            self.last_refresh = now
+            #
+            # An image analyzed again has the same labels, so postings
+            # for images indexed by an earlier refresh are skipped.
+            #
+            known = set(self.numbers)
+            changed = set()
+            for seq, digest, label, confidence in \
+                    self.store.label_rows(self.last_seq):
+                self.last_seq = max(self.last_seq, seq)
+                if digest not in known:
+                    self.add(digest, label, confidence)
+                    changed.add(label.lower())
+            for key in changed:
+                self.postings[key].merge()
+
+    def _evaluate(self, tree, min_confidence, scores):
+        """Return the image numbers matching a query tree.
+
+        The result is (images, negated): the images matching, or with
+        negated true, the images not matching.  Images is a set, or for
+        a single label the array slice of its postings.
+
+        :param scores: list to which (postings, images, confidences) is
+                       appended for each label that is not negated.
+        """
+        kind = tree[0]
+        if kind == 'LABEL':
+            postings = self.postings.get(tree[1].lower())
+            if postings is None:
+                return set(), False
+            images, confidences = postings.above(min_confidence)
+            scores.append((postings, images, confidences))
+            return images, False
+        if kind == 'NOT':
+            images, negated = self._evaluate(tree[1], min_confidence, [])
+            return images, not negated
+        operands = [self._evaluate(subtree,
+                                   min_confidence,
+                                   scores if subtree[0] != 'NOT' else [])
+                    + (subtree,)
+                    for subtree in tree[1]]
+        included = [(images, subtree) for images, negated, subtree
+                    in operands if not negated]
+        excluded = [images for images, negated, subtree in operands
+                    if negated]
+        if kind == 'OR':
+            # a | b | ~c | ~d  ==  ~((c & d) - (a | b))
+            result = set()
+            for images, subtree in included:
+                result.update(images)
+            if not excluded:
+                return result, False
+            excluded.sort(key=len)
+            others = set(excluded[0])
+            for images in excluded[1:]:
+                others.intersection_update(images)
+            others.difference_update(result)
+            return others, True
+        if not included:
+            # ~c & ~d  ==  ~(c | d)
+            result = set()
+            for images in excluded:
+                result.update(images)
+            return result, True
+        included.sort(key=lambda operand: len(operand[0]))
+        result = set(included[0][0])
+        for images, subtree in included[1:]:
+            if subtree[0] == 'LABEL' and \
+                    len(result) * PROBE_FACTOR < len(images):
+                postings = self.postings[subtree[1].lower()]
+                result = set(image for image in result
+                             if postings.confidence(image) >=
+                             min_confidence)
+            else:
+                result.intersection_update(images)
+        for images in excluded:
+            result.difference_update(images)
+        return result, False
+
+    def search(self, query, min_confidence=0., k=20):
+        """Find the images matching a query.
+
+        :param query: query string, see the module docstring.
+        :param min_confidence: confidence a label needs to count.
+        :param k: number of results to return.
+        :return: (total number of matches, list of (digest, score) for
+                  the k best, best first).
+        :raises QuerySyntaxError: if the query is malformed.
+        """
+        tree = parse(query)
+        self.refresh()
+        with self.lock:
+            terms = []
+            images, negated = self._evaluate(tree, min_confidence, terms)
+            if negated:
+                if not isinstance(images, set):
+                    images = set(images)
+                total = len(self.digests) - len(images)
+                best = self._top_k(lambda image: image not in images,
+                                   lambda: (image for image
+                                            in range(len(self.digests))
+                                            if image not in images),
+                                   terms, min_confidence, k)
+            elif len(terms) != 1 or terms[0][1] is not images:
+                if not isinstance(images, set):
+                    images = set(images)
+                total = len(images)
+                best = self._top_k(images.__contains__,
+                                   lambda: sorted(images),
+                                   terms, min_confidence, k)
+            else:
+                # One label: every posting read is a match, and all
+                # matches are read before the heap can be short.
+                total = len(images)
+                best = self._top_k(lambda image: True, lambda: (),
+                                   terms, min_confidence, k)
+            return total, [(self.digests[image], score)
+                           for score, image in best]
+
+    def _score(self, image, terms, min_confidence):
+        score = 0.
+        for postings, images, confidences in terms:
+            confidence = postings.confidence(image)
+            if confidence >= min_confidence:
+                score += confidence
+        return score
+
+    def _top_k(self, matches, unseen, terms, min_confidence, k):
+        """Return [(score, image)] for the k best matches, best first.
+
+        :param matches: function returning True if an image matches.
+        :param unseen: function returning an iterable of the matches by
+                       image number, for those not reached through a
+                       term's postings.
+        """
+        if k < 1:
+            return []
+        heap = []  # the k best (score, image) so far, worst first
+        seen = set()
+        cursors = [len(images) for postings, images, confidences in terms]
+        while any(cursors):
+            threshold = 0.
+            for term, (postings, images, confidences) in enumerate(terms):
+                if cursors[term] == 0:
+                    continue
+                cursors[term] -= 1
+                image = images[cursors[term]]
+                threshold += confidences[cursors[term]]
+                if image in seen or not matches(image):
+                    continue
+                seen.add(image)
+                entry = (self._score(image, terms, min_confidence), image)
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+            if len(heap) == k and heap[0][0] >= threshold:
+                break
+        if len(heap) < k:  # matched only through NOT, score 0
+            for image in unseen():
+                if image not in seen:
+                    heap.append((0., image))
+                    if len(heap) == k:
+                        break
+        return sorted(heap, key=lambda entry: (-entry[0], entry[1]))
+
+    def labels(self):
+        """Return (label, number of images) pairs, most common first."""
+        with self.lock:
+            counts = [(self.names[key], len(postings))
+                      for key, postings in self.postings.items()]
+        return sorted(counts, key=lambda c: (-c[1], c[0]))
+
+    def __len__(self):
+        return sum(len(postings) for postings in self.postings.values())
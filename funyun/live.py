@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""Analyze a live stream of camera frames.
+
+The client sends JPEG frames back to back in one long request body (an
+MJPEG stream, with or without multipart boundaries) and reads results
+from the response as they are ready.  A reader thread parses frames and
+keeps only the newest one, so a frame not yet taken when the next
+arrives is dropped: when analysis falls behind, the stream skips ahead
+rather than queueing.  A frame is analyzed only if its difference hash
+differs enough from the last analyzed frame's, only a few frames per
+stream are analyzed at once, and analyses start no faster than the
+stream's and the process's rate limits allow, however fast frames come.
+"""
+#
+# Standard library imports.
+#
+import threading
+import time
+from functools import partial
+#
+# Local imports.
+#
+from .analysis import analyze_image
+from .imagecheck import ImageValidationError, validate_image
+from .video import JPEG_EOI, JPEG_SOI, VideoError, dhash
+#
+# Global defs.
+#
+READ_SIZE = 64 * 1024
+WAIT_INTERVAL = 0.1  # seconds between checks when there is nothing to do
+
+
+class RateLimiter(object):
+    """Token bucket limiting how often something may happen."""
+
+    def __init__(self, rate, burst=1):
+        """Create a limiter.
+
+        :param rate: events per second allowed on average.
+        :param burst: events allowed at once after an idle period.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take a token if one is available, without waiting."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1.:
+                return False
+            self.tokens -= 1.
+            return True
+
+
+def iter_jpeg_stream(stream, max_frame_bytes):
+    """Yield JPEG frames from a file-like stream of concatenated JPEGs.
+
+    Anything between frames, such as multipart boundaries and headers,
+    is ignored.  A frame ends at its first EOI marker, so frames must
+    not embed JPEG thumbnails.  Frames larger than max_frame_bytes are
+    discarded.  The stream is read by lines, since read() may wait for
+    a full buffer, so a frame is seen as soon as a line break follows
+    it, as one does in multipart MJPEG.
+    """
+    buffer = bytearray()
+    while True:
+        chunk = stream.readline(READ_SIZE)
+        if not chunk:
+            return
+        buffer += chunk
+        while True:
+            start = buffer.find(JPEG_SOI)
+            if start < 0:
+                del buffer[:max(0, len(buffer) - 1)]
+                break
+            end = buffer.find(JPEG_EOI, start + 2)
+            if end < 0:
+                del buffer[:start]
+                if len(buffer) > max_frame_bytes:
+                    buffer.clear()  # skip the rest of an oversized frame
+                break
+            frame = bytes(buffer[start:end + 2])
+            del buffer[:end + 2]
+            if len(frame) <= max_frame_bytes:
+                yield frame
+
+
+class LiveSession(object):
+    """Analysis of one live stream of frames."""
+
+    def __init__(self,
+                 rek,
+                 executor,
+                 limiter,
+                 max_fps=2.,
+                 max_in_flight=1,
+                 max_distance=6,
+                 min_dimension=1,
+                 max_seconds=600):
+        """Create a session.
+
+        :param rek: a Rekognize instance.
+        :param executor: executor analyses run on.
+        :param limiter: RateLimiter shared by all sessions.
+        :param max_fps: frames analyzed per second, at most.
+        :param max_in_flight: frames analyzed at once, at most.
+        :param max_distance: frames whose hash differs from the last
+                             analyzed frame's in this many bits or fewer
+                             are skipped.
+        :param min_dimension: smallest frame width or height analyzed.
+        :param max_seconds: length of stream analyzed.
+        """
+        self.rek = rek
+        self.executor = executor
+        self.limiter = limiter
+        self.interval = 1. / max_fps
+        self.max_in_flight = max_in_flight
+        self.max_distance = max_distance
+        self.min_dimension = min_dimension
+        self.max_seconds = max_seconds
+        self.condition = threading.Condition()
+        self.latest = None  # (frame number, JPEG bytes)
+        self.reading = True
+        self.error = None
+        self.completed = []  # (frame number, result or exception)
+        self.in_flight = 0
+        self.counts = {'frames': 0, 'analyzed': 0, 'skipped': 0,
+                       'dropped': 0, 'invalid': 0}
+        #
+        # Observers are called as observer(outcome) for each frame,
+        # outcome being one of the keys of counts other than 'frames'.
+        #
+        self.observers = []
+
+    def _count(self, outcome):
+        self.counts[outcome] += 1
+        for observer in self.observers:
+            observer(outcome)
+
+    def feed(self, frames):
+        """Take frames from an iterable until it ends; run in a thread."""
+        try:
+            for frame in frames:
+                with self.condition:
+                    if not self.reading:
+                        break
+                    if self.latest is not None:
+                        self._count('dropped')
+                    self.latest = (self.counts['frames'], frame)
+                    self.counts['frames'] += 1
+                    self.condition.notify_all()
+        except Exception as exc:
+            self.error = exc
+        finally:
+            with self.condition:
+                self.reading = False
+                self.condition.notify_all()
+
+    def _done(self, number, future):
+        try:
+            outcome = future.result()
+        except Exception as exc:
+            outcome = exc
+        with self.condition:
+            self.in_flight -= 1
+            self.completed.append((number, outcome))
+            self.condition.notify_all()
+
+    def results(self):
+        """Yield (frame number, result) as analyses finish.
+
+        Frames are analyzed newest first, as capacity allows; the
+        stream ends when the client stops sending and the last analysis
+        finishes, or after max_seconds.
+        """
+        stop = time.monotonic() + self.max_seconds
+        last_hash = None
+        next_start = 0.
+        try:
+            while True:
+                with self.condition:
+                    completed, self.completed = self.completed, []
+                for number, outcome in completed:
+                    if isinstance(outcome, Exception):
+                        raise outcome
+                    yield number, outcome
+                with self.condition:
+                    if self.completed:
+                        continue
+                    now = time.monotonic()
+                    if now > stop:
+                        return
+                    if self.latest is None:
+                        if not self.reading and not self.in_flight:
+                            if self.error is not None:
+                                raise self.error
+                            return
+                        self.condition.wait(WAIT_INTERVAL)
+                        continue
+                    if self.in_flight >= self.max_in_flight or \
+                            now < next_start:
+                        # Busy: the frame waits, and is dropped if a
+                        # newer one arrives first.
+                        self.condition.wait(max(next_start - now, 0.) or
+                                            WAIT_INTERVAL)
+                        continue
+                    number, frame = self.latest
+                    self.latest = None
+                try:
+                    validate_image(frame, min_dimension=self.min_dimension)
+                    frame_hash = dhash(frame)
+                except (ImageValidationError, OSError):
+                    self._count('invalid')
+                    continue
+                except VideoError:  # Pillow missing: no skipping
+                    frame_hash = None
+                if frame_hash is not None and last_hash is not None and \
+                        bin(frame_hash ^ last_hash).count('1') <= \
+                        self.max_distance:
+                    self._count('skipped')
+                    continue
+                if not self.limiter.try_acquire():
+                    # Other streams are using the process's quota.
+                    with self.condition:
+                        if self.latest is None:
+                            self.latest = (number, frame)
+                        else:
+                            self._count('dropped')
+                        self.condition.wait(WAIT_INTERVAL)
+                    continue
+                last_hash = frame_hash
+                next_start = time.monotonic() + self.interval
+                self._count('analyzed')
+                with self.condition:
+                    self.in_flight += 1
+                future = self.executor.submit(analyze_image, self.rek, frame)
+                future.add_done_callback(partial(self._done, number))
+        finally:
+            with self.condition:
+                self.reading = False  # stop the reader
+                self.condition.notify_all()
+
+
+def label_changes(previous, current):
+    """Return (added, removed) labels between two {label: confidence}."""
+    before = set(previous or ())
+    after = set(current)
+    return sorted(after - before), sorted(before - after)
@@ -1,41 +1,185 @@
 # -*- coding: utf-8 -*-
 """Set up logging.
+
+Records destined for the log file are put on an in-memory queue by the
+calling thread and written by a background listener thread, so that file
+I/O and rotation stay off the request path.  Since every gunicorn worker
+has its own listener writing to the same file, the file handler takes an
+advisory lock around each write and reopens the file if another worker
+has rotated it.
 """
 #
 # Library imports.
 #
+import atexit
+import copy
+import fcntl
+import json
 import logging
+import os
+import queue
 import sys
-from logging.handlers import RotatingFileHandler
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from datetime import datetime
 from pathlib import Path  # python 3.4
 #
 # Third-party imports.
 #
-from flask import request
+from flask import request, has_request_context
 
 #
 # Global variables.
 #
 DEFAULT_FILE_LOGLEVEL = logging.INFO
 DEFAULT_STDERR_LOGLEVEL = logging.WARNING
+LOG_QUEUE_LISTENER = None
+
+
+class CachedClock(object):
+    """Formats UTC timestamps, re-formatting at most once per second."""
+
+    def __init__(self, fmt='%Y-%m-%d %H:%M:%S'):
+        self.fmt = fmt
+        self.second = None
+        self.formatted = ''
+
+    def format(self, created):
+        second = int(created)
+        if second != self.second:
+            self.formatted = time.strftime(self.fmt, time.gmtime(second))
+            self.second = second
+        return self.formatted
+
+
+UTC_CLOCK = CachedClock()
 
 
 class ContextualFilter(logging.Filter):
     """A logging filter with request-based info."""
 
     def filter(self, record):
-        record.utcnow = (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S%Z'))
-        try:
+        record.utcnow = UTC_CLOCK.format(record.created)
+        if has_request_context():
             record.url = request.path
             record.method = request.method
-        except RuntimeError:
+        else:
             record.url = ''
             record.method = ''
-
         return True
 
 
+class JSONFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def __init__(self):
+        super().__init__()
+        self.clock = CachedClock('%Y-%m-%dT%H:%M:%S')
+
+    def format(self, record):
+        log_dict = {'time': '%s.%03dZ' % (self.clock.format(record.created),
+                                          record.msecs),
+                    'level': record.levelname,
+                    'logger': record.name,
+                    'module': record.module,
+                    'lineno': record.lineno,
+                    'pid': record.process,
+                    'message': record.getMessage()}
+        for field in ('url', 'method'):
+            value = getattr(record, field, '')
+            if value:
+                log_dict[field] = value
+        if record.exc_text:
+            log_dict['exc'] = record.exc_text
+        return json.dumps(log_dict)
+
+
+class LocalQueueHandler(QueueHandler):
+    """Queue handler that defers all formatting to the listener.
+
+    Only the message string and any traceback text are rendered in the
+    calling thread, since args and exc_info may not survive the hand-off.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self.queue.put_nowait(record)
+
+
+class LockingRotatingFileHandler(RotatingFileHandler):
+    """Rotating file handler that is safe to share between processes.
+
+    An exclusive lock on a sidecar lock file is held while writing and
+    rotating.  If the file was rotated by another process since it was
+    opened here, it is reopened before writing.
+    """
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.lockfile = open(self.baseFilename + '.lock', 'a')
+
+    def _stream_is_stale(self):
+        if self.stream is None:
+            return False
+        try:
+            path_stat = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return True
+        stream_stat = os.fstat(self.stream.fileno())
+        return (path_stat.st_ino, path_stat.st_dev) != \
+            (stream_stat.st_ino, stream_stat.st_dev)
+
+    def emit(self, record):
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        try:
+            if self._stream_is_stale():
+                self.stream.close()
+                self.stream = self._open()
+            super().emit(record)
+        finally:
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+
+    def close(self):
+        super().close()
+        self.lockfile.close()
+
+
+def start_queue_listener(handlers):
+    """Start a background thread writing queued records to handlers.
+
+    :param handlers: handlers that will do the actual writing.
+    :return: a QueueHandler to be attached to loggers.
+    """
+    global LOG_QUEUE_LISTENER
+    if LOG_QUEUE_LISTENER is not None:
+        LOG_QUEUE_LISTENER.stop()
+    log_queue = queue.Queue(-1)
+    LOG_QUEUE_LISTENER = QueueListener(log_queue,
+                                       *handlers,
+                                       respect_handler_level=True)
+    LOG_QUEUE_LISTENER.start()
+    atexit.register(stop_queue_listener)
+    return LocalQueueHandler(log_queue)
+
+
+def stop_queue_listener():
+    """Flush queued records and stop the listener thread."""
+    global LOG_QUEUE_LISTENER
+    if LOG_QUEUE_LISTENER is not None:
+        LOG_QUEUE_LISTENER.stop()
+        LOG_QUEUE_LISTENER = None
+
+
 def configure_logging(app):
     """ Configure logging to stderr and a log file.
 
@@ -86,13 +230,22 @@ def configure_logging(app):
                 app.logger.error('Unable to create logfile directory "%s"',
                                  logfile_path.parent)
                 raise OSError
-        log_handler = RotatingFileHandler(str(logfile_path),
-                                          maxBytes=app.config[
-                                              'LOGFILE_MAXBYTES'],
-                                          backupCount=app.config[
-                                              'LOGFILE_BACKUPCOUNT'])
-
-        log_handler.setLevel(file_log_level)
+        file_handler = LockingRotatingFileHandler(str(logfile_path),
+                                                  maxBytes=app.config[
+                                                      'LOGFILE_MAXBYTES'],
+                                                  backupCount=app.config[
+                                                      'LOGFILE_BACKUPCOUNT'])
+        file_handler.setLevel(file_log_level)
+        if app.config['LOGFILE_JSON']:
+            file_handler.setFormatter(JSONFormatter())
+        else:
+            file_handler.setFormatter(
+                logging.Formatter(app.config['FILE_LOG_FORMAT']))
+        if app.config['LOGFILE_QUEUE']:
+            log_handler = start_queue_listener([file_handler])
+            log_handler.setLevel(file_log_level)
+        else:
+            log_handler = file_handler
         werkzeug_logger = logging.getLogger('werkzeug')
         werkzeug_logger.addHandler(log_handler)
         for handler in app.logger.handlers:  # set levels on existing handlers
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""Read pieces of log files without loading them whole.
+
+All functions here work by seeking within the file, so the memory used
+is bounded by the chunk size no matter how large the log has grown.
+"""
+#
+# Standard library imports.
+#
+import os
+import re
+import time
+#
+# Global defs.
+#
+CHUNKSIZE = 64 * 1024
+TIMESTAMP_SEARCH_BYTES = 80
+TIMESTAMP_RE = re.compile(rb'(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})')
+DATE_RE = re.compile(rb'^(\d{4}-\d{2}-\d{2})$')
+
+
+def normalize_timestamp(since):
+    """Convert a user-supplied time to the form b'YYYY-MM-DD HH:MM:SS'.
+
+    :param since: a date or date-time string, 'T' or ' ' separated.
+    :return: bytes, or None if unparseable.
+    """
+    since = since.strip().encode('ascii', 'ignore')
+    match = TIMESTAMP_RE.match(since)
+    if match:
+        return match.group(1) + b' ' + match.group(2)
+    match = DATE_RE.match(since)
+    if match:
+        return match.group(1) + b' 00:00:00'
+    return None
+
+
+def line_timestamp(line):
+    """Return the comparable timestamp at the start of a log line, or None."""
+    match = TIMESTAMP_RE.search(line, 0, TIMESTAMP_SEARCH_BYTES)
+    if match:
+        return match.group(1) + b' ' + match.group(2)
+    return None
+
+
+def tail_offset(fh, nlines, end=None):
+    """Find the offset at which the last nlines lines of a file start.
+
+    The file is read backwards in chunks from end.
+
+    :param fh: file opened in binary mode.
+    :param nlines: number of lines wanted.
+    :param end: offset to count back from, defaults to end of file.
+    :return: byte offset.
+    """
+    if end is None:
+        end = fh.seek(0, os.SEEK_END)
+    if nlines <= 0:
+        return end
+    position = end
+    newlines = 0
+    # A trailing newline terminates the last line rather than starting one.
+    if end > 0:
+        fh.seek(end - 1)
+        if fh.read(1) == b'\n':
+            newlines = -1
+    while position > 0:
+        readsize = min(CHUNKSIZE, position)
+        position -= readsize
+        fh.seek(position)
+        chunk = fh.read(readsize)
+        index = len(chunk)
+        while True:
+            index = chunk.rfind(b'\n', 0, index)
+            if index < 0:
+                break
+            newlines += 1
+            if newlines == nlines:
+                return position + index + 1
+    return 0
+
+
+def _timestamp_after(fh, offset, end):
+    """Return (line_start, timestamp) of first stamped line after offset."""
+    if offset > 0:
+        fh.seek(offset - 1)
+        fh.readline()  # skip to start of next line
+    else:
+        fh.seek(0)
+    while fh.tell() < end:
+        line_start = fh.tell()
+        stamp = line_timestamp(fh.readline())
+        if stamp is not None:
+            return line_start, stamp
+    return end, None
+
+
+def since_offset(fh, since, end=None):
+    """Find the offset of the first line stamped at or after since.
+
+    Log files are appended in time order, so this is a binary search
+    on byte offsets.  Lines without a timestamp go with the line
+    before them.
+
+    :param fh: file opened in binary mode.
+    :param since: timestamp as returned by normalize_timestamp().
+    :param end: end offset of the search, defaults to end of file.
+    :return: byte offset.
+    """
+    if end is None:
+        end = fh.seek(0, os.SEEK_END)
+    low, high = 0, end
+    while low < high:
+        mid = (low + high) // 2
+        line_start, stamp = _timestamp_after(fh, mid, end)
+        if stamp is None or stamp >= since:
+            high = mid
+        else:
+            low = fh.tell()
+    line_start, stamp = _timestamp_after(fh, low, end)
+    return line_start
+
+
+def iter_range(path, start, end, chunksize=CHUNKSIZE):
+    """Yield the bytes of a file between start and end in chunks."""
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = fh.read(min(chunksize, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def follow(path, start, duration, poll_interval=1.0, chunksize=CHUNKSIZE):
+    """Yield data appended to a file, for at most duration seconds.
+
+    If the file is rotated while following, reading starts over at the
+    beginning of the new file.
+
+    :param path: file to follow.
+    :param start: offset to start from.
+    :param duration: seconds after which to stop.
+    :param poll_interval: seconds between checks for new data.
+    """
+    stop_time = time.monotonic() + duration
+    fh = open(path, 'rb')
+    try:
+        fh.seek(start)
+        while True:
+            chunk = fh.read(chunksize)
+            if chunk:
+                yield chunk
+                continue
+            if time.monotonic() >= stop_time:
+                return
+            time.sleep(poll_interval)
+            try:
+                path_stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if path_stat.st_ino != os.fstat(fh.fileno()).st_ino or \
+                    path_stat.st_size < fh.tell():
+                fh.close()
+                fh = open(path, 'rb')
+    finally:
+        fh.close()
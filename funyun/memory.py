@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""Find out where worker memory goes, using tracemalloc.
+
+Tracing is per process, so every report says which worker produced it.
+Snapshots are kept in memory in the worker that took them, and diffs
+compare the two most recent ones or the oldest and the newest.
+"""
+#
+# Standard library imports.
+#
+import os
+import resource
+import tracemalloc
+from io import StringIO
+#
+# Global defs.
+#
+SNAPSHOT_FILTERS = (tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, '<frozen importlib._bootstrap*'),
+                    tracemalloc.Filter(False, '<unknown>'))
+MAX_SNAPSHOTS = 10
+SNAPSHOTS = []
+
+
+def start_tracing(nframes=1):
+    """Start tracing allocations, keeping nframes of traceback for each."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(nframes)
+
+
+def stop_tracing():
+    """Stop tracing and discard snapshots, freeing tracemalloc's memory."""
+    tracemalloc.stop()
+    del SNAPSHOTS[:]
+
+
+def take_snapshot():
+    """Take and keep a snapshot of traced allocations."""
+    if not tracemalloc.is_tracing():
+        raise RuntimeError('tracemalloc is not tracing')
+    snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+    SNAPSHOTS.append(snapshot)
+    del SNAPSHOTS[:-MAX_SNAPSHOTS]
+    return snapshot
+
+
+def status():
+    """Return a text summary of memory use in this process."""
+    outstr = StringIO()
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    outstr.write('pid: %d\n' % os.getpid())
+    outstr.write('max RSS: %d kB\n' % maxrss)
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        outstr.write('tracing: %d frames\n'
+                     % tracemalloc.get_traceback_limit())
+        outstr.write('traced: %.1f kB (peak %.1f kB)\n' % (current / 1024.,
+                                                          peak / 1024.))
+        outstr.write('tracemalloc overhead: %.1f kB\n'
+                     % (tracemalloc.get_tracemalloc_memory() / 1024.))
+    else:
+        outstr.write('tracing: off\n')
+    outstr.write('snapshots: %d\n' % len(SNAPSHOTS))
+    return outstr.getvalue()
+
+
+def format_top(snapshot, limit=25, key_type='lineno'):
+    """Format the top allocation sites of a snapshot."""
+    stats = snapshot.statistics(key_type)
+    outstr = StringIO()
+    outstr.write('pid %d: top %d of %d allocation sites by size\n'
+                 % (os.getpid(), min(limit, len(stats)), len(stats)))
+    for stat in stats[:limit]:
+        outstr.write('%10.1f kB %8d blocks  %s\n'
+                     % (stat.size / 1024., stat.count, stat.traceback))
+    return outstr.getvalue()
+
+
+def format_diff(old, new, limit=25, key_type='lineno'):
+    """Format the allocation sites that grew most between two snapshots."""
+    stats = new.compare_to(old, key_type)
+    outstr = StringIO()
+    total = sum(stat.size_diff for stat in stats)
+    outstr.write('pid %d: %+.1f kB total, top %d of %d changed sites\n'
+                 % (os.getpid(), total / 1024., min(limit, len(stats)),
+                    len(stats)))
+    for stat in stats[:limit]:
+        outstr.write('%+10.1f kB %+8d blocks  %s\n'
+                     % (stat.size_diff / 1024., stat.count_diff,
+                        stat.traceback))
+    return outstr.getvalue()
+
+
+def init_memory(app):
+    """Install per-request allocation logging if configured.
+
+    Requests that leave more than MEMORY_DELTA_THRESHOLD bytes of
+    traced memory allocated are logged.  Tracing is started here, since
+    deltas cannot be measured without it.  Traced memory is counted
+    for the whole process, so a delta belongs to one request only when
+    the worker serves one request at a time; with GUNICORN_THREADS
+    above 1 tracing is still started, for snapshots, but no deltas are
+    logged.  Background analysis threads allocate too, so even then a
+    delta is an upper bound.
+
+    :param app: the Flask app.
+    """
+    if not app.config['MEMORY_TRACE_REQUESTS']:
+        return
+    from flask import g, request
+    threshold = app.config['MEMORY_DELTA_THRESHOLD']
+    start_tracing(app.config['MEMORY_TRACE_FRAMES'])
+    if app.config['GUNICORN_THREADS'] > 1:
+        app.logger.info('Not logging per-request memory deltas with %d '
+                        'threads per worker.',
+                        app.config['GUNICORN_THREADS'])
+        return
+
+    @app.before_request
+    def start_memory_delta():
+        if tracemalloc.is_tracing():
+            g.memory_start = tracemalloc.get_traced_memory()[0]
+
+    @app.teardown_request
+    def log_memory_delta(exc):
+        start = g.pop('memory_start', None)
+        if start is None or not tracemalloc.is_tracing():
+            return
+        delta = tracemalloc.get_traced_memory()[0] - start
+        if delta > threshold:
+            app.logger.warning('%s %s retained %.1f kB in pid %d.',
+                               request.method,
+                               request.path,
+                               delta / 1024.,
+                               os.getpid())
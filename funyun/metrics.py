@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""Collect metrics and render them in Prometheus text format.
+
+Each process accumulates its metrics in memory and periodically writes
+them to its own JSON file in a shared directory.  Rendering reads and
+sums the files from all processes, so any gunicorn worker can answer a
+scrape for the whole server.  Counters and histograms of processes that
+have exited are folded into an archive file so they stay monotonic;
+gauges are only reported for live processes.
+"""
+#
+# Standard library imports.
+#
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path  # python 3.4
+#
+# Global defs.
+#
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+SIZE_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024,
+                2 * 1024 * 1024, 5 * 1024 * 1024, 16 * 1024 * 1024)
+ARCHIVE_NAME = 'archive.json'
+LOCK_NAME = '.lock'
+#
+# Metric name: (type, help, histogram buckets).
+#
+METRIC_DEFS = {
+    'funyun_request_seconds':
+        ('histogram', 'Request latency by route.', LATENCY_BUCKETS),
+    'funyun_requests_in_flight':
+        ('gauge', 'Requests currently being handled.', None),
+    'funyun_rekognition_seconds':
+        ('histogram', 'Rekognition call latency by operation.',
+         LATENCY_BUCKETS),
+    'funyun_rekognition_endpoint_seconds':
+        ('histogram', 'Rekognition call latency by endpoint.',
+         LATENCY_BUCKETS),
+    'funyun_rekognition_errors_total':
+        ('counter', 'Rekognition calls that raised an error.', None),
+    'funyun_enrichment_seconds':
+        ('histogram', 'Enrichment HTTP call latency by service.',
+         LATENCY_BUCKETS),
+    'funyun_upload_bytes':
+        ('histogram', 'Size of uploaded files.', SIZE_BUCKETS),
+    'funyun_cache_requests_total':
+        ('counter', 'Cache lookups by cache and result.', None),
+    'funyun_scheduler_wait_seconds':
+        ('histogram', 'Time Rekognition calls waited for a slot, by '
+         'priority.', LATENCY_BUCKETS),
+    'funyun_deadline_exceeded_total':
+        ('counter', 'Analyses answered partially at their deadline.', None),
+    'funyun_live_frames_total':
+        ('counter', 'Live stream frames by outcome.', None),
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # pragma: no cover
+        return True
+    return True
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, _escape(v))
+                          for k, v in items) + '}'
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class MetricsRegistry(object):
+    """Per-process metrics backed by a file in a shared directory."""
+
+    def __init__(self, directory=None, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # one writer of the file
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.last_flush = 0.0
+        self.pid = os.getpid()
+
+    def configure(self, directory, flush_interval):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.flush_interval = flush_interval
+        atexit.register(self.flush)
+
+    def _reset_if_forked(self):
+        if os.getpid() != self.pid:  # pragma: no cover
+            self.pid = os.getpid()
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def _maybe_flush(self):
+        if self.directory is not None and \
+                time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def inc(self, name, amount=1, **labels):
+        """Add to a counter."""
+        key = _key(name, labels)
+        with self.lock:
+            self._reset_if_forked()
+            self.counters[key] = self.counters.get(key, 0) + amount
+        self._maybe_flush()
+
+    def gauge_add(self, name, amount, **labels):
+        """Add to (or, with negative amount, subtract from) a gauge."""
+        key = _key(name, labels)
+        with self.lock:
+            self._reset_if_forked()
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram."""
+        buckets = METRIC_DEFS[name][2]
+        key = _key(name, labels)
+        with self.lock:
+            self._reset_if_forked()
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+        self._maybe_flush()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the time spent in a with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _snapshot(self):
+        with self.lock:
+            return {'pid': self.pid,
+                    'counters': [[k[0], k[1], v]
+                                 for k, v in self.counters.items()],
+                    'gauges': [[k[0], k[1], v]
+                               for k, v in self.gauges.items()],
+                    'histograms': [[k[0], k[1], h[0], h[1], h[2]]
+                                   for k, h in self.histograms.items()]}
+
+    def flush(self):
+        """Write this process's metrics to its file."""
+        if self.directory is None:
+            return
+        self.last_flush = time.monotonic()
+        path = self.directory / ('%d.json' % os.getpid())
+        tmp_path = path.with_suffix('.tmp')
+        #
+        # Any request thread may flush; the temporary file is shared,
+        # and an older snapshot must not replace a newer one.
+        #
+        with self.flush_lock:
+            with tmp_path.open('w') as fh:
+                json.dump(self._snapshot(), fh)
+            os.replace(str(tmp_path), str(path))
+
+    def collect(self):
+        """Merge metrics from all processes.
+
+        :return: (counters, gauges, histograms) dicts keyed like the
+                 in-memory ones.
+        """
+        self.flush()
+        counters, gauges, histograms = {}, {}, {}
+        archived_counters, archived_histograms = {}, {}
+
+        def merge(data, counters, gauges, histograms):
+            for name, labels, value in data['counters']:
+                key = (name, tuple(tuple(i) for i in labels))
+                counters[key] = counters.get(key, 0) + value
+            if gauges is not None:
+                for name, labels, value in data['gauges']:
+                    key = (name, tuple(tuple(i) for i in labels))
+                    gauges[key] = gauges.get(key, 0) + value
+            for name, labels, buckets, total, count in data['histograms']:
+                key = (name, tuple(tuple(i) for i in labels))
+                hist = histograms.get(key)
+                if hist is None:
+                    hist = histograms[key] = [[0] * len(buckets), 0.0, 0]
+                for i, bucket_count in enumerate(buckets):
+                    hist[0][i] += bucket_count
+                hist[1] += total
+                hist[2] += count
+
+        with (self.directory / LOCK_NAME).open('a') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            archive_path = self.directory / ARCHIVE_NAME
+            if archive_path.exists():
+                with archive_path.open() as fh:
+                    archive = json.load(fh)
+                merge(archive, counters, None, histograms)
+                merge(archive, archived_counters, None, archived_histograms)
+            dead_paths = []
+            for path in self.directory.glob('[0-9]*.json'):
+                try:
+                    with path.open() as fh:
+                        data = json.load(fh)
+                except (IOError, ValueError):  # pragma: no cover
+                    continue
+                if _pid_alive(data['pid']):
+                    merge(data, counters, gauges, histograms)
+                    continue
+                merge(data, counters, None, histograms)
+                #
+                # Only exited processes go into the archive; files of
+                # live ones stay and are merged again on each scrape.
+                #
+                merge(data, archived_counters, None, archived_histograms)
+                dead_paths.append(path)
+            if dead_paths:  # fold exited processes into the archive
+                archive = {'pid': 0, 'gauges': [],
+                           'counters': [[k[0], k[1], v] for k, v
+                                        in archived_counters.items()],
+                           'histograms': [[k[0], k[1], h[0], h[1], h[2]]
+                                          for k, h
+                                          in archived_histograms.items()]}
+                tmp_path = archive_path.with_suffix('.tmp')
+                with tmp_path.open('w') as fh:
+                    json.dump(archive, fh)
+                os.replace(str(tmp_path), str(archive_path))
+                for path in dead_paths:
+                    path.unlink()
+        return counters, gauges, histograms
+
+    def render(self):
+        """Render merged metrics in Prometheus text exposition format."""
+        counters, gauges, histograms = self.collect()
+        by_name = {}
+        for store in (counters, gauges, histograms):
+            for key, value in store.items():
+                by_name.setdefault(key[0], []).append((key[1], value))
+        lines = []
+        for name in sorted(by_name):
+            metric_type, help_text, buckets = METRIC_DEFS.get(
+                name, ('untyped', '', None))
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in sorted(by_name[name]):
+                if metric_type != 'histogram':
+                    lines.append('%s%s %s' % (name,
+                                              _format_labels(labels),
+                                              _format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(buckets, value[0]):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format_labels(labels, ('le', bound)),
+                        cumulative))
+                lines.append('%s_bucket%s %d' % (
+                    name, _format_labels(labels, ('le', '+Inf')), value[2]))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels),
+                                              _format_value(value[1])))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels),
+                                                value[2]))
+        lines.extend(self._cache_ratios(counters))
+        return '\n'.join(lines) + '\n'
+
+    def _cache_ratios(self, counters):
+        """Derive hit ratios from the cache request counters."""
+        totals = {}
+        for (name, labels), value in counters.items():
+            if name != 'funyun_cache_requests_total':
+                continue
+            labels = dict(labels)
+            hits, lookups = totals.get(labels['cache'], (0, 0))
+            if labels['result'] == 'hit':
+                hits += value
+            totals[labels['cache']] = (hits, lookups + value)
+        if not totals:
+            return []
+        lines = ['# HELP funyun_cache_hit_ratio Fraction of cache lookups '
+                 'that hit.',
+                 '# TYPE funyun_cache_hit_ratio gauge']
+        for cache in sorted(totals):
+            hits, lookups = totals[cache]
+            lines.append('funyun_cache_hit_ratio{cache="%s"} %s'
+                         % (_escape(cache), _format_value(hits / lookups)))
+        return lines
+
+
+METRICS = MetricsRegistry()
+
+
+def cache_lookup(cache, hit):
+    """Count a lookup in a named cache."""
+    METRICS.inc('funyun_cache_requests_total',
+                cache=cache,
+                result='hit' if hit else 'miss')
+
+
+def observe_rekognition(operation, elapsed, ok):
+    """Rekognize observer that records call latency and errors."""
+    METRICS.observe('funyun_rekognition_seconds', elapsed,
+                    operation=operation)
+    if not ok:
+        METRICS.inc('funyun_rekognition_errors_total', operation=operation)
+
+
+def observe_endpoint(endpoint, operation, elapsed, ok):
+    """ClientPool observer that records latency per endpoint."""
+    METRICS.observe('funyun_rekognition_endpoint_seconds', elapsed,
+                    endpoint=endpoint)
+
+
+def observe_schedule(priority, waited):
+    """Scheduler observer that records time spent waiting for a slot."""
+    METRICS.observe('funyun_scheduler_wait_seconds', waited,
+                    priority=priority)
+
+
+def observe_live_frame(outcome):
+    """LiveSession observer that counts frames by outcome."""
+    METRICS.inc('funyun_live_frames_total', outcome=outcome)
+
+
+def init_metrics(app):
+    """Set up the metrics directory and per-request instrumentation.
+
+    :param app: the Flask app.
+    """
+    if not app.config['METRICS']:
+        return
+    from flask import g, request
+    METRICS.configure(Path(app.config['TMP']) / 'metrics',
+                      app.config['METRICS_FLUSH_SECONDS'])
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_start = time.perf_counter()
+        METRICS.gauge_add('funyun_requests_in_flight', 1)
+
+    @app.after_request
+    def record_request_metrics(response):
+        METRICS.gauge_add('funyun_requests_in_flight', -1)
+        g.metrics_done = True
+        if request.url_rule is not None:
+            route = request.url_rule.rule
+        else:
+            route = 'unmatched'
+        METRICS.observe('funyun_request_seconds',
+                        time.perf_counter() - g.metrics_start,
+                        route=route,
+                        method=request.method,
+                        status=response.status_code)
+        return response
+
+    @app.teardown_request
+    def end_request_metrics(exc):
+        if 'metrics_start' in g and 'metrics_done' not in g:
+            METRICS.gauge_add('funyun_requests_in_flight', -1)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Cache rendered pages and compiled templates on disk.
+
+A rendered page is stored under a key made from the image digest, the
+template name and a fingerprint of the template.  The fingerprint is a
+hash of the app version and the template source, so editing a template
+or upgrading the app changes every key and stale pages are never
+served; they age out as the cache is pruned.  Pages are files, shared by
+all workers on the host, written atomically.
+
+Jinja's compiled bytecode is also cached on disk, so a freshly started
+worker loads templates without compiling them.  Jinja checks the
+source checksum itself, so stale bytecode is never used.
+"""
+#
+# Standard library imports.
+#
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path  # python 3.4
+#
+# Third-party imports.
+#
+from jinja2 import FileSystemBytecodeCache
+#
+# Local imports.
+#
+from .filesystem import prune_files
+#
+# Global defs.
+#
+PRUNE_EVERY = 100  # pages stored between sweeps of old pages
+
+
+def init_template_cache(app):
+    """Cache compiled templates in TMP/jinja.
+
+    :param app: the Flask app.
+    """
+    if not app.config['TEMPLATE_BYTECODE_CACHE']:
+        return
+    directory = Path(app.config['TMP']) / 'jinja'
+    directory.mkdir(parents=True, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(str(directory))
+
+
+class TemplateVersions(object):
+    """Fingerprints of templates and the app version."""
+
+    def __init__(self, env, version):
+        """Create a fingerprinter.
+
+        :param env: the Jinja environment templates are rendered with.
+        :param version: app version, part of every fingerprint.
+        """
+        self.env = env
+        self.version = version
+        self.fingerprints = {}  # name -> (filename, mtime, fingerprint)
+
+    def fingerprint(self, name):
+        """Return a hash of the app version and a template's source.
+
+        The source is read again only when the file's mtime changes.
+        """
+        known = self.fingerprints.get(name)
+        if known is not None:
+            filename, mtime, fingerprint = known
+            try:
+                if os.stat(filename).st_mtime == mtime:
+                    return fingerprint
+            except OSError:
+                pass
+        source, filename, uptodate = self.env.loader.get_source(self.env,
+                                                                name)
+        fingerprint = hashlib.sha256(('%s\0%s' % (self.version, source))
+                                     .encode('UTF-8')).hexdigest()
+        if filename is not None:
+            self.fingerprints[name] = (filename, os.stat(filename).st_mtime,
+                                       fingerprint)
+        return fingerprint
+
+
+class PageCache(object):
+    """Directory of rendered pages, keyed by image and template."""
+
+    def __init__(self, directory, templates, max_entries=1000):
+        """Create a page cache.
+
+        :param directory: directory for page files.
+        :param templates: a TemplateVersions for the templates rendered.
+        :param max_entries: pages kept; the least recently used beyond
+                            this are removed.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.templates = templates
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.puts = 0
+
+    def path(self, digest, template):
+        key = '%s\0%s\0%s' % (digest, template,
+                              self.templates.fingerprint(template))
+        return self.directory / (hashlib.sha256(key.encode('UTF-8'))
+                                 .hexdigest() + '.html')
+
+    def get(self, digest, template):
+        """Return the cached page for an image, or None."""
+        path = self.path(digest, template)
+        try:
+            page = path.read_text(encoding='UTF-8')
+        except OSError:
+            return None
+        try:
+            os.utime(str(path))  # mark as recently used
+        except OSError:
+            pass
+        return page
+
+    def put(self, digest, template, page):
+        """Store a rendered page."""
+        path = self.path(digest, template)
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.directory),
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='UTF-8') as page_fh:
+                page_fh.write(page)
+            os.replace(tmp_path, str(path))
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+        with self.lock:
+            self.puts += 1
+            prune = self.puts % PRUNE_EVERY == 0
+        if prune:
+            prune_files(self.directory, '*.html', self.max_entries)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Shrink large originals to a size Rekognition accepts.
+
+Phone cameras produce images of more pixels and bytes than Rekognition
+takes or needs.  Such images are scaled down to fit within a maximum
+dimension and re-encoded as JPEG, at lower quality if need be to fit
+the byte limit.  Images already within both limits are left untouched,
+so their digests, and any cached analyses, stay the same.
+
+Pillow is an optional dependency (the 'preprocess' extra); without it,
+images are left as they are and oversized ones are rejected as before.
+"""
+#
+# Standard library imports.
+#
+from io import BytesIO
+#
+# Third-party imports.
+#
+try:
+    from PIL import Image
+except ImportError:  # optional, install the 'preprocess' extra
+    Image = None
+#
+# Global defs.
+#
+JPEG_QUALITIES = (90, 80, 70, 60)
+
+
+def can_downscale():
+    """Return True if Pillow is installed to scale images down."""
+    return Image is not None
+
+
+def downscale(data, width, height, max_dimension, max_bytes):
+    """Return an image scaled down to fit the limits, or data unchanged.
+
+    :param data: image bytes.
+    :param width: image width in pixels.
+    :param height: image height in pixels.
+    :param max_dimension: largest width or height wanted.
+    :param max_bytes: largest encoded size wanted.
+    :return: image bytes.
+    """
+    if Image is None or \
+            (max(width, height) <= max_dimension and len(data) <= max_bytes):
+        return data
+    image = Image.open(BytesIO(data))
+    exif = image.info.get('exif')  # keep capture time and location
+    image.draft('RGB', (max_dimension, max_dimension))  # fast JPEG decode
+    image = image.convert('RGB')
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    for quality in JPEG_QUALITIES:
+        outfh = BytesIO()
+        if exif:
+            image.save(outfh, 'JPEG', quality=quality, exif=exif)
+        else:
+            image.save(outfh, 'JPEG', quality=quality)
+        if outfh.tell() <= max_bytes:
+            break
+    return outfh.getvalue()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Sample per-request stacks and write them as flamegraph input.
+
+A sampler thread reads the stack of the thread handling a request at a
+fixed interval and counts identical stacks.  Because sampling is by wall
+clock, time spent blocked on the network shows up as well as CPU time.
+Output is in the "collapsed stack" format read by flamegraph.pl and
+speedscope, one file per profiled request in LOG/profiles.
+
+Nothing is installed unless PROFILE is set, so there is no cost when
+profiling is off.
+"""
+#
+# Standard library imports.
+#
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path  # python 3.4
+#
+# Global defs.
+#
+PROFILE_DIR = 'profiles'
+PROFILE_EXT = '.collapsed'
+UNSAFE_CHARS_RE = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+class StackSampler(object):
+    """Count the stacks seen in one thread, sampled on a timer."""
+
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run,
+                                       name='stack-sampler',
+                                       daemon=True)
+        self.start_time = None
+        self.elapsed = 0.0
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name,
+                                             os.path.basename(
+                                                 code.co_filename),
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.elapsed = time.perf_counter() - self.start_time
+
+    def write_collapsed(self, path):
+        """Write counts as 'frame;frame;frame count' lines."""
+        with path.open('w') as fh:
+            for stack, count in self.counts.most_common():
+                print('%s %d' % (stack, count), file=fh)
+
+
+def profile_dir(app):
+    """Return the directory in which profiles are written."""
+    return Path(app.config['LOG']) / PROFILE_DIR
+
+
+def list_profiles(app):
+    """Return paths of saved profiles, newest first."""
+    directory = profile_dir(app)
+    if not directory.is_dir():
+        return []
+    return sorted(directory.glob('*' + PROFILE_EXT),
+                  key=lambda path: path.stat().st_mtime,
+                  reverse=True)
+
+
+def init_profiling(app):
+    """Install request hooks if profiling is enabled.
+
+    A request is profiled if it carries the PROFILE_HEADER header or if
+    it is picked at random at PROFILE_SAMPLE_RATE.
+
+    :param app: the Flask app.
+    """
+    if not app.config['PROFILE']:
+        return
+    from flask import g, request
+    directory = profile_dir(app)
+    directory.mkdir(parents=True, exist_ok=True)
+    header = app.config['PROFILE_HEADER']
+    sample_rate = app.config['PROFILE_SAMPLE_RATE']
+    interval = app.config['PROFILE_INTERVAL']
+    keep = app.config['PROFILE_KEEP']
+
+    @app.before_request
+    def start_profile():
+        if header in request.headers or random.random() < sample_rate:
+            g.profiler = StackSampler(threading.get_ident(), interval)
+            g.profiler.start()
+
+    @app.teardown_request
+    def save_profile(exc):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+        profiler.stop()
+        name = '%s-%d-%s-%dms%s' % (
+            time.strftime('%Y%m%d-%H%M%S', time.gmtime()),
+            os.getpid(),
+            UNSAFE_CHARS_RE.sub('_', request.path.strip('/')) or 'root',
+            profiler.elapsed * 1000,
+            PROFILE_EXT)
+        profiler.write_collapsed(directory / name)
+        app.logger.info('Profile of %s written to %s.', request.path, name)
+        for old_path in list_profiles(app)[keep:]:
+            try:
+                old_path.unlink()
+            except OSError:  # pragma: no cover
+                pass
@@ -3,12 +3,23 @@
 #
 # Standard library imports.
 #
+import copy
+import time
 from collections import OrderedDict
 from io import StringIO
 #
 # Third-party imports.
 #
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+#
+# Local imports.
+#
+try:
+    from .cassette import CassetteMissError, call_key
+except ImportError:  # run as a script
+    from cassette import CassetteMissError, call_key
 #
 # Global defs.
 #
@@ -18,6 +29,15 @@ FEATURES_BLACKLIST = ('Landmarks',
                       'Quality',
                       'BoundingBox',
                       'Confidence')
+
+
+def client_config(timeout=None):
+    """Return botocore client configuration with a call timeout."""
+    if timeout is None:
+        return None
+    return Config(connect_timeout=timeout, read_timeout=timeout)
+
+
 #
 # Class definitions.
 #
@@ -54,6 +74,7 @@ class Rekognize(object):
             self.age = self.Age(0, 100)
             self.features = []
             self.confidence = 0
+            self.bounding_box = None
 
 
         def __str__(self, noFalse=True):
@@ -94,11 +115,143 @@ class Rekognize(object):
             return outstr.getvalue()
 
 
-    def __init__(self, region='us-west-2'):
-        self.client = boto3.client('rekognition', region)
+    def __init__(self,
+                 region='us-west-2',
+                 mode='live',
+                 cassette=None,
+                 replay_miss='error',
+                 image_store=None,
+                 s3_min_bytes=0,
+                 timeout=None,
+                 scheduler=None,
+                 priority='api'):
+        """Create a Rekognition client.
+
+        :param region: AWS region.
+        :param mode: 'live' calls AWS, 'record' calls AWS and saves each
+                     response in the cassette, 'replay' serves responses
+                     from the cassette.
+        :param cassette: a cassette.Cassette, needed unless mode is 'live'.
+        :param replay_miss: in replay mode, what to do when no response
+                            was recorded: 'error' raises CassetteMissError,
+                            'live' calls AWS (and records the response).
+        :param image_store: an s3store.ImageStore; if given, images of at
+                            least s3_min_bytes are put in S3 and calls
+                            refer to them there instead of carrying the
+                            bytes.
+        :param s3_min_bytes: smallest image sent by S3 reference.
+        :param timeout: connect and read timeout of AWS calls (seconds),
+                        or None for the botocore default.
+        :param scheduler: a scheduler.Scheduler admitting AWS calls, or
+                          None to make them at once.
+        :param priority: scheduler priority class of calls.
+        """
+        if mode not in ('live', 'record', 'replay'):
+            raise ValueError('Unknown Rekognize mode "%s"' % mode)
+        if mode != 'live' and cassette is None:
+            raise ValueError('Rekognize mode "%s" needs a cassette' % mode)
+        self.region = region
+        self.mode = mode
+        self.cassette = cassette
+        self.replay_miss = replay_miss
+        self.image_store = image_store
+        self.s3_min_bytes = s3_min_bytes
+        self.timeout = timeout
+        self.scheduler = scheduler
+        self.priority = priority
+        self._client = None
+        self._parent = None
         self.labels = None
         self.faces = None
         self.celebrities = None
+        #
+        # Observers are called as observer(operation, elapsed, ok)
+        # after every Rekognition call.
+        #
+        self.observers = []
+
+
+    @property
+    def client(self):
+        """The boto3 client, created on first use."""
+        if self._parent is not None:
+            return self._parent.client
+        if self._client is None:
+            self._client = boto3.client('rekognition', self.region,
+                                        config=client_config(self.timeout))
+        return self._client
+
+
+    @client.setter
+    def client(self, client):
+        self._parent = None
+        self._client = client
+
+
+    def with_priority(self, priority):
+        """Return a copy of this client whose calls have a priority.
+
+        The copy shares the AWS client, cassette and observers.
+        """
+        rek = copy.copy(self)
+        rek.priority = priority
+        rek._parent = self._parent or self
+        return rek
+
+
+    def _image_param(self, img):
+        """Return the Image parameter for a call, inline or by S3."""
+        if self.image_store is not None and len(img) >= self.s3_min_bytes:
+            return self.image_store.image_param(img)
+        return {'Bytes': img}
+
+
+    def _call(self, operation, img, **params):
+        """Make a Rekognition API call on an image (or on none, if img
+        is None), replaying or recording it.  Cassette keys depend on the
+        image bytes, not on how the image is passed, so recordings work
+        in either case.
+        """
+        if self.mode == 'live':
+            return self._live_call(operation, img, **params)
+        if img is None:
+            key = call_key(operation, params)
+        else:
+            key = call_key(operation, dict(params, Image={'Bytes': img}))
+        if self.mode == 'replay':
+            response = self.cassette.get(key)
+            if response is not None:
+                return response
+            if self.replay_miss != 'live':
+                raise CassetteMissError('No recorded %s response for key %s'
+                                        % (operation, key))
+        response = self._live_call(operation, img, **params)
+        self.cassette.put(key, operation, response)
+        return response
+
+
+    def _live_call(self, operation, img, **params):
+        """Make a Rekognition API call once the scheduler admits it,
+        notifying observers."""
+        if img is not None:
+            params['Image'] = self._image_param(img)
+        if self.scheduler is not None:
+            with self.scheduler.slot(self.priority):
+                return self._timed_call(operation, params)
+        return self._timed_call(operation, params)
+
+
+    def _timed_call(self, operation, params):
+        start = time.perf_counter()
+        ok = False
+        try:
+            response = getattr(self.client, operation)(**params)
+            ok = True
+        finally:
+            elapsed = time.perf_counter() - start
+            for observer in self.observers:
+                observer(operation, elapsed, ok)
+        return response
 
 
     def all_info(self):
@@ -119,38 +272,41 @@ class Rekognize(object):
                       verbose=False):
         if verbose:
             print('Detecting labels...')
-        self.labels = OrderedDict()
-        response = self.client.detect_labels(Image={'Bytes': img},
-                                             MaxLabels=max_labels,
-                                             MinConfidence=min_confidence)
+        labels = OrderedDict()
+        response = self._call('detect_labels',
+                              img,
+                              MaxLabels=max_labels,
+                              MinConfidence=min_confidence)
         label_list = response['Labels']
         if verbose:
             print('   %d features recognized in image:' % len(label_list))
         for label in label_list:
             name = label['Name']
             confidence = label['Confidence']
-            self.labels[name] = confidence
-        return self.labels
+            labels[name] = confidence
+        self.labels = labels
+        return labels
 
 
     def recognize_celebrities(self, img, verbose=False):
         if verbose:
             print('Recognizing celebrities...')
-        self.celebrities = []
-        response = self.client.recognize_celebrities(Image={'Bytes': img})
+        recognized = []
+        response = self._call('recognize_celebrities', img)
         celebrities = response['CelebrityFaces']
         for celebrity in celebrities:
             name = celebrity['Name']
             urls = celebrity['Urls']
             ident = celebrity['Id']
             confidence = celebrity['MatchConfidence']
-            self.celebrities.append(self.Celebrity(name,
-                                                   ident,
-                                                   confidence,
-                                                   urls ))
+            recognized.append(self.Celebrity(name,
+                                             ident,
+                                             confidence,
+                                             urls ))
         if verbose:
             print('  %d celebrities recognized.' %len(celebrities))
-        return self.celebrities
+        self.celebrities = recognized
+        return recognized
 
 
     def print_labels(self):
@@ -165,13 +321,15 @@ class Rekognize(object):
             print('Analyzing faces...')
         if attributes is None:
             attributes = ['ALL']
-        self.faces = []
-        response = self.client.detect_faces(Image={'Bytes': img},
-                                            Attributes=attributes)
+        faces = []
+        response = self._call('detect_faces',
+                              img,
+                              Attributes=attributes)
         facedata = response['FaceDetails']
-        newface = self.Face()
         for face in facedata:
+            newface = self.Face()
             newface.confidence = face['Confidence']
+            newface.bounding_box = face.get('BoundingBox')
             for emotion in face['Emotions']:
                 name = emotion['Type'].capitalize()
                 confidence = emotion['Confidence']
@@ -187,8 +345,75 @@ class Rekognize(object):
                                                               vals['Value'],
                                                               vals['Confidence'])
                                             )
-            self.faces.append(newface)
-        return self.faces
+            faces.append(newface)
+        self.faces = faces
+        return faces
+
+
+    def create_collection(self, collection_id):
+        """Create a face collection, if it does not already exist.
+
+        :return: True if the collection was created.
+        """
+        try:
+            self._call('create_collection', None,
+                       CollectionId=collection_id)
+        except ClientError as exc:
+            if exc.response['Error']['Code'] != \
+                    'ResourceAlreadyExistsException':
+                raise
+            return False
+        return True
+
+
+    def index_faces(self,
+                    img,
+                    collection_id,
+                    external_id=None,
+                    max_faces=None,
+                    quality_filter='AUTO'):
+        """Add the faces in an image to a collection.
+
+        :return: list of dicts of face_id, box and confidence for the
+                 faces indexed.
+        """
+        params = {'CollectionId': collection_id,
+                  'QualityFilter': quality_filter}
+        if external_id is not None:
+            params['ExternalImageId'] = external_id
+        if max_faces is not None:
+            params['MaxFaces'] = max_faces
+        response = self._call('index_faces', img, **params)
+        return [{'face_id': record['Face']['FaceId'],
+                 'box': record['Face']['BoundingBox'],
+                 'confidence': record['Face']['Confidence']}
+                for record in response['FaceRecords']]
+
+
+    def search_faces_by_image(self,
+                              img,
+                              collection_id,
+                              threshold=80,
+                              max_faces=1):
+        """Search a collection for the largest face in an image.
+
+        :return: list of dicts of face_id, external_id and similarity,
+                 most similar first.
+        """
+        try:
+            response = self._call('search_faces_by_image',
+                                  img,
+                                  CollectionId=collection_id,
+                                  FaceMatchThreshold=threshold,
+                                  MaxFaces=max_faces)
+        except ClientError as exc:
+            if exc.response['Error']['Code'] == 'InvalidParameterException':
+                return []  # no face found in the image
+            raise
+        return [{'face_id': match['Face']['FaceId'],
+                 'external_id': match['Face'].get('ExternalImageId'),
+                 'similarity': match['Similarity']}
+                for match in response['FaceMatches']]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""Keep analysis results in a local, indexed SQLite database.
+
+Each analyzed image is stored by digest with its full result, its
+capture time, camera and GPS position from EXIF, and one row per label
+and celebrity so images can be found by content.  Writes are queued
+and made in batches by a background thread, off the request path;
+reads use a connection per thread and, with the database in WAL mode,
+do not wait for writes.
+"""
+#
+# Standard library imports.
+#
+import atexit
+import json
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path  # python 3.4
+#
+# Third-party imports.
+#
+import piexif
+#
+# Local imports.
+#
+from .analysis import ANALYSIS_VERSION
+#
+# Global defs.
+#
+SCHEMA = ("""CREATE TABLE IF NOT EXISTS images (
+                 digest TEXT PRIMARY KEY,
+                 version INTEGER NOT NULL,
+                 size INTEGER NOT NULL,
+                 analyzed REAL NOT NULL,
+                 faces INTEGER NOT NULL,
+                 capture_time TEXT,
+                 latitude REAL,
+                 longitude REAL,
+                 camera TEXT,
+                 result BLOB NOT NULL)""",
+          """CREATE TABLE IF NOT EXISTS labels (
+                 digest TEXT NOT NULL,
+                 label TEXT NOT NULL,
+                 confidence REAL NOT NULL,
+                 PRIMARY KEY (digest, label))""",
+          #
+          # Labels are deleted and inserted again when an image is
+          # analyzed again, so their rowids may be reused; readers
+          # following new labels use this sequence, which never is.
+          #
+          """CREATE TABLE IF NOT EXISTS label_changes (
+                 seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                 digest TEXT NOT NULL UNIQUE)""",
+          'INSERT INTO label_changes (digest) SELECT digest FROM images '
+          'WHERE NOT EXISTS (SELECT 1 FROM label_changes)',
+          """CREATE TABLE IF NOT EXISTS celebrities (
+                 digest TEXT NOT NULL,
+                 celebrity_id TEXT NOT NULL,
+                 name TEXT NOT NULL,
+                 confidence REAL NOT NULL,
+                 PRIMARY KEY (digest, celebrity_id))""",
+          'CREATE INDEX IF NOT EXISTS images_capture_time '
+          'ON images (capture_time)',
+          'CREATE INDEX IF NOT EXISTS labels_label '
+          'ON labels (label, confidence)',
+          'CREATE INDEX IF NOT EXISTS celebrities_id '
+          'ON celebrities (celebrity_id)')
+BUSY_TIMEOUT = 10.  # seconds to wait on another process's write
+STOP = object()  # queue sentinel
+
+
+def _rational(value):
+    return value[0] / value[1] if value[1] else 0.
+
+
+def _degrees(dms, ref):
+    degrees = (_rational(dms[0]) + _rational(dms[1]) / 60. +
+               _rational(dms[2]) / 3600.)
+    return -degrees if ref in (b'S', b'W') else degrees
+
+
+def exif_info(img):
+    """Return capture time, position and camera from an image's EXIF.
+
+    :param img: image bytes.
+    :return: dict with 'capture_time' (ISO 8601, local to the camera),
+             'latitude', 'longitude' and 'camera', each None if absent.
+    """
+    info = {'capture_time': None, 'latitude': None, 'longitude': None,
+            'camera': None}
+    try:
+        exif = piexif.load(img)
+    except Exception:  # no EXIF, PNG, or EXIF piexif can't parse
+        return info
+    taken = exif['Exif'].get(piexif.ExifIFD.DateTimeOriginal) or \
+        exif['0th'].get(piexif.ImageIFD.DateTime)
+    if taken:
+        taken = taken.decode('ASCII', 'replace').strip('\x00 ')
+        info['capture_time'] = taken.replace(':', '-', 2).replace(' ', 'T')
+    camera = [exif['0th'].get(tag, b'').decode('ASCII', 'replace')
+              .strip('\x00 ')
+              for tag in (piexif.ImageIFD.Make, piexif.ImageIFD.Model)]
+    if any(camera):
+        info['camera'] = ' '.join(part for part in camera if part)
+    gps = exif['GPS']
+    try:
+        info['latitude'] = _degrees(gps[piexif.GPSIFD.GPSLatitude],
+                                    gps.get(piexif.GPSIFD.GPSLatitudeRef))
+        info['longitude'] = _degrees(gps[piexif.GPSIFD.GPSLongitude],
+                                     gps.get(piexif.GPSIFD.GPSLongitudeRef))
+    except (KeyError, IndexError, TypeError):
+        info['latitude'] = info['longitude'] = None
+    return info
+
+
+class ResultsStore(object):
+    """SQLite store of analysis results with batched background writes."""
+
+    def __init__(self, path, batch_size=100, flush_interval=1.):
+        """Open or create a store.
+
+        :param path: path of the database file.
+        :param batch_size: most results written in one transaction.
+        :param flush_interval: longest a queued result waits (seconds).
+        """
+        self.path = Path(path)
+        if not self.path.parent.is_dir():
+            self.path.parent.mkdir(parents=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.local = threading.local()
+        self.write_errors = 0
+        self.last_error = None
+        with self._connection() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                connection.execute(statement)
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop,
+                                       name='results-writer',
+                                       daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def _connection(self):
+        """Return this thread's connection."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(str(self.path),
+                                         timeout=BUSY_TIMEOUT)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def save(self, result, exif=None):
+        """Queue a result for writing.
+
+        :param result: dict from analysis.analyze_image().
+        :param exif: dict from exif_info(), or None.
+        """
+        self.queue.put((time.time(), result, exif or {}))
+
+    def _write_loop(self):
+        connection = self._connection()
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            stopping = any(item is STOP for item in batch)
+            items = [item for item in batch if item is not STOP]
+            try:
+                if items:
+                    self._write(connection, items)
+            except sqlite3.Error as exc:  # keep writing later batches
+                self.write_errors += 1
+                self.last_error = str(exc)
+            finally:
+                for unused in batch:
+                    self.queue.task_done()
+
+    def _write(self, connection, items):
+        images = []
+        labels = []
+        celebrities = []
+        for analyzed, result, exif in items:
+            digest = result['digest']
+            blob = zlib.compress(json.dumps(result,
+                                            separators=(',', ':'))
+                                 .encode('UTF-8'))
+            images.append((digest, ANALYSIS_VERSION, result['size'],
+                           analyzed, len(result['faces']),
+                           exif.get('capture_time'), exif.get('latitude'),
+                           exif.get('longitude'), exif.get('camera'), blob))
+            labels.extend((digest, label, confidence)
+                          for label, confidence in result['labels'].items())
+            celebrities.extend((digest, celebrity['id'], celebrity['name'],
+                                celebrity['confidence'])
+                               for celebrity in result['celebrities'])
+        digests = [(image[0],) for image in images]
+        with connection:
+            connection.executemany('DELETE FROM labels WHERE digest = ?',
+                                   digests)
+            connection.executemany('DELETE FROM celebrities WHERE digest = ?',
+                                   digests)
+            connection.executemany('INSERT OR REPLACE INTO images '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   images)
+            connection.executemany('INSERT OR REPLACE INTO labels '
+                                   'VALUES (?, ?, ?)', labels)
+            connection.executemany('INSERT OR REPLACE INTO label_changes '
+                                   '(digest) VALUES (?)', digests)
+            connection.executemany('INSERT OR REPLACE INTO celebrities '
+                                   'VALUES (?, ?, ?, ?)', celebrities)
+
+    def flush(self):
+        """Wait until all queued results are written."""
+        self.queue.join()
+
+    def close(self):
+        """Write queued results and stop the writer."""
+        if self.writer.is_alive():
+            self.queue.put(STOP)
+            self.writer.join()
+
+    def get(self, digest):
+        """Return the stored result for an image, or None.
+
+        Results from an older analysis version are ignored.
+        """
+        row = self._connection().execute(
+            'SELECT result FROM images WHERE digest = ? AND version = ?',
+            (digest, ANALYSIS_VERSION)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]).decode('UTF-8'))
+
+    def record(self, digest):
+        """Return the stored metadata of an image, or None."""
+        row = self._connection().execute(
+            'SELECT digest, size, analyzed, faces, capture_time, latitude, '
+            'longitude, camera FROM images WHERE digest = ?',
+            (digest,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('digest', 'size', 'analyzed', 'faces',
+                         'capture_time', 'latitude', 'longitude', 'camera'),
+                        row))
+
+    def by_label(self, label, min_confidence=0.):
+        """Return digests of images with a label, most confident first."""
+        return [row[0] for row in self._connection().execute(
+            'SELECT digest FROM labels WHERE label = ? AND confidence >= ? '
+            'ORDER BY confidence DESC', (label, min_confidence))]
+
+    def by_celebrity(self, celebrity_id):
+        """Return digests of images in which a celebrity was recognized."""
+        return [row[0] for row in self._connection().execute(
+            'SELECT digest FROM celebrities WHERE celebrity_id = ? '
+            'ORDER BY confidence DESC', (celebrity_id,))]
+
+    def by_capture_time(self, start=None, end=None):
+        """Return digests of images taken in [start, end), oldest first.
+
+        :param start: ISO 8601 time, or None for no lower bound.
+        :param end: ISO 8601 time, or None for no upper bound.
+        """
+        return [row[0] for row in self._connection().execute(
+            'SELECT digest FROM images WHERE capture_time IS NOT NULL '
+            'AND capture_time >= ? AND capture_time < ? '
+            'ORDER BY capture_time',
+            (start or '', end or '\uffff'))]
+
+    def label_rows(self, after=0):
+        """Yield (seq, digest, label, confidence) for the labels of
+        images written after a change sequence number, in seq order."""
+        return self._connection().execute(
+            'SELECT label_changes.seq, labels.digest, label, '
+            'labels.confidence FROM label_changes '
+            'JOIN labels ON labels.digest = label_changes.digest '
+            'JOIN images ON images.digest = label_changes.digest '
+            'WHERE label_changes.seq > ? AND images.version = ? '
+            'ORDER BY label_changes.seq', (after, ANALYSIS_VERSION))
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM images').fetchone()[0]
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Keep images in S3 so Rekognition calls can refer to them.
+
+Each analysis makes several Rekognition calls on the same image.  Sent
+inline, the image bytes travel with every call; stored once in S3, each
+call carries only the bucket and object name.  Objects are named by the
+image's SHA-256 digest, so an image already in the bucket is not
+uploaded again, and a lifecycle rule on the prefix expires them.
+
+Rekognition only reads from buckets in its own region.  Any
+S3-compatible service (e.g., a local stand-in for testing) can be used
+by giving its endpoint URL.
+"""
+#
+# Standard library imports.
+#
+import threading
+import time
+from collections import OrderedDict
+#
+# Third-party imports.
+#
+import boto3
+from botocore.exceptions import ClientError
+#
+# Local imports.
+#
+from .cassette import image_digest
+#
+# Global defs.
+#
+LIFECYCLE_RULE_ID = 'funyun-expire-images'
+KNOWN_OBJECTS_MAX = 10000
+EXPIRY_MARGIN = 3600  # re-upload objects this close to expiring (seconds)
+CONTENT_TYPES = {b'\xff\xd8': 'image/jpeg',
+                 b'\x89P': 'image/png'}
+
+
+class ImageStore(object):
+    """Upload images to S3 once, keyed by digest."""
+
+    def __init__(self,
+                 bucket,
+                 prefix='funyun/images/',
+                 expire_days=1,
+                 region=None,
+                 endpoint_url=None,
+                 client=None):
+        """Create a store.
+
+        :param bucket: S3 bucket name.
+        :param prefix: prefix of object names, also used by the
+                       lifecycle rule.
+        :param expire_days: days after which objects are deleted.
+        :param region: AWS region of the bucket.
+        :param endpoint_url: URL of an S3-compatible service, or None.
+        :param client: boto3 S3 client to use instead of creating one.
+        """
+        self.bucket = bucket
+        self.prefix = prefix
+        self.expire_days = expire_days
+        if client is None:
+            client = boto3.client('s3',
+                                  region_name=region,
+                                  endpoint_url=endpoint_url)
+        self.client = client
+        self.lock = threading.Lock()
+        self.known = OrderedDict()  # object name -> upload time
+        self.storing = {}  # object name -> [lock, users] while storing
+        self.uploads = 0
+
+    def object_name(self, img):
+        """Return the object name for image bytes."""
+        return self.prefix + image_digest(img)
+
+    def _fresh(self, uploaded):
+        return (time.time() - uploaded <
+                self.expire_days * 86400 - EXPIRY_MARGIN)
+
+    def _remember(self, name, uploaded):
+        with self.lock:
+            self.known[name] = uploaded
+            self.known.move_to_end(name)
+            while len(self.known) > KNOWN_OBJECTS_MAX:
+                self.known.popitem(last=False)
+
+    def _stored_time(self, name):
+        """Return when an object was stored, or None if it is absent."""
+        with self.lock:
+            uploaded = self.known.get(name)
+        if uploaded is not None:
+            return uploaded
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=name)
+        except ClientError as exc:
+            if exc.response['Error']['Code'] in ('404', 'NoSuchKey',
+                                                 'NotFound'):
+                return None
+            raise
+        return head['LastModified'].timestamp()
+
+    def store(self, img):
+        """Make sure an image is in the bucket, uploading it if needed.
+
+        Objects close to expiring are uploaded again, which restarts
+        their lifecycle clock.
+
+        :param img: image bytes.
+        :return: object name.
+        """
+        name = self.object_name(img)
+        #
+        # The calls of one analysis run concurrently; the first to
+        # store an image uploads it and the others wait for it.
+        #
+        with self.lock:
+            entry = self.storing.setdefault(name, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                uploaded = self._stored_time(name)
+                if uploaded is None or not self._fresh(uploaded):
+                    self.client.put_object(
+                        Bucket=self.bucket,
+                        Key=name,
+                        Body=img,
+                        ContentType=CONTENT_TYPES.get(
+                            img[:2], 'application/octet-stream'))
+                    self.uploads += 1
+                    uploaded = time.time()
+                self._remember(name, uploaded)
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.storing[name]
+        return name
+
+    def image_param(self, img):
+        """Return a Rekognition Image parameter referring to the image."""
+        return {'S3Object': {'Bucket': self.bucket,
+                             'Name': self.store(img)}}
+
+    def ensure_lifecycle(self):
+        """Add the expiration rule for our prefix to the bucket.
+
+        Other rules on the bucket are kept.
+
+        :raises ClientError: if the bucket configuration can't be changed.
+        """
+        try:
+            rules = self.client.get_bucket_lifecycle_configuration(
+                Bucket=self.bucket)['Rules']
+        except ClientError as exc:
+            if exc.response['Error']['Code'] != \
+                    'NoSuchLifecycleConfiguration':
+                raise
+            rules = []
+        rule = {'ID': LIFECYCLE_RULE_ID,
+                'Filter': {'Prefix': self.prefix},
+                'Status': 'Enabled',
+                'Expiration': {'Days': self.expire_days}}
+        if rule not in rules:
+            rules = [r for r in rules if r.get('ID') != LIFECYCLE_RULE_ID]
+            rules.append(rule)
+            self.client.put_bucket_lifecycle_configuration(
+                Bucket=self.bucket,
+                LifecycleConfiguration={'Rules': rules})
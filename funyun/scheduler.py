@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Share the Rekognition quota between classes of traffic.
+
+Calls are admitted through a fixed number of slots, shared by every
+worker process on the host.  Each slot is a file in a directory and is
+held by an exclusive flock, so a slot held by a process that dies is
+freed by the kernel.  Each priority class may use only some of the
+slots: its cap.  Classes with lower caps take slots from the bottom and
+the interactive class from the top, so a bulk backfill can never hold
+the slots kept back for interactive requests.
+
+Within a process, waiting calls are ordered by weighted fair queuing:
+each call is tagged with a virtual finish time that advances by
+1 / weight per call of its class, and free slots go to the waiting
+calls with the smallest tags whose class is under its cap.  A class
+with twice the weight gets twice the share of contended slots, and an
+idle class's share is used by the others.
+"""
+#
+# Standard library imports.
+#
+import fcntl
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path  # python 3.4
+#
+# Global defs.
+#
+PRIORITIES = ('interactive', 'api', 'bulk')
+DEFAULT_WEIGHTS = {'interactive': 8, 'api': 4, 'bulk': 1}
+DEFAULT_CAPS = {'interactive': 16, 'api': 12, 'bulk': 6}
+POLL_INTERVAL = 0.005  # seconds between checks for slots freed elsewhere
+
+
+class _Waiter(object):
+    def __init__(self, priority, tag, sequence):
+        self.priority = priority
+        self.tag = tag
+        self.sequence = sequence
+        self.slot = None
+
+
+class Scheduler(object):
+    """Admit calls by priority through slots shared across processes."""
+
+    def __init__(self,
+                 directory,
+                 slots=16,
+                 weights=None,
+                 caps=None,
+                 poll_interval=POLL_INTERVAL):
+        """Create a scheduler.
+
+        :param directory: directory for the slot files, the same for
+                          all processes that share the slots.
+        :param slots: calls in flight at once, across all processes.
+        :param weights: dict of priority class: weight.
+        :param caps: dict of priority class: most slots it may use.
+        :param poll_interval: how often waiting calls look for slots
+                              freed by other processes (seconds).
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        caps = dict(DEFAULT_CAPS, **(caps or {}))
+        self.caps = {priority: max(1, min(slots, caps[priority]))
+                     for priority in self.weights}
+        self.poll_interval = poll_interval
+        self.slot_files = [(self.directory / ('slot-%d' % number))
+                           .open('a') for number in range(slots)]
+        self.held = set()  # slots held by this process
+        self.condition = threading.Condition()
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.virtual_time = 0.
+        self.last_tags = {priority: 0. for priority in self.weights}
+        self.active = {priority: 0 for priority in self.weights}
+        #
+        # Observers are called as observer(priority, waited) when a
+        # call is admitted.
+        #
+        self.observers = []
+
+    def _slot_order(self, priority):
+        """Return the slots a class may use, in the order it tries them."""
+        cap = self.caps[priority]
+        if priority == PRIORITIES[0]:
+            top = len(self.slot_files)
+            return range(top - 1, top - cap - 1, -1)
+        return range(cap)
+
+    def _try_lock(self, priority):
+        """Lock a free slot for a class, returning its number or None."""
+        for number in self._slot_order(priority):
+            if number in self.held:
+                continue
+            try:
+                fcntl.flock(self.slot_files[number],
+                            fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            self.held.add(number)
+            return number
+        return None
+
+    def _dispatch(self):
+        """Give free slots to waiters, best tag first.  Hold condition."""
+        blocked = set()
+        for waiter in sorted(self.waiters,
+                             key=lambda w: (w.tag, w.sequence)):
+            if waiter.priority in blocked:
+                continue
+            waiter.slot = self._try_lock(waiter.priority)
+            if waiter.slot is None:
+                blocked.add(waiter.priority)
+                if len(blocked) == len(self.weights):
+                    break
+                continue
+            self.waiters.remove(waiter)
+            self.virtual_time = max(self.virtual_time, waiter.tag)
+            self.active[waiter.priority] += 1
+        self.condition.notify_all()
+
+    def acquire(self, priority):
+        """Wait for a slot.
+
+        :return: the slot number, to be passed to release().
+        """
+        if priority not in self.weights:
+            raise ValueError('Unknown priority "%s"' % priority)
+        start = time.perf_counter()
+        with self.condition:
+            tag = max(self.virtual_time, self.last_tags[priority]) + \
+                1. / self.weights[priority]
+            self.last_tags[priority] = tag
+            waiter = _Waiter(priority, tag, next(self.sequence))
+            self.waiters.append(waiter)
+            while True:
+                self._dispatch()
+                if waiter.slot is not None:
+                    break
+                self.condition.wait(self.poll_interval)
+        waited = time.perf_counter() - start
+        for observer in self.observers:
+            observer(priority, waited)
+        return waiter.slot
+
+    def release(self, priority, slot):
+        """Free a slot from acquire()."""
+        with self.condition:
+            fcntl.flock(self.slot_files[slot], fcntl.LOCK_UN)
+            self.held.discard(slot)
+            self.active[priority] -= 1
+            if self.waiters:
+                self._dispatch()
+
+    @contextmanager
+    def slot(self, priority):
+        """Context manager holding a slot for one call."""
+        slot = self.acquire(priority)
+        try:
+            yield slot
+        finally:
+            self.release(priority, slot)
+
+    def stats(self):
+        """Return calls in flight and waiting, by priority class."""
+        with self.condition:
+            waiting = {priority: 0 for priority in self.weights}
+            for waiter in self.waiters:
+                waiting[waiter.priority] += 1
+            return {priority: {'active': self.active[priority],
+                               'waiting': waiting[priority],
+                               'cap': self.caps[priority],
+                               'weight': self.weights[priority]}
+                    for priority in self.weights}
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""A fixed-size cache in a memory-mapped file, shared by processes.
+
+Every worker on a host maps the same file, so the cache is warmed once
+and held in memory once, however many workers there are.  The file is
+a hash table of fixed-size slots.  A key hashes to a bucket; it may be
+stored in any of the PROBES slots from there.  A slot holds a sequence
+number, a 16-byte key hash, the value length, a reference bit and the
+value.
+
+Reads take no locks.  A writer makes the sequence number odd while it
+changes a slot and even again when done; a reader copies the slot and
+accepts the copy only if the sequence number was the same, and even,
+before and after.  Writers take one of a set of striped locks, each
+both a thread lock and a byte-range lock on a lock file, so writers to
+different stripes never wait on each other.
+
+When all slots a key may use are full, one is evicted by the clock
+algorithm: reads set a slot's reference bit, and the writer takes the
+first slot without it, clearing the bits it passes.
+"""
+#
+# Standard library imports.
+#
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from pathlib import Path  # python 3.4
+#
+# Global defs.
+#
+MAGIC = b'FYSC0001'
+FILE_HEADER = struct.Struct('<8sII')  # magic, slots, slot size
+SLOT_HEADER = struct.Struct('<I16sIB3x')  # seq, key, length, referenced
+SEQ = struct.Struct('<I')
+REFERENCED = 24  # offset of the reference bit in a slot
+PROBES = 8  # slots a key may occupy
+STRIPES = 64  # write locks
+READ_RETRIES = 4  # attempts to read a slot while it is written
+
+
+def _key_hash(key):
+    return hashlib.sha256(key.encode('UTF-8')).digest()[:16]
+
+
+class SharedCache(object):
+    """Key-value cache in a memory-mapped file shared across processes."""
+
+    def __init__(self, path, slots=4096, slot_size=8192):
+        """Open or create a cache.
+
+        :param path: path of the cache file; processes sharing the
+                     cache must use the same path and geometry.
+        :param slots: number of slots.
+        :param slot_size: bytes per slot, including a small header;
+                          larger values are not cached.
+        """
+        self.path = Path(path)
+        self.slots = slots
+        self.slot_size = slot_size
+        self.max_value = slot_size - SLOT_HEADER.size
+        self.size = FILE_HEADER.size + slots * slot_size
+        self.locks = [threading.Lock() for unused in range(STRIPES)]
+        self.lock_file = open(str(self.path) + '.lock', 'a+b')
+        fcntl.lockf(self.lock_file, fcntl.LOCK_EX, STRIPES, 0)
+        try:
+            self._open()
+        finally:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_UN, STRIPES, 0)
+
+    def _open(self):
+        """Map the file, creating it if missing or of another geometry.
+
+        Caller holds all stripe locks.
+        """
+        header = FILE_HEADER.pack(MAGIC, self.slots, self.slot_size)
+        try:
+            fd = os.open(str(self.path), os.O_RDWR)
+        except FileNotFoundError:
+            fd = None
+        if fd is not None and (os.fstat(fd).st_size != self.size or
+                               os.pread(fd, FILE_HEADER.size, 0) != header):
+            os.close(fd)
+            fd = None
+        if fd is None:
+            #
+            # Replace rather than resize the file, so processes still
+            # mapping an old one are not cut off from it.
+            #
+            fd, tmp_path = tempfile.mkstemp(dir=str(self.path.parent),
+                                            suffix='.tmp')
+            try:
+                os.ftruncate(fd, self.size)
+                os.pwrite(fd, header, 0)
+                os.replace(tmp_path, str(self.path))
+            except OSError:
+                os.close(fd)
+                os.unlink(tmp_path)
+                raise
+        try:
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+    def _offset(self, slot):
+        return FILE_HEADER.size + slot * self.slot_size
+
+    def _candidates(self, key_hash):
+        bucket = int.from_bytes(key_hash[:8], 'little') % self.slots
+        return [(bucket + probe) % self.slots for probe in range(PROBES)]
+
+    def get(self, key):
+        """Return the value for a key, or None."""
+        key_hash = _key_hash(key)
+        for slot in self._candidates(key_hash):
+            offset = self._offset(slot)
+            for unused in range(READ_RETRIES):
+                seq, slot_key, length, referenced = \
+                    SLOT_HEADER.unpack_from(self.map, offset)
+                if seq & 1:
+                    continue  # being written
+                if slot_key != key_hash or length > self.max_value:
+                    break
+                start = offset + SLOT_HEADER.size
+                value = self.map[start:start + length]
+                if SEQ.unpack_from(self.map, offset)[0] != seq:
+                    continue
+                if not referenced:
+                    self.map[offset + REFERENCED] = 1
+                return value
+        return None
+
+    def put(self, key, value):
+        """Store a value for a key.
+
+        :return: False if the value is too large to cache.
+        """
+        if len(value) > self.max_value:
+            return False
+        key_hash = _key_hash(key)
+        candidates = self._candidates(key_hash)
+        #
+        # A key's slots can overlap the next stripe's, so writers lock
+        # the stripe of each slot they may change, in order.
+        #
+        stripes = sorted(set(slot % STRIPES for slot in candidates))
+        for number in stripes:
+            self.locks[number].acquire()
+            fcntl.lockf(self.lock_file, fcntl.LOCK_EX, 1, number)
+        try:
+            self._write(self._choose(key_hash, candidates), key_hash, value)
+        finally:
+            for number in reversed(stripes):
+                fcntl.lockf(self.lock_file, fcntl.LOCK_UN, 1, number)
+                self.locks[number].release()
+        return True
+
+    def _choose(self, key_hash, candidates):
+        """Return the slot to write a key to.  Caller holds its locks."""
+        empty = None
+        for slot in candidates:
+            seq, slot_key, length, referenced = \
+                SLOT_HEADER.unpack_from(self.map, self._offset(slot))
+            if slot_key == key_hash:
+                return slot
+            if empty is None and slot_key == bytes(16):
+                empty = slot
+        if empty is not None:
+            return empty
+        for unused in range(2):
+            for slot in candidates:
+                offset = self._offset(slot)
+                if not self.map[offset + REFERENCED]:
+                    return slot
+                self.map[offset + REFERENCED] = 0
+        return candidates[0]
+
+    def _write(self, slot, key_hash, value):
+        offset = self._offset(slot)
+        seq = SEQ.unpack_from(self.map, offset)[0]
+        SEQ.pack_into(self.map, offset, (seq + 1) & 0xffffffff)
+        start = offset + SLOT_HEADER.size
+        self.map[start:start + len(value)] = value
+        SLOT_HEADER.pack_into(self.map, offset, (seq + 1) & 0xffffffff,
+                              key_hash, len(value), 1)
+        SEQ.pack_into(self.map, offset, (seq + 2) & 0xffffffff)
+
+    def delete(self, key):
+        """Remove a key, if cached."""
+        key_hash = _key_hash(key)
+        candidates = self._candidates(key_hash)
+        for slot in candidates:
+            number = slot % STRIPES
+            with self.locks[number]:
+                fcntl.lockf(self.lock_file, fcntl.LOCK_EX, 1, number)
+                try:
+                    offset = self._offset(slot)
+                    seq, slot_key, length, referenced = \
+                        SLOT_HEADER.unpack_from(self.map, offset)
+                    if slot_key == key_hash:
+                        SLOT_HEADER.pack_into(self.map, offset,
+                                              (seq + 2) & 0xffffffff,
+                                              bytes(16), 0, 0)
+                finally:
+                    fcntl.lockf(self.lock_file, fcntl.LOCK_UN, 1, number)
+
+    def stats(self):
+        """Return the number of slots in use and the total."""
+        used = sum(1 for slot in range(self.slots)
+                   if SLOT_HEADER.unpack_from(self.map, self._offset(slot))[1]
+                   != bytes(16))
+        return {'used': used, 'slots': self.slots}
+
+    def close(self):
+        self.map.close()
+        self.lock_file.close()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""Coalesce identical concurrent work into a single call.
+
+Within a process, threads asking for a key that is already being
+computed wait for that computation and share its result.  Optionally,
+processes on the same host coordinate too: the process that gets a
+per-key file lock computes the result and leaves it in a JSON file,
+and processes that were waiting on the lock pick it up from there.
+The lock is a lease: a waiter that has waited longer than the lease
+gives up on coordination and computes the result itself.
+
+A caller that cannot wait indefinitely starts the call on an executor
+and waits for it with a timeout; the call runs to completion either
+way, and its result is shared with everyone waiting for it.
+"""
+#
+# Standard library imports.
+#
+import fcntl
+import json
+import os
+import threading
+import time
+from pathlib import Path  # python 3.4
+#
+# Local imports.
+#
+from .metrics import cache_lookup
+#
+# Global defs.
+#
+POLL_INTERVAL = 0.02
+CLEANUP_EVERY = 100  # calls between sweeps of stale files
+
+
+def _same_file(fh, path):
+    """Return True if an open file is still the one at path."""
+    try:
+        linked = os.stat(str(path))
+    except FileNotFoundError:
+        return False
+    opened = os.fstat(fh.fileno())
+    return (opened.st_dev, opened.st_ino) == (linked.st_dev, linked.st_ino)
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """Return the call's result, or raise its error.
+
+        :param timeout: seconds to wait, or None to wait until done.
+        :raises TimeoutError: if the call is not done within timeout.
+        """
+        if not self.event.wait(timeout):
+            raise TimeoutError('Call not done within %.3g s.' % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight(object):
+    """Run at most one call per key at a time, sharing the result."""
+
+    def __init__(self, directory=None, result_ttl=30., lease=30.):
+        """Create a coalescer.
+
+        :param directory: directory for cross-process lock and result
+                          files, or None to coalesce within the process
+                          only.  Results must be JSON-serializable if set.
+        :param result_ttl: seconds a result file is reused by other
+                           processes.
+        :param lease: seconds to wait on another process before
+                      computing the result anyway.
+        """
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.directory = None
+        if directory is not None:
+            self.directory = Path(directory)
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self.result_ttl = result_ttl
+        self.lease = lease
+        self.ncalls = 0
+
+    def do(self, key, func, timeout=None, executor=None):
+        """Return func(), or the result of an identical call in flight.
+
+        :param key: string identifying the work; must be usable as a
+                    file name if coordinating across processes.
+        :param func: callable with no arguments.
+        :param timeout: seconds to wait for the result, or None.
+        :param executor: executor to run func on if this call leads;
+                         required with a timeout.
+        :raises TimeoutError: if the result is not ready within timeout.
+        """
+        if timeout is not None:
+            return self.start(key, func, executor).wait(timeout)
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            cache_lookup('singleflight', True)
+            return call.wait()
+        self._run(key, func, call)
+        return call.wait()
+
+    def start(self, key, func, executor):
+        """Start func() on an executor, unless an identical call is in
+        flight, and return the call.
+
+        The call has done(), and wait(timeout=None), which returns the
+        result or raises the call's error or TimeoutError.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if leader:
+            try:
+                executor.submit(self._run, key, func, call)
+            except RuntimeError as exc:  # executor shut down
+                call.error = exc
+                with self.lock:
+                    del self.calls[key]
+                call.event.set()
+        else:
+            cache_lookup('singleflight', True)
+        return call
+
+    def _run(self, key, func, call):
+        try:
+            call.result = self._lead(key, func)
+        except Exception as exc:
+            call.error = exc
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+    def in_flight(self, key):
+        """Return True if a call for key is running here or elsewhere."""
+        with self.lock:
+            if key in self.calls:
+                return True
+        if self.directory is None:
+            return False
+        lock_path = self.directory / (key + '.lock')
+        if not lock_path.exists():
+            return False
+        try:
+            with lock_path.open('a') as lock_fh:
+                fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
+        except BlockingIOError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    def _read_result(self, result_path):
+        try:
+            if time.time() - result_path.stat().st_mtime > self.result_ttl:
+                return None
+            with result_path.open() as result_fh:
+                return json.load(result_fh)
+        except (OSError, ValueError):
+            return None
+
+    def _lead(self, key, func):
+        if self.directory is None:
+            cache_lookup('singleflight', False)
+            return func()
+        lock_path = self.directory / (key + '.lock')
+        result_path = self.directory / (key + '.json')
+        lock_fh, locked = self._lock(lock_path)
+        with lock_fh:
+            try:
+                result = self._read_result(result_path)
+                cache_lookup('singleflight', result is not None)
+                if result is not None:
+                    return result
+                result = func()
+                tmp_path = result_path.with_suffix('.%d.tmp' % os.getpid())
+                with tmp_path.open('w') as result_fh:
+                    json.dump(result, result_fh)
+                os.replace(str(tmp_path), str(result_path))
+                return result
+            finally:
+                if locked:
+                    fcntl.flock(lock_fh, fcntl.LOCK_UN)
+                self._maybe_cleanup()
+
+    def _lock(self, lock_path):
+        """Open and lock a key's lock file, waiting up to the lease.
+
+        Cleanup may unlink the file between our opening and locking it,
+        and a lock on an unlinked file excludes no one, so the lock is
+        kept only if the file is still at lock_path.
+
+        :return: (open lock file, True if locked).
+        """
+        give_up = time.monotonic() + self.lease
+        while True:
+            lock_fh = lock_path.open('a')
+            while True:
+                try:
+                    fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    if time.monotonic() > give_up:
+                        return lock_fh, False
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                if _same_file(lock_fh, lock_path):
+                    return lock_fh, True
+                lock_fh.close()  # unlinked: try the file there now
+                break
+
+    def _maybe_cleanup(self):
+        """Every so often, remove expired result files and idle locks."""
+        self.ncalls += 1
+        if self.ncalls % CLEANUP_EVERY:
+            return
+        expired = time.time() - max(self.result_ttl, self.lease)
+        for path in self.directory.iterdir():
+            try:
+                if path.stat().st_mtime > expired:
+                    continue
+                if path.suffix != '.lock':
+                    path.unlink()
+                    continue
+                #
+                # Unlink a lock file only while holding its lock, and
+                # only if it is still the file at path: another sweep
+                # may have replaced it with one in use.
+                #
+                with path.open('a') as lock_fh:
+                    fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    if _same_file(lock_fh, path):
+                        path.unlink()
+            except (OSError, BlockingIOError):
+                continue
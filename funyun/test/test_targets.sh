@@ -123,6 +123,7 @@ test_GET /funyun/time_as_JSON
 # Passworded targets.
 #
 test_GET_PASSWORD /log.txt
+test_GET_PASSWORD /metrics
 test_GET_PASSWORD /environment
 trap - EXIT
 echo "funyun  tests completed successfully."
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Keep uploaded images on disk, addressed by digest.
+
+Images are stored once per digest and shared by all workers on the
+host, so any worker can serve or analyze an image uploaded to another.
+The least recently used images beyond a limit are removed.
+"""
+#
+# Standard library imports.
+#
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path  # python 3.4
+#
+# Local imports.
+#
+from .cassette import image_digest
+from .filesystem import prune_files
+#
+# Global defs.
+#
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+PRUNE_EVERY = 100  # images stored between sweeps of old images
+
+
+class UploadStore(object):
+    """Directory of uploaded images, named by SHA-256 digest."""
+
+    def __init__(self, directory, max_entries=1000):
+        """Create an upload store.
+
+        :param directory: directory for image files.
+        :param max_entries: images kept.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.puts = 0
+
+    def path(self, digest):
+        if not DIGEST_RE.match(digest):
+            raise KeyError(digest)
+        return self.directory / (digest + '.img')
+
+    def put(self, data):
+        """Store an image and return its digest."""
+        digest = image_digest(data)
+        path = self.path(digest)
+        if path.exists():
+            os.utime(str(path))
+            return digest
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.directory),
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as image_fh:
+                image_fh.write(data)
+            os.replace(tmp_path, str(path))
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+        with self.lock:
+            self.puts += 1
+            prune = self.puts % PRUNE_EVERY == 0
+        if prune:
+            prune_files(self.directory, '*.img', self.max_entries)
+        return digest
+
+    def get(self, digest):
+        """Return the bytes of an image, or None if not stored."""
+        try:
+            return self.path(digest).read_bytes()
+        except (KeyError, OSError):
+            return None
+
+    def __contains__(self, digest):
+        try:
+            return self.path(digest).exists()
+        except KeyError:
+            return False
@@ -0,0 +1 @@
+version = '0.1.dev0'
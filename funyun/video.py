@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""Analyze videos and animated GIFs as a series of keyframes.
+
+Frames are sampled at a fixed rate: GIFs are decoded with Pillow, other
+formats are decoded by an ffmpeg subprocess that writes JPEG frames to
+a pipe and errors to a temporary file.  A frame is kept only if its
+difference hash differs enough from the last kept frame, so a static
+shot costs one analysis, not one per sample.  Keyframes are analyzed
+on a thread pool while extraction continues, with a bounded number in
+flight, so frames are never all in memory at once.  The per-keyframe
+results are merged into a timeline.
+
+Pillow is an optional dependency (the 'video' extra); ffmpeg must be
+on the path for formats other than GIF.
+"""
+#
+# Standard library imports.
+#
+import subprocess
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+#
+# Third-party imports.
+#
+try:
+    from PIL import Image, ImageSequence
+except ImportError:  # optional, install the 'video' extra
+    Image = None
+#
+# Local imports.
+#
+from .analysis import analyze_image
+from .imagecheck import ImageValidationError, validate_image
+#
+# Global defs.
+#
+VIDEO_EXTENSIONS = ['gif', 'mp4', 'm4v', 'mov', 'webm', 'mkv', 'avi']
+GIF_MAGIC = (b'GIF87a', b'GIF89a')
+GIF_DEFAULT_DURATION = 100  # ms, as browsers do for 0 or missing
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+JPEG_QUALITY = 90
+PIPE_CHUNK_SIZE = 64 * 1024
+HASH_SIZE = 8  # bits per side of the difference hash
+
+
+class VideoError(ValueError):
+    """A video could not be decoded."""
+
+
+def _require_pillow():
+    if Image is None:
+        raise VideoError('Video analysis requires Pillow '
+                         '(pip install funyun[video]).')
+
+
+def _to_jpeg(image):
+    outfh = BytesIO()
+    image.convert('RGB').save(outfh, 'JPEG', quality=JPEG_QUALITY)
+    return outfh.getvalue()
+
+
+def iter_gif_frames(path, fps, max_seconds):
+    """Yield (time, JPEG bytes) for a GIF sampled at fps.
+
+    A frame shown across several sample times is yielded only once.
+    """
+    _require_pillow()
+    interval = 1. / fps
+    next_sample = 0.
+    frame_start = 0.
+    with Image.open(path) as gif:
+        for frame in ImageSequence.Iterator(gif):
+            if next_sample >= max_seconds:
+                break
+            duration = frame.info.get('duration') or GIF_DEFAULT_DURATION
+            frame_end = frame_start + duration / 1000.
+            if next_sample < frame_end:
+                yield next_sample, _to_jpeg(frame)
+                while next_sample < frame_end:
+                    next_sample += interval
+            frame_start = frame_end
+
+
+def iter_ffmpeg_frames(path, fps, max_seconds, ffmpeg='ffmpeg'):
+    """Yield (time, JPEG bytes) for a video sampled at fps by ffmpeg."""
+    command = [ffmpeg, '-nostdin', '-v', 'error',
+               '-t', str(max_seconds), '-i', str(path),
+               '-vf', 'fps=%g' % fps,
+               '-f', 'image2pipe', '-c:v', 'mjpeg', '-q:v', '3',
+               'pipe:1']
+    #
+    # Errors go to a file rather than a second pipe, which ffmpeg could
+    # fill and block on while we wait for frames.
+    #
+    errors_fh = tempfile.TemporaryFile()
+    try:
+        process = subprocess.Popen(command,
+                                   stdout=subprocess.PIPE,
+                                   stderr=errors_fh)
+    except OSError as exc:
+        errors_fh.close()
+        raise VideoError('Unable to run %s: %s' % (ffmpeg, exc))
+    buffer = bytearray()
+    nframes = 0
+    try:
+        while True:
+            chunk = process.stdout.read(PIPE_CHUNK_SIZE)
+            if not chunk:
+                break
+            buffer += chunk
+            #
+            # ffmpeg's JPEG frames have no embedded thumbnails, so the
+            # first EOI marker ends the frame.
+            #
+            while True:
+                end = buffer.find(JPEG_EOI, 2)
+                if end < 0:
+                    break
+                frame = bytes(buffer[:end + 2])
+                del buffer[:end + 2]
+                if frame.startswith(JPEG_SOI):
+                    yield nframes / fps, frame
+                    nframes += 1
+        if process.wait() != 0 and nframes == 0:
+            errors_fh.seek(0)
+            errors = errors_fh.read().decode('UTF-8', 'replace').strip()
+            raise VideoError('Unable to decode video: %s' % errors)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        errors_fh.close()
+
+
+def iter_frames(path, fps, max_seconds, ffmpeg='ffmpeg'):
+    """Yield (time, JPEG bytes) samples from a video or animated GIF."""
+    with open(str(path), 'rb') as fh:
+        magic = fh.read(6)
+    if magic in GIF_MAGIC:
+        return iter_gif_frames(path, fps, max_seconds)
+    return iter_ffmpeg_frames(path, fps, max_seconds, ffmpeg=ffmpeg)
+
+
+def dhash(jpeg):
+    """Return the 64-bit difference hash of JPEG bytes.
+
+    The JPEG is decoded at reduced scale, which is much cheaper than a
+    full decode.
+    """
+    _require_pillow()
+    image = Image.open(BytesIO(jpeg))
+    image.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))
+    pixels = list(image.convert('L')
+                  .resize((HASH_SIZE + 1, HASH_SIZE))
+                  .getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] >
+                                    pixels[offset + col + 1])
+    return value
+
+
+def iter_keyframes(frames, max_distance, interval, counts):
+    """Drop frames nearly identical to the last frame kept.
+
+    :param frames: iterable of (time, JPEG bytes).
+    :param max_distance: frames whose hash differs from the last kept
+                         frame's in this many bits or fewer are dropped.
+    :param interval: seconds between samples.
+    :param counts: dict updated with 'frames', 'keyframes' and 'end'
+                   (the time just past the last frame).
+    """
+    last_hash = None
+    for time, jpeg in frames:
+        counts['frames'] += 1
+        counts['end'] = time + interval
+        frame_hash = dhash(jpeg)
+        if last_hash is not None and \
+                bin(frame_hash ^ last_hash).count('1') <= max_distance:
+            continue
+        last_hash = frame_hash
+        counts['keyframes'] += 1
+        yield time, jpeg
+
+
+def _segments(times, keyframe_times, end):
+    """Merge the spans of the keyframes at times into [start, end] pairs.
+
+    A keyframe stands for the video from its time until the next
+    keyframe.
+    """
+    next_time = dict(zip(keyframe_times, keyframe_times[1:] + [end]))
+    segments = []
+    for time in times:
+        stop = max(next_time[time], time)
+        if segments and segments[-1][1] >= time:
+            segments[-1][1] = stop
+        else:
+            segments.append([time, stop])
+    return segments
+
+
+def merge_timeline(keyframes, end):
+    """Merge per-keyframe analyses into a timeline.
+
+    :param keyframes: list of (time, analysis dict) in time order.
+    :param end: time just past the last sampled frame.
+    :return: dict with per-label and per-celebrity confidence and time
+             segments, and the per-keyframe timeline.
+    """
+    keyframe_times = [time for time, result in keyframes]
+    labels = {}
+    celebrities = {}
+    timeline = []
+    for time, result in keyframes:
+        for label, confidence in result['labels'].items():
+            entry = labels.setdefault(label, {'confidence': 0., 'times': []})
+            entry['confidence'] = max(entry['confidence'], confidence)
+            entry['times'].append(time)
+        for celebrity in result['celebrities']:
+            entry = celebrities.setdefault(celebrity['name'],
+                                           {'id': celebrity['id'],
+                                            'urls': celebrity['urls'],
+                                            'confidence': 0.,
+                                            'times': []})
+            entry['confidence'] = max(entry['confidence'],
+                                      celebrity['confidence'])
+            entry['times'].append(time)
+        timeline.append({'time': time,
+                         'labels': result['labels'],
+                         'faces': result['faces'],
+                         'celebrities': [c['name']
+                                         for c in result['celebrities']]})
+    for entries in (labels, celebrities):
+        for entry in entries.values():
+            entry['segments'] = _segments(entry.pop('times'),
+                                          keyframe_times, end)
+    return {'labels': labels,
+            'celebrities': celebrities,
+            'timeline': timeline}
+
+
+def analyze_video(rek,
+                  path,
+                  fps=1.,
+                  max_distance=6,
+                  workers=4,
+                  max_seconds=60,
+                  min_dimension=1,
+                  ffmpeg='ffmpeg'):
+    """Analyze the keyframes of a video or animated GIF.
+
+    :param rek: a Rekognize instance.
+    :param path: path of the video file.
+    :param fps: frames sampled per second.
+    :param max_distance: dedup threshold, see iter_keyframes().
+    :param workers: keyframes analyzed concurrently.
+    :param max_seconds: length of video analyzed.
+    :param min_dimension: smallest frame width or height analyzed.
+    :param ffmpeg: ffmpeg executable.
+    :return: dict of results, see merge_timeline().
+    :raises VideoError: if the video can't be decoded.
+    """
+    counts = {'frames': 0, 'keyframes': 0, 'end': 0.}
+    frames = iter_frames(path, fps, max_seconds, ffmpeg=ffmpeg)
+    keyframes = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for time, jpeg in iter_keyframes(frames, max_distance, 1. / fps,
+                                         counts):
+            if not pending and not keyframes:
+                try:
+                    validate_image(jpeg, min_dimension=min_dimension)
+                except ImageValidationError as exc:
+                    raise VideoError('Frames unusable: %s' % exc)
+            pending.append((time,
+                            executor.submit(analyze_image, rek, jpeg)))
+            while len(pending) > workers * 2:
+                time, future = pending.popleft()
+                keyframes.append((time, future.result()))
+        while pending:
+            time, future = pending.popleft()
+            keyframes.append((time, future.result()))
+    if counts['frames'] == 0:
+        raise VideoError('No frames found in video.')
+    result = merge_timeline(keyframes, counts['end'])
+    result.update({'fps': fps,
+                   'duration': counts['end'],
+                   'frames': counts['frames'],
+                   'keyframes': counts['keyframes']})
+    return result
@@ -134,7 +134,11 @@ tests_require = [
     'pytest>=2.8.0'
 ]
 
-extras_require = dict(docs=['Sphinx>=1.4.2'], tests=tests_require)
+extras_require = dict(docs=['Sphinx>=1.4.2'],
+                      tests=tests_require,
+                      video=['Pillow'],
+                      faces=['Pillow'],
+                      preprocess=['Pillow'])
 
 extras_require['all'] = []
 for reqs in extras_require.values():
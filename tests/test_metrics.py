@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Tests of metrics merged across processes."""
+#
+# Standard library imports.
+#
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import threading
+from pathlib import Path  # python 3.4
+#
+# Global defs.
+#
+# The registry is loaded from its file, not through the funyun package,
+# whose import creates the Flask app.
+#
+METRICS_PATH = (Path(__file__).resolve().parent.parent / 'funyun' /
+                'metrics.py')
+_spec = importlib.util.spec_from_file_location('funyun_metrics',
+                                               str(METRICS_PATH))
+metrics = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(metrics)
+
+
+def _dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def _write(directory, pid, requests):
+    with (directory / ('%d.json' % pid)).open('w') as fh:
+        json.dump({'pid': pid,
+                   'counters': [['funyun_requests_total', [], requests]],
+                   'gauges': [],
+                   'histograms': []}, fh)
+
+
+def test_scrapes_count_live_processes_once(tmp_path):
+    registry = metrics.MetricsRegistry()
+    registry.configure(tmp_path, flush_interval=60.)
+    _write(tmp_path, os.getppid(), 5)  # a live worker
+    _write(tmp_path, _dead_pid(), 3)  # an exited worker
+    key = ('funyun_requests_total', ())
+    for unused in range(2):
+        counters, gauges, histograms = registry.collect()
+        assert counters[key] == 8
+    with (tmp_path / 'archive.json').open() as fh:
+        assert json.load(fh)['counters'] == [['funyun_requests_total', [],
+                                              3]]
+
+
+def test_concurrent_flushes(tmp_path):
+    registry = metrics.MetricsRegistry()
+    registry.configure(tmp_path, flush_interval=0.)
+    errors = []
+
+    def count():
+        try:
+            for unused in range(200):
+                registry.inc('funyun_requests_total')
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=count) for unused in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    counters, gauges, histograms = registry.collect()
+    assert counters[('funyun_requests_total', ())] == 1600